@@ -133,7 +133,10 @@ class BaseActor(object):
             script.stop()
 
     def find_block_definition(self, function_name):
-        bd = self.blocks.find_block_definition(function_name)
+        """Finds a custom block's definition; ours hide the project's"""
+        bd = None
+        if self.blocks is not None:
+            bd = self.blocks.find_block_definition(function_name)
         return bd or self.project.find_block_definition(function_name)
 
 
@@ -243,22 +246,58 @@ class Sprite(BaseActor):
             if len(self.speech_message) > 0:
                 self.create_new_speech_message = True
 
+    def draw_state(self):
+        """Returns everything that affects how this sprite looks on screen,
+        so that we can tell if it needs to be redrawn"""
+        return (self.value_of_property("@x").as_number(),
+                self.value_of_property("@y").as_number(),
+                self.value_of_property("@heading").as_number(),
+                self.value_of_property("@scale").as_number(),
+                self.costume, self.speech_message, self.speech_is_thought)
+
+    def set_draw_state(self, state):
+        """Makes this sprite look the way draw_state() said another copy
+        of it did (such as one running on a worker process)"""
+        x, y, heading, scale, self.costume, message, is_thought = state
+        for name, value in (("@x", x), ("@y", y),
+                            ("@heading", heading), ("@scale", scale)):
+            self.set_property(name, data.Literal(value))
+        self.say_or_think(message, is_thought)
+
+    def current_speech_image(self, media_environment):
+        """Returns the image of what we're saying, or None if we are quiet"""
+        if len(self.speech_message) == 0:
+            return None
+        if self.create_new_speech_message:
+            self.speech_image = \
+                media_environment.create_speech_message(
+                    self.speech_message, self.speech_is_thought)
+            self.create_new_speech_message = False
+        return self.speech_image
+
     def draw(self, media_environment):
-        x = self.value_of_property("@x").as_number()
-        y = self.value_of_property("@y").as_number()
+        x, y, heading, scale = self.draw_state()[:4]
         if self.costumes:
             self.costumes.draw(media_environment,
-                               self.costume, x, y,
-                               self.value_of_property("@heading").as_number(),
-                               self.value_of_property("@scale").as_number())
-        if len(self.speech_message) > 0:
-            if self.create_new_speech_message:
-                self.speech_image = \
-                    media_environment.create_speech_message(
-                        self.speech_message, self.speech_is_thought)
-                self.create_new_speech_message = False
+                               self.costume, x, y, heading, scale)
+        speech_image = self.current_speech_image(media_environment)
+        if speech_image is not None:
             media_environment.draw_speech_message(
-                self.speech_image, (x + 30, y + 30))
+                speech_image, (x + 30, y + 30))
+
+    def screen_rects(self, media_environment):
+        """Returns the areas of the screen this sprite covers when drawn"""
+        x, y, heading, scale = self.draw_state()[:4]
+        rects = []
+        if self.costumes:
+            rects.append(self.costumes.rect(media_environment,
+                                            self.costume, x, y,
+                                            heading, scale))
+        speech_image = self.current_speech_image(media_environment)
+        if speech_image is not None:
+            rects.append(media_environment.speech_message_rect(
+                speech_image, (x + 30, y + 30)))
+        return rects
 
     def radians_from_heading(self):
         """Returns an angle representing the heading, in the range (0, 360)"""
@@ -297,8 +336,9 @@ class Stage(BaseActor):
         self.pentrails = None  # unique to stage
         self.sprites = []  # unique to stage
 
-    def deserialize(self, elem):
-        """Loads this class from an element tree representation"""
+    def deserialize(self, elem, sprites=None):
+        """Loads this class from an element tree representation.
+        If the sprites have already been loaded, pass them in."""
         assert (elem.tag == "stage")
 
         super(Stage, self).deserialize(elem)
@@ -318,6 +358,10 @@ class Stage(BaseActor):
         # unique children
         self.pentrails = elem.find("pentrails")
 
+        if sprites is not None:
+            self.sprites = sprites
+            return
+
         # The sprites and divided into sprite and watcher elements;
         # keep them all in order
         sprites = elem.find("sprites")
@@ -370,6 +414,13 @@ class Stage(BaseActor):
                 stage.append(child)
         return stage
 
+    def draw_state(self):
+        """Returns everything that affects how the stage looks on screen"""
+        return (self.costume, )
+
+    def set_draw_state(self, state):
+        self.costume, = state
+
     def draw(self, media_environment):
         if self.costumes:
             self.costumes.draw_stage(media_environment, self.costume)
@@ -397,8 +448,9 @@ class Project:
         self.blocks = None
         self.variables = data.Variables()
 
-    def deserialize(self, elem):
-        """Loads this class from an element tree representation"""
+    def deserialize(self, elem, sprites=None):
+        """Loads this class from an element tree representation.
+        If the stage's sprites have already been loaded, pass them in."""
 
         assert (elem.tag == "project")
 
@@ -410,7 +462,7 @@ class Project:
         # children
         self.notes = elem.find("notes")
         self.thumbnail = elem.find("thumbnail")
-        self.stage.deserialize(elem.find("stage"))
+        self.stage.deserialize(elem.find("stage"), sprites)
         self.hidden = elem.find("hidden")
         self.headers = elem.find("headers")
         self.code = elem.find("code")
@@ -437,6 +489,8 @@ class Project:
         return self.variables.get_variable(name)
 
     def find_block_definition(self, function_name):
+        if self.blocks is None:
+            return None
         return self.blocks.find_block_definition(function_name)
 
     def all_actors(self):
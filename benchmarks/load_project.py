@@ -0,0 +1,106 @@
+"""load_project.py
+
+Times loading a project, and measures the memory it takes to do so,
+reading the whole XML tree at once ('tree') or as a stream ('stream').
+
+    python benchmarks/load_project.py [project.xml] [--repeat N]
+                                      [--copies N]
+
+--copies makes a bigger project to load, by copying its sprites N times.
+
+Each way of loading runs in a fresh process, so that their peak memory
+use can be compared fairly."""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+import copy
+import xml.etree.cElementTree as ElementTree
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, ".."))
+
+import factory
+
+default_project = os.path.join(here, "..", "tests", "sample_project.xml")
+
+
+def load_tree(filename):
+    return factory.deserialize_value(
+        ElementTree.parse(filename).getroot(), None)
+
+
+def load_stream(filename):
+    return factory.deserialize_file(filename, None)
+
+loaders = {"tree": load_tree, "stream": load_stream}
+
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(mode, filename, repeat):
+    """Loads the project; prints the time taken and memory used"""
+    loader = loaders[mode]
+    start_memory = peak_memory_kb()
+    project = loader(filename)
+    peak = peak_memory_kb() - start_memory
+    del project
+
+    start = time.time()
+    for i in range(repeat):
+        loader(filename)
+    elapsed = (time.time() - start) / repeat
+    print "%-6s %8.1f ms per load %8d KB peak" % (mode, elapsed * 1000, peak)
+
+
+def make_copies(filename, copies):
+    """Writes a project with each sprite copied; returns its filename"""
+    tree = ElementTree.parse(filename)
+    sprites = tree.getroot().find("stage").find("sprites")
+    originals = list(sprites)
+    for i in range(copies - 1):
+        for sprite in originals:
+            sprites.append(copy.deepcopy(sprite))
+    handle, copies_filename = tempfile.mkstemp(suffix=".xml")
+    os.close(handle)
+    tree.write(copies_filename)
+    return copies_filename
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks project loading")
+    parser.add_argument("project", nargs="?", default=default_project)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--copies", type=int, default=1)
+    parser.add_argument("--mode", choices=sorted(loaders),
+                        help="measure just one way of loading, in this process")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    options = parse_arguments(argv)
+    if options.mode:
+        measure(options.mode, options.project, options.repeat)
+        return
+    filename = options.project
+    if options.copies > 1:
+        filename = make_copies(filename, options.copies)
+    try:
+        print "%s, %d copies (%d KB)" % (options.project, options.copies,
+                                         os.path.getsize(filename) // 1024)
+        for mode in sorted(loaders, reverse=True):
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   filename, "--repeat",
+                                   str(options.repeat), "--mode", mode])
+    finally:
+        if filename != options.project:
+            os.unlink(filename)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,499 @@
+"""suite.py
+
+Benchmarks the interpreter on the projects in tests/, and on made-up
+projects that scale up what real projects do a lot of: many sprites,
+many scripts, deep recursion, many broadcasts, and many sprites waiting.
+
+    python benchmarks/suite.py [case ...] [--list] [--repeat N]
+                               [--run-time SECONDS] [--save FILE]
+                               [--compare FILE] [--tolerance PERCENT]
+
+For each project, it measures:
+
+    load_ms            loading it (factory.deserialize_file)
+    serialize_ms       saving it (factory.xml_for_object)
+    costumes_ms        decoding all its costumes (0 without pygame)
+    transform_ms       rotating and scaling them all, as drawing does
+                       (media.Costumes.image), to several headings and
+                       sizes, with the image cache emptied first
+    run_s              running its green flag scripts, headless, until
+                       they are done (or --run-time is up)
+    cpu_s              the processor time that took (for projects that
+                       mostly wait, this matters more than run_s)
+    blocks             how many blocks ran
+    blocks_per_second
+    peak_kb            the most memory the process used
+
+Blocks are counted through tracing.recorder, and the compiled code turns
+off its shortcuts (tail calls and unboxed arithmetic) while anything is
+recording.  So the project runs twice, from a fresh load each time: once
+as it ships, for run_s and cpu_s, and once to count the blocks.  If it
+is cut off by --run-time, the blocks the first run ran can't be known,
+and blocks_per_second is that of the counting run ("cut_off" is true).
+
+Each case runs in a fresh process, so that its peak memory is its own.
+
+--save writes the results as JSON, to be kept as a baseline.
+--compare prints how the results differ from a baseline, and exits with
+a status of 1 if anything got worse by more than --tolerance percent."""
+
+import os
+import sys
+import json
+import time
+import glob
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, ".."))
+
+import factory
+import media
+import event_loop
+import tracing
+
+tests_directory = os.path.join(here, "..", "tests")
+
+# How big the made-up projects are
+default_sprites = 100
+default_scripts = 100
+default_depth = 2000
+default_broadcasts = 1000
+default_waiters = 300
+
+
+class BlockCounter(object):
+
+    """Stands in for a tracing.TraceRecorder, and just counts blocks"""
+
+    def __init__(self):
+        self.count = 0
+
+    def record(self, block, target, args, result):
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+# Made-up projects
+
+project_template = """<project name="%(name)s" app="Snap! 4.0" version="1">
+<notes></notes><thumbnail></thumbnail>
+<stage name="Stage" width="480" height="360" costume="0" tempo="60"
+       threadsafe="false" lines="round" codify="false" scheduled="false"
+       id="1">
+<costumes><list></list></costumes><sounds><list></list></sounds>
+<variables></variables><blocks></blocks><scripts></scripts>
+<sprites>%(sprites)s</sprites></stage>
+<hidden></hidden><headers></headers><code></code>
+<blocks>%(blocks)s</blocks>
+<variables><variable name="count"><l>0</l></variable>
+<variable name="result"><l>0</l></variable></variables>
+</project>"""
+
+sprite_template = """<sprite name="Sprite%(idx)d" idx="%(idx)d" x="0" y="0"
+    heading="90" scale="1" rotation="1" draggable="true" costume="0"
+    color="80,80,80" pen="tip" id="%(id)d">
+<costumes><list></list></costumes><sounds><list></list></sounds>
+<variables></variables><blocks></blocks>
+<scripts>%(scripts)s</scripts></sprite>"""
+
+# Wander around, counting steps
+wander_script = """<script><block s="receiveGo"/>
+<block s="doRepeat"><l>100</l><script>
+    <block s="forward"><l>1</l></block>
+    <block s="turn"><l>15</l></block>
+    <block s="doChangeVar"><l>count</l><l>1</l></block>
+</script></block></script>"""
+
+count_script = """<script><block s="receiveGo"/>
+<block s="doRepeat"><l>10</l><script>
+    <block s="doChangeVar"><l>count</l><l>1</l></block>
+</script></block></script>"""
+
+# Adds up the numbers to n, the long way
+sum_down_definition = """<block-definition s="sum down %'n'"
+    type="reporter" category="other">
+<inputs><input type="%s"/></inputs>
+<script>
+    <block s="doIf">
+        <block s="reportLessThan"><block var="n"/><l>1</l></block>
+        <script><block s="doReport"><l>0</l></block></script>
+    </block>
+    <block s="doReport"><block s="reportSum"><block var="n"/>
+        <custom-block s="sum down %s">
+            <block s="reportDifference"><block var="n"/><l>1</l></block>
+        </custom-block>
+    </block></block>
+</script></block-definition>"""
+
+sum_down_script = """<script><block s="receiveGo"/>
+<block s="doSetVar"><l>result</l>
+    <custom-block s="sum down %%s"><l>%d</l></custom-block>
+</block></script>"""
+
+broadcast_script = """<script><block s="receiveGo"/>
+<block s="doRepeat"><l>%d</l><script>
+    <block s="doBroadcast"><l>ping</l></block>
+</script></block></script>"""
+
+# Like a particle: mostly waiting
+wait_script = """<script><block s="receiveGo"/>
+<block s="doRepeat"><l>20</l><script>
+    <block s="doWait"><l>0.05</l></block>
+    <block s="turn"><l>15</l></block>
+</script></block></script>"""
+
+receive_script = """<script><block s="receiveMessage"><l>ping</l></block>
+<block s="doChangeVar"><l>count</l><l>1</l></block></script>"""
+
+
+def sprite_xml(idx, scripts):
+    return sprite_template % {"idx": idx, "id": 100 + idx,
+                              "scripts": "".join(scripts)}
+
+
+def project_xml(name, sprites, blocks=""):
+    return project_template % {"name": name, "sprites": "".join(sprites),
+                               "blocks": blocks}
+
+
+def many_sprites(options):
+    return project_xml("sprites", [sprite_xml(i + 1, [wander_script])
+                                   for i in range(options.sprites)])
+
+
+def many_scripts(options):
+    return project_xml("scripts", [sprite_xml(
+        1, [count_script] * options.scripts)])
+
+
+def deep_recursion(options):
+    return project_xml("recursion",
+                       [sprite_xml(1, [sum_down_script % options.depth])],
+                       sum_down_definition)
+
+
+def many_broadcasts(options):
+    return project_xml("broadcasts", [
+        sprite_xml(1, [broadcast_script % options.broadcasts]),
+        sprite_xml(2, [receive_script])])
+
+
+def many_waiters(options):
+    return project_xml("waits", [sprite_xml(i + 1, [wait_script])
+                                 for i in range(options.waiters)])
+
+made_up_projects = {
+    "sprites": many_sprites,
+    "scripts": many_scripts,
+    "recursion": deep_recursion,
+    "broadcasts": many_broadcasts,
+    "waits": many_waiters,
+}
+
+
+def test_projects():
+    """Returns {case name: filename} for the projects in tests/"""
+    projects = {}
+    for filename in glob.glob(os.path.join(tests_directory, "*.xml")):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        projects[name.replace(" ", "_")] = filename
+    return projects
+
+
+def all_cases():
+    cases = sorted(test_projects())
+    cases.extend(sorted(made_up_projects))
+    return cases
+
+
+# Measuring one case (in its own process)
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def average_ms(function, repeat):
+    start = time.time()
+    for i in range(repeat):
+        function()
+    return (time.time() - start) * 1000 / repeat
+
+
+def decode_costumes(project):
+    for actor in project.all_actors():
+        if actor.costumes and actor.costumes.list_node:
+            for costume in actor.costumes.list_node.list:
+                costume.image
+
+# What transform_costumes turns and scales each costume to
+transform_headings = (0, 45, 90, 135, 180, 270)
+transform_scales = (0.5, 1, 2)
+
+
+def transform_costumes(project):
+    """Rotates and scales each costume, as drawing a sprite does"""
+    media.image_cache.clear()  # so that each image is made afresh
+    for actor in project.all_actors():
+        costumes = actor.costumes
+        if costumes and costumes.list_node:
+            for index in range(1, len(costumes.list_node) + 1):
+                for heading in transform_headings:
+                    for scale in transform_scales:
+                        costumes.image(index, heading, scale)
+
+
+def run_green_flag(project, run_time, counter=None):
+    """Runs the project's green flag scripts, as the event loop would;
+    returns the seconds taken.  A BlockCounter, if one is given, counts
+    the blocks that run (see above for what that costs)."""
+    loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+    loop.start_project(project)
+    tracing.recorder = counter
+    start = time.time()
+    try:
+        loop.trigger_green_flag()
+        loop.active_scripts.join(timeout=run_time)
+        elapsed = time.time() - start
+    finally:
+        tracing.recorder = None
+        loop.purge_all_scripts()
+    return elapsed
+
+
+def run_and_count(load, run_time):
+    """Runs a project (from load()) as it ships, then again counting its
+    blocks; returns (seconds, processor seconds, blocks, blocks per
+    second, whether it was cut off)"""
+    cpu_start = cpu_seconds()
+    run_s = run_green_flag(load(), run_time)
+    cpu_s = cpu_seconds() - cpu_start
+
+    counter = BlockCounter()
+    counted_s = run_green_flag(load(), run_time, counter)
+    cut_off = max(run_s, counted_s) >= run_time
+    seconds = counted_s if cut_off else run_s
+    return (run_s, cpu_s, counter.count,
+            counter.count / seconds if seconds else 0, cut_off)
+
+
+def measure(filename, options):
+    """Returns the results for one project"""
+    project = factory.deserialize_file(filename, None)
+    if project.__class__.__name__ != "Project":
+        return None
+
+    start = time.time()
+    decode_costumes(project)
+    costumes_ms = (time.time() - start) * 1000
+
+    run_s, cpu_s, blocks, blocks_per_second, cut_off = run_and_count(
+        lambda: factory.deserialize_file(filename, None), options.run_time)
+
+    return {
+        "load_ms": average_ms(
+            lambda: factory.deserialize_file(filename, None), options.repeat),
+        "serialize_ms": average_ms(
+            lambda: factory.xml_for_object(project), options.repeat),
+        "costumes_ms": costumes_ms,
+        "transform_ms": average_ms(
+            lambda: transform_costumes(project), options.repeat),
+        "run_s": run_s,
+        "cpu_s": cpu_s,
+        "blocks": blocks,
+        "blocks_per_second": blocks_per_second,
+        "cut_off": cut_off,
+        "peak_kb": peak_memory_kb(),
+    }
+
+
+def measure_case(case, options):
+    if case in made_up_projects:
+        handle, filename = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(handle, "w") as f:
+            f.write(made_up_projects[case](options))
+        try:
+            return measure(filename, options)
+        finally:
+            os.unlink(filename)
+    return measure(test_projects()[case], options)
+
+
+def measure_in_subprocess(case, options):
+    command = [sys.executable, os.path.abspath(__file__), "--in-process",
+               "--repeat", str(options.repeat),
+               "--run-time", str(options.run_time),
+               "--sprites", str(options.sprites),
+               "--scripts", str(options.scripts),
+               "--depth", str(options.depth),
+               "--broadcasts", str(options.broadcasts),
+               "--waiters", str(options.waiters), case]
+    output = subprocess.check_output(command)
+    # The last line is ours; projects may print things as they run
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Reporting
+
+# Which way is better, for each measurement?
+lower_is_better = ("load_ms", "serialize_ms", "costumes_ms",
+                   "transform_ms", "run_s", "cpu_s", "peak_kb")
+higher_is_better = ("blocks_per_second",)
+
+# Differences between times smaller than these are just noise
+noise_floors = {"load_ms": 1.0, "serialize_ms": 1.0, "costumes_ms": 1.0,
+                "transform_ms": 1.0, "run_s": 0.01, "cpu_s": 0.01}
+
+
+def print_results(results):
+    print "%-52s %9s %9s %9s %9s %9s %9s %13s %9s" % (
+        "case", "load ms", "save ms", "decode ms", "turn ms", "run s",
+        "cpu s", "blocks/s", "peak KB")
+    for case in sorted(results):
+        r = results[case]
+        if r is None:
+            print "%-52s (not a project)" % case
+            continue
+        print "%-52s %9.2f %9.2f %9.2f %9.2f %9.3f %9.3f %12.0f%1s %9d" % (
+            case, r["load_ms"], r["serialize_ms"], r["costumes_ms"],
+            r.get("transform_ms", 0), r["run_s"], r.get("cpu_s", 0),
+            r["blocks_per_second"], "*" if r.get("cut_off") else "",
+            r["peak_kb"])
+    if any(r and r.get("cut_off") for r in results.values()):
+        print "(* cut off by --run-time; counted with the shortcuts off)"
+
+
+def percent_worse(measurement, old, new):
+    """How much worse is the new value than the old one, in percent?
+    (Negative if it is better.)"""
+    if not old:
+        return 0.0
+    change = (new - old) * 100.0 / old
+    if measurement in higher_is_better:
+        return -change
+    return change
+
+
+def compare(results, baseline, tolerance):
+    """Prints what changed since the baseline; returns the number of
+    measurements that got worse by more than the tolerance"""
+    regressions = 0
+    for case in sorted(results):
+        old, new = baseline["results"].get(case), results[case]
+        if old is None or new is None:
+            continue
+        for measurement in lower_is_better + higher_is_better:
+            if measurement not in old:
+                continue  # the baseline is from before we measured it
+            floor = noise_floors.get(measurement, 0)
+            if old[measurement] < floor and new[measurement] < floor:
+                continue
+            worse = percent_worse(measurement, old[measurement],
+                                  new[measurement])
+            if worse > tolerance:
+                regressions += 1
+                flag = "SLOWER" if measurement != "peak_kb" else "BIGGER"
+            elif worse < -tolerance:
+                flag = "better"
+            else:
+                continue
+            print "%-8s %-40s %-18s %12.2f -> %12.2f (%+.0f%%)" % (
+                flag, case, measurement, old[measurement],
+                new[measurement], -worse if measurement in
+                higher_is_better else worse)
+    return regressions
+
+
+def sizes(options):
+    """How big the made-up projects are"""
+    return {"sprites": options.sprites, "scripts": options.scripts,
+            "depth": options.depth, "broadcasts": options.broadcasts,
+            "waiters": options.waiters}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the interpreter")
+    parser.add_argument("cases", nargs="*",
+                        help="which cases to run (default: all of them)")
+    parser.add_argument("--list", action="store_true",
+                        help="list the cases, and exit")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="how many times to load and save each project")
+    parser.add_argument("--run-time", type=float, default=2.0,
+                        help="longest time to let a project run, in seconds")
+    parser.add_argument("--sprites", type=int, default=default_sprites)
+    parser.add_argument("--scripts", type=int, default=default_scripts)
+    parser.add_argument("--depth", type=int, default=default_depth)
+    parser.add_argument("--broadcasts", type=int, default=default_broadcasts)
+    parser.add_argument("--waiters", type=int, default=default_waiters)
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results here, as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with this baseline")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percent worse that counts as a regression")
+    parser.add_argument("--in-process", action="store_true",
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    options = parse_arguments(argv)
+    if options.list:
+        print "\n".join(all_cases())
+        return 0
+
+    cases = options.cases or all_cases()
+    unknown = set(cases) - set(all_cases())
+    if unknown:
+        print "Unknown cases: %s (try --list)" % ", ".join(sorted(unknown))
+        return 2
+
+    if options.in_process:
+        for case in cases:
+            print json.dumps(measure_case(case, options))
+        return 0
+
+    results = {}
+    for case in cases:
+        results[case] = measure_in_subprocess(case, options)
+    print_results(results)
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.platform(),
+                       "sizes": sizes(options),
+                       "results": results}, f, indent=2, sort_keys=True)
+        print "Saved %s" % options.save
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        print
+        print "Compared with %s (%s, Python %s):" % (
+            options.compare, baseline["machine"], baseline["python"])
+        if baseline["sizes"] != sizes(options):
+            print "(The made-up projects were different sizes: %s)" % (
+                json.dumps(baseline["sizes"], sort_keys=True))
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print "%d measurements are more than %g%% worse" % (
+                regressions, options.tolerance)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,168 @@
+"""switching.py
+
+Compares the concurrency backends (see concurrency.py) on what scripts
+ask of them: switching between scripts, starting them, waking them up on
+time, and running whole projects.
+
+    python benchmarks/switching.py [backend ...] [--switches N]
+                                   [--sleeps N] [--busy N] [--sprites N]
+                                   [--broadcasts N] [--json]
+
+For each backend, it measures:
+
+    switch_us          one script letting another run (sleep(0)), with
+                       two scripts taking turns (threads often carry on
+                       without switching, so this can be very low)
+    spawn_us           starting a script that does nothing, and joining it
+    late_ms            how late a script waking from a 5 ms wait is,
+                       on average, with --busy scripts running
+    late_p95_ms        ... and 95% of the time
+    sprites_bps        blocks per second running the 'sprites' and
+    broadcasts_bps     'broadcasts' projects from suite.py
+
+Each backend runs in a fresh process."""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, ".."))
+
+import concurrency
+import factory
+import suite
+
+
+def switch_us(switches):
+    def take_turns():
+        for i in xrange(switches):
+            concurrency.sleep(0)
+
+    tasks = concurrency.Group()
+    start = time.time()
+    for i in range(2):
+        tasks.add(concurrency.spawn(take_turns))
+    tasks.join()
+    return (time.time() - start) * 1e6 / (2 * switches)
+
+
+def spawn_us(count):
+    tasks = concurrency.Group()
+    start = time.time()
+    for i in xrange(count):
+        tasks.add(concurrency.spawn(lambda: None))
+    tasks.join()
+    return (time.time() - start) * 1e6 / count
+
+
+def lateness_ms(sleeps, busy):
+    """Returns (mean, p95) of how late 5 ms sleeps wake up, in ms"""
+    running = [True]
+    late = []
+
+    def keep_busy():
+        while running[0]:
+            sum(xrange(100))
+            concurrency.sleep(0)
+
+    def wait_repeatedly():
+        for i in xrange(sleeps):
+            start = time.time()
+            concurrency.sleep(0.005)
+            late.append((time.time() - start - 0.005) * 1000)
+
+    tasks = concurrency.Group()
+    for i in range(busy):
+        tasks.add(concurrency.spawn(keep_busy))
+    waiter = concurrency.Group()
+    waiter.add(concurrency.spawn(wait_repeatedly))
+    waiter.join()
+    running[0] = False
+    tasks.join()
+    late.sort()
+    return sum(late) / len(late), late[int(len(late) * 0.95)]
+
+
+def project_bps(xml, run_time):
+    return suite.run_and_count(
+        lambda: factory.deserialize_xml(xml, None), run_time)[3]
+
+
+def measure(backend, options):
+    concurrency.use(backend)
+    late, late_p95 = lateness_ms(options.sleeps, options.busy)
+    return {
+        "switch_us": switch_us(options.switches),
+        "spawn_us": spawn_us(options.switches // 10),
+        "late_ms": late,
+        "late_p95_ms": late_p95,
+        "sprites_bps": project_bps(suite.many_sprites(options),
+                                   options.run_time),
+        "broadcasts_bps": project_bps(suite.many_broadcasts(options),
+                                      options.run_time),
+    }
+
+
+def measure_in_subprocess(backend, options):
+    command = [sys.executable, os.path.abspath(__file__), "--in-process",
+               "--switches", str(options.switches),
+               "--sleeps", str(options.sleeps),
+               "--busy", str(options.busy),
+               "--sprites", str(options.sprites),
+               "--broadcasts", str(options.broadcasts),
+               "--run-time", str(options.run_time), backend]
+    output = subprocess.check_output(command)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Compares the concurrency backends")
+    parser.add_argument("backends", nargs="*",
+                        help="which backends to run (default: all of them)")
+    parser.add_argument("--switches", type=int, default=20000)
+    parser.add_argument("--sleeps", type=int, default=200)
+    parser.add_argument("--busy", type=int, default=10,
+                        help="scripts keeping busy while we measure waits")
+    parser.add_argument("--sprites", type=int, default=suite.default_sprites)
+    parser.add_argument("--broadcasts", type=int,
+                        default=suite.default_broadcasts)
+    parser.add_argument("--run-time", type=float, default=5.0,
+                        help="longest time to let a project run, in seconds")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    parser.add_argument("--in-process", action="store_true",
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    options = parse_arguments(argv)
+    backends = options.backends or sorted(concurrency.backends)
+
+    if options.in_process:
+        for backend in backends:
+            print json.dumps(measure(backend, options))
+        return 0
+
+    results = dict((backend, measure_in_subprocess(backend, options))
+                   for backend in backends)
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return 0
+    print "%-10s %10s %10s %10s %12s %12s %14s" % (
+        "backend", "switch us", "spawn us", "late ms", "late p95 ms",
+        "sprites b/s", "broadcasts b/s")
+    for backend in sorted(results):
+        r = results[backend]
+        print "%-10s %10.2f %10.2f %10.3f %12.3f %12.0f %14.0f" % (
+            backend, r["switch_us"], r["spawn_us"], r["late_ms"],
+            r["late_p95_ms"], r["sprites_bps"], r["broadcasts_bps"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,458 @@
+"""block_compiler.py turns block trees into nested Python closures.
+
+Block.evaluate walks the block tree every time a block runs: it rebuilds
+the argument list, skips over comments, and (for custom blocks) looks up
+the block definition.  Compiling a script once, right after it has been
+deserialized, does all of that up front, so that running a block is just
+a handful of function calls.
+
+Each compiled block is a function taking (target, parent_script) and
+returning the same thing Block.evaluate would.
+
+The tree-walking interpreter remains available as a fallback; set
+'enabled' to False before loading a project to use it instead.
+
+Nested arithmetic blocks (like 'a + b * c') pass plain numbers to each
+other; only the outermost one makes a Literal of its result.
+
+Blocks that read, set, or change a variable remember where they found it
+(see VariableSlot), rather than searching every time they run.
+
+Compiled blocks report to tracing.recorder, just as Block.evaluate does;
+when tracing is off, that costs one global lookup per block.
+
+Blocks in a script that call custom blocks are compiled to generator
+functions instead (see compile_steps), so that a recursive custom block
+doesn't recurse in Python too.  Script.run explains how they are run.
+"""
+
+import operator
+
+import data
+import script
+import tracing
+
+
+# Should scripts be compiled when they are deserialized?
+enabled = True
+
+
+def is_block(item):
+    """Is this argument a block that must be evaluated when run?"""
+    return isinstance(item, script.Block)
+
+
+def compile_constant(value):
+    """Literals, lists, and nested scripts evaluate to themselves"""
+
+    def evaluate(target, parent_script):
+        return value
+    return evaluate
+
+
+def compile_argument(item):
+    if is_block(item):
+        return item.compile()
+    return compile_constant(item)
+
+
+def compile_script(code):
+    """Returns a list of compiled blocks, one per block in the script"""
+    return [compile_statement(block) for block in code.blocks]
+
+
+def compile_statement(block):
+    """Compiles a block that is in a script (not in another block)"""
+    if not calls_custom_blocks(block):
+        return compile_block(block)
+    if is_tail_call(block):
+        return compile_tail_call(block)
+    return compile_steps(block, statement=True)
+
+
+def compile_block(block):
+    """Returns a function that evaluates the block"""
+
+    if block.var_name is not None:
+        return compile_var_block(block)
+
+    arguments = [arg for arg in block.arguments
+                 if not isinstance(arg, data.Comment)]
+
+    if block.type is script.BlockType.custom:
+        return compile_custom_block(block, arguments)
+    if is_arithmetic(block):
+        return compile_boxed_number(compile_arithmetic(block, arguments))
+    if block.function_name in variable_compilers and \
+            len(arguments) == 2 and not is_block(arguments[0]):
+        # The variable's name is known in advance
+        return variable_compilers[block.function_name](block, arguments)
+    if block.function is None:
+        return compile_unknown_block(block, arguments)
+    if not any(is_block(arg) for arg in arguments):
+        return compile_constant_call(block, block.function, arguments)
+    return compile_call(block, block.function, compile_arguments(arguments))
+
+
+def compile_arguments(arguments):
+    """Returns a function that evaluates a list of arguments"""
+
+    if not any(is_block(arg) for arg in arguments):
+        # All of the arguments are constant; build the list once
+        return compile_constant(arguments)
+
+    evaluators = [compile_argument(arg) for arg in arguments]
+
+    # Specialize the common cases so we don't loop over the arguments
+    if len(evaluators) == 1:
+        first, = evaluators
+
+        def evaluate_args(target, parent_script):
+            return [first(target, parent_script)]
+    elif len(evaluators) == 2:
+        first, second = evaluators
+
+        def evaluate_args(target, parent_script):
+            return [first(target, parent_script),
+                    second(target, parent_script)]
+    else:
+        def evaluate_args(target, parent_script):
+            return [evaluator(target, parent_script)
+                    for evaluator in evaluators]
+    return evaluate_args
+
+
+# Arithmetic blocks, and the operation each of them does.
+# These must match what the blocks in ops/operator_blocks.py do.
+arithmetic_operators = {
+    "reportSum": operator.add,
+    "reportDifference": operator.sub,
+    "reportProduct": operator.mul,
+    "reportQuotient": operator.div,
+    "reportModulus": operator.mod,
+}
+
+
+def is_arithmetic(item):
+    """Can this be compiled to a function that returns a plain number?"""
+    return is_block(item) and item.var_name is None and \
+        item.type is script.BlockType.regular and \
+        item.function_name in arithmetic_operators and \
+        len([arg for arg in item.arguments
+             if not isinstance(arg, data.Comment)]) == 2
+
+
+def compile_number(item):
+    """Returns a function that evaluates the item as a plain number"""
+    if is_arithmetic(item):
+        return compile_arithmetic(
+            item, [arg for arg in item.arguments
+                   if not isinstance(arg, data.Comment)])
+    if is_block(item):
+        evaluate = item.compile()
+
+        def number(target, parent_script):
+            return evaluate(target, parent_script).as_number()
+        return number
+    value = item.as_number()
+
+    def number(target, parent_script):
+        return value
+    return number
+
+
+def compile_arithmetic(block, arguments):
+    """Returns a function that does the block's arithmetic, and returns
+    a plain number instead of a Literal"""
+    operation = arithmetic_operators[block.function_name]
+    first, second = [compile_number(arg) for arg in arguments]
+
+    def evaluate(target, parent_script):
+        a = first(target, parent_script)
+        b = second(target, parent_script)
+        result = operation(a, b)
+        if tracing.recorder is not None:
+            tracing.recorder.record(
+                block, target, [data.Literal(a), data.Literal(b)],
+                data.Literal(result))
+        return result
+    return evaluate
+
+
+def compile_boxed_number(number):
+    """Wraps a function returning a number, so it returns a Literal"""
+    def evaluate(target, parent_script):
+        return data.Literal(number(target, parent_script))
+    return evaluate
+
+
+class VariableSlot(object):
+
+    """Finds the variable a compiled block uses.
+
+    Variables are normally found by walking up from the running script,
+    through the scripts it is nested in, to the sprite, then the project.
+    Only names that scripts have declared for themselves need that walk;
+    any other name belongs to the sprite or the project, and once found,
+    it stays found until a variable is added to either of them.
+
+    Scripts on other threads may share the slot, so what it remembers is
+    kept in tuples that are replaced whole, never a field at a time."""
+
+    def __init__(self, name):
+        self.name = name
+        # (generation of script.local_variable_names checked, is_local)
+        self.local = (None, True)
+        # (actor, its variables' version, project variables or None,
+        #  their version, the variable found)
+        self.found = (None, None, None, None, None)
+
+    def find(self, target, parent_script):
+        """Returns the variable, or None if there is no such variable"""
+        generation, is_local = self.local
+        if generation != script.local_names_generation:
+            generation = script.local_names_generation
+            is_local = self.name in script.local_variable_names
+            self.local = (generation, is_local)
+        if is_local:
+            return parent_script.get_variable(target, self.name)
+
+        actor, actor_version, project_variables, project_version, \
+            variable = self.found
+        if target is actor and \
+                target.variables.version == actor_version and \
+                (project_variables is None or
+                 project_variables.version == project_version):
+            return variable
+
+        actor_version = target.variables.version
+        variable = target.variables.get_variable(self.name)
+        project_variables = project_version = None  # not the project's...
+        if variable is None:
+            # ...unless it is a global variable (or it doesn't exist)
+            project_variables = target.project.variables
+            project_version = project_variables.version
+            variable = project_variables.get_variable(self.name)
+        self.found = (target, actor_version, project_variables,
+                      project_version, variable)
+        return variable
+
+
+def compile_var_block(block):
+    find = VariableSlot(block.var_name).find
+    name = block.var_name
+
+    def evaluate(target, parent_script):
+        result = script.variable_value(find(target, parent_script))
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, name, result)
+        return result
+    return evaluate
+
+
+def compile_set_var(block, arguments):
+    name = arguments[0]
+    find = VariableSlot(name.as_string()).find
+    evaluate_value = compile_argument(arguments[1])
+
+    def evaluate(target, parent_script):
+        value = evaluate_value(target, parent_script)
+        variable = find(target, parent_script)
+        if variable:
+            variable.set(value)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, [name, value], None)
+        return None
+    return evaluate
+
+
+def compile_change_var(block, arguments):
+    name = arguments[0]
+    find = VariableSlot(name.as_string()).find
+    evaluate_increment = compile_argument(arguments[1])
+
+    def evaluate(target, parent_script):
+        increment = evaluate_increment(target, parent_script)
+        script.increment_variable_value(find(target, parent_script),
+                                        increment.as_number())
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, [name, increment], None)
+        return None
+    return evaluate
+
+
+# Blocks that are compiled specially when the variable name is constant
+variable_compilers = {
+    "doSetVar": compile_set_var,
+    "doChangeVar": compile_change_var,
+}
+
+
+def compile_constant_call(block, function, args):
+    def evaluate(target, parent_script):
+        result = function(target, parent_script, args)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, args, result)
+        return result
+    return evaluate
+
+
+def compile_call(block, function, evaluate_args):
+    def evaluate(target, parent_script):
+        args = evaluate_args(target, parent_script)
+        result = function(target, parent_script, args)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, args, result)
+        return result
+    return evaluate
+
+
+def compile_custom_block(block, arguments):
+    """Custom block definitions are found the first time the block runs,
+    as they are defined after they are used in the XML"""
+    evaluate_args = compile_arguments(arguments)
+    bind = block.bind_custom_function
+    function_name = block.function_name
+
+    def evaluate(target, parent_script):
+        args = evaluate_args(target, parent_script)
+        function = bind(target)
+        if function is None:
+            print "Unknown function: %s" % function_name
+            result = data.Literal(None)
+        else:
+            result = function(target, parent_script, args)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, args, result)
+        return result
+    return evaluate
+
+
+def compile_unknown_block(block, arguments):
+    """Matches Block.evaluate's handling of an unknown function"""
+    evaluate_args = compile_arguments(arguments)
+    function_name = block.function_name
+
+    def evaluate(target, parent_script):
+        args = evaluate_args(target, parent_script)
+        print "Unknown function: %s" % function_name
+        result = data.Literal(None)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, args, result)
+        return result
+    return evaluate
+
+
+def calls_custom_blocks(item):
+    """Does evaluating this item run a custom block?  (Scripts nested in
+    it, like the inside of a loop, don't count; they are compiled, and
+    run, separately.)"""
+    return is_block(item) and (
+        item.type is script.BlockType.custom or
+        any(calls_custom_blocks(arg) for arg in item.arguments))
+
+
+def compile_argument_steps(item):
+    """Returns (is_steps, evaluate) for an argument.
+    If is_steps, evaluate returns a generator to wait on for the value."""
+    if calls_custom_blocks(item):
+        return True, compile_steps(item)
+    return False, compile_argument(item)
+
+
+def compile_steps(block, statement=False):
+    """Returns a generator function that evaluates a block which calls
+    custom blocks.
+
+    Rather than evaluate an argument that calls a custom block, or run a
+    custom block, the generator yields a generator that does so, and is
+    sent back the result (see Script.run).  Its own result is the block's
+    value, which it passes to the StopIteration that ends it.
+
+    A statement (a block in a script) has no value; it moves the script
+    on to its next block when it is done.  If it reports a value (with
+    'report'), that value is its result, and the script is done."""
+    arguments = [arg for arg in block.arguments
+                 if not isinstance(arg, data.Comment)]
+    evaluators = [compile_argument_steps(arg) for arg in arguments]
+    is_custom = block.type is script.BlockType.custom
+    bind = block.bind_custom_definition
+    function = block.function
+    function_name = block.function_name
+
+    def steps(target, parent_script):
+        args = []
+        for is_steps, evaluate in evaluators:
+            value = evaluate(target, parent_script)
+            if is_steps:
+                value = yield value
+            args.append(value)
+
+        if is_custom:
+            definition = bind(target)
+            if definition is None:
+                print "Unknown function: %s" % function_name
+                result = data.Literal(None)
+            else:
+                result = yield definition.start(target, parent_script, args)
+                if result is None:
+                    # it didn't report anything
+                    result = data.Literal(None)
+        elif function is not None:
+            result = function(target, parent_script, args)
+        else:
+            print "Unknown function: %s" % function_name
+            result = data.Literal(None)
+        if tracing.recorder is not None:
+            tracing.recorder.record(block, target, args, result)
+
+        if statement:
+            parent_script.next_block()
+            result = None
+        raise StopIteration(result)
+    return steps
+
+
+def is_tail_call(block):
+    """Is this 'report (some custom block)'?"""
+    arguments = [arg for arg in block.arguments
+                 if not isinstance(arg, data.Comment)]
+    return block.type is script.BlockType.regular and \
+        block.function_name == "doReport" and len(arguments) == 1 and \
+        is_block(arguments[0]) and \
+        arguments[0].type is script.BlockType.custom
+
+
+def compile_tail_call(block):
+    """Compiles 'report (some custom block)' so that the custom block
+    runs in place of the script reporting, rather than on top of it"""
+    call, = [arg for arg in block.arguments
+             if not isinstance(arg, data.Comment)]
+    evaluators = [compile_argument_steps(arg) for arg in call.arguments
+                  if not isinstance(arg, data.Comment)]
+    bind = call.bind_custom_definition
+    function_name = call.function_name
+
+    # The trace shows what each block returned, which a tail call never
+    # finds out; so when tracing, we make an ordinary call instead
+    report = compile_steps(block, statement=True)
+
+    def steps(target, parent_script):
+        if tracing.recorder is not None:
+            reported = yield report(target, parent_script)
+            raise StopIteration(reported)
+
+        args = []
+        for is_steps, evaluate in evaluators:
+            value = evaluate(target, parent_script)
+            if is_steps:
+                value = yield value
+            args.append(value)
+
+        definition = bind(target)
+        if definition is None:
+            print "Unknown function: %s" % function_name
+            raise StopIteration(data.Literal(None))
+        # it sees the same variables as an ordinary call would
+        raise StopIteration(script.TailCall(definition, args, parent_script))
+    return steps
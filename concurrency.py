@@ -0,0 +1,202 @@
+"""concurrency.py is where scripts, wait blocks, and the web server get
+their concurrency from, so the rest of Enchanting 2 need not care how it
+is done.  There are two backends:
+
+ - "gevent" (the default, if it is installed): scripts are greenlets.
+   Switching between them is cheap, and they only switch when they sleep,
+   so a script never sees another's block half done.
+ - "threads": scripts are threads, from the standard library, so
+   Enchanting 2 runs where gevent can't be built, or inside a program
+   with an event loop of its own (run EventLoop.run_forever on a thread).
+   Switching costs more, and a script can be interrupted in the middle of
+   a block.  The web server has a thread of its own, which serves the
+   websocket too if gevent-websocket is installed (with a gevent hub of
+   its own, to which the other threads hand their messages for web
+   clients, see server.Outbox); otherwise it only serves the web page.
+   Stopped scripts can't be killed, so they finish their current block.
+
+Pick one with use() (or enchanting2.py --concurrency) before anything
+starts running, and call what it provides through this module (as in
+concurrency.sleep(1)), as it changes with the backend:
+
+    spawn(function, *args)   starts a task
+    sleep(seconds)           lets the other tasks run
+    Group()                  a set of tasks, to join() or kill()
+    Lock()                   a lock, for use with 'with'
+    Event()                  wait(timeout) until someone calls set()
+    Wakeup()                 tasks wait() on it until someone calls
+                             set(), which wakes them all at once
+    run_in_thread(function, *args)
+                             calls a function on a thread, without
+                             holding up the other tasks
+    serve_web(port)          starts the web server
+
+benchmarks/switching.py compares the backends.
+"""
+
+import threading
+import time
+
+# The name of the backend in use
+backend = None
+
+spawn = None
+sleep = None
+Group = None
+Lock = None
+Event = None
+Wakeup = None
+run_in_thread = None
+serve_web = None
+
+
+def use_gevent():
+    import gevent
+    import gevent.event
+    import gevent.pool
+    try:
+        from gevent.lock import BoundedSemaphore
+    except ImportError:
+        print "Enchanting2 requires gevent v1.0 or newer"
+        raise
+
+    class GreenletWakeup(object):
+
+        """Like gevent.event.Event, but lighter: the waiting greenlets
+        simply switch to the hub, and set() has the hub switch back to
+        each of them, so waking a crowd costs a callback each"""
+
+        __slots__ = ("waiting", "done")
+
+        def __init__(self):
+            self.waiting = []
+            self.done = False
+
+        def wait(self):
+            if not self.done:
+                current = gevent.getcurrent()
+                self.waiting.append(current)
+                try:
+                    gevent.get_hub().switch()
+                except BaseException:
+                    # killed while waiting; don't wake it up later on
+                    if current in self.waiting:
+                        self.waiting.remove(current)
+                    raise
+
+        def set(self):
+            self.done = True
+            run_callback = gevent.get_hub().loop.run_callback
+            for greenlet in self.waiting:
+                if not greenlet.dead:  # it may have been killed
+                    run_callback(greenlet.switch)
+            self.waiting = []
+
+        def is_set(self):
+            return self.done
+
+    def gevent_run_in_thread(function, *args):
+        return gevent.get_hub().threadpool.apply(function, args)
+
+    def serve_web_with_gevent(port):
+        import server
+        return gevent.spawn(server.run_web_servers, port)
+
+    return {
+        "spawn": gevent.spawn,
+        "sleep": gevent.sleep,
+        "Group": gevent.pool.Group,
+        "Lock": lambda: BoundedSemaphore(1),
+        "Event": gevent.event.Event,
+        "Wakeup": GreenletWakeup,
+        "run_in_thread": gevent_run_in_thread,
+        "serve_web": serve_web_with_gevent,
+    }
+
+
+class ThreadGroup(object):
+
+    """Keeps track of threads, as gevent.pool.Group does greenlets"""
+
+    def __init__(self):
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def add(self, thread):
+        with self.lock:
+            self.threads = set(t for t in self.threads if t.is_alive())
+            self.threads.add(thread)
+
+    def join(self, timeout=None):
+        """Waits for the threads to finish, or for the timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                running = [t for t in self.threads if t.is_alive()]
+            if not running:
+                return True
+            if deadline is None:
+                running[0].join()
+            else:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                running[0].join(left)
+
+    def kill(self):
+        """Forgets the threads.  (Threads can't be killed, but the
+        scripts running on them have been stopped, so they will finish
+        at their next block.)"""
+        with self.lock:
+            self.threads = set()
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for t in self.threads if t.is_alive())
+
+
+def spawn_thread(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True  # don't keep us from quitting
+    thread.start()
+    return thread
+
+
+def serve_web_on_thread(port):
+    import server
+    return spawn_thread(server.run_web_servers_on_thread, port)
+
+
+def use_threads():
+    return {
+        "spawn": spawn_thread,
+        "sleep": time.sleep,
+        "Group": ThreadGroup,
+        "Lock": threading.Lock,
+        "Event": threading.Event,
+        "Wakeup": threading.Event,
+        "run_in_thread": lambda function, *args: function(*args),
+        "serve_web": serve_web_on_thread,
+    }
+
+backends = {
+    "gevent": use_gevent,
+    "threads": use_threads,
+}
+
+
+def use(name):
+    """Switches to a backend ("gevent" or "threads")"""
+    global backend
+    globals().update(backends[name]())
+    backend = name
+
+
+def use_default():
+    """Uses gevent if it is installed, and threads if not"""
+    try:
+        use("gevent")
+    except ImportError:
+        use("threads")
+
+use_default()
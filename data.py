@@ -56,19 +56,33 @@ class Literal(object):
     # (it'll need to keep track of changes in time differently,
     # for example).  Also note sure about functions, etc.
 
+    # There are a great many literals; keep them small
+    __slots__ = ("value", "number", "is_option")
+
     def __init__(self, value=None):
         self.set_value(value)
         self.is_option = False  # Is this an option selected from a combo box?
 
     def set_value(self, value):
-        """In order of priority, value is a boolean, number, or string"""
-        if isinstance(value, bool):
+        """In order of priority, value is a boolean, number, or string.
+
+        The value as a number (or None, if it isn't one) is worked out
+        here, once, rather than every time the literal is used."""
+        value_type = type(value)
+        if value_type is float:
+            # The result of an operation; by far the most common case
+            self.value = self.number = value
+        elif value_type is bool:
             self.value = value
+            self.number = float(value)
+        elif value is None:
+            self.value = self.number = None
         else:
             try:
-                self.value = float(value)
+                self.value = self.number = float(value)
             except:
                 self.value = value
+                self.number = None
 
     def deserialize(self, elem):
         """Load from an xml element tree"""
@@ -104,28 +118,25 @@ class Literal(object):
 
     def __eq__(self, other):
         # Do both sides evaluate to numbers?
-        try:
-            return float(self.value) == float(other.value)
-        except:
-            pass
+        other_number = getattr(other, "number", None)
+        if self.number is not None and other_number is not None:
+            return self.number == other_number
         # Return result of case-insensitive string comparison
         return self.as_string().upper() == other.as_string().upper()
 
     def __gt__(self, other):
         # Do both sides evaluate to numbers?
-        try:
-            return float(self.value) > float(other.value)
-        except:
-            pass
+        other_number = getattr(other, "number", None)
+        if self.number is not None and other_number is not None:
+            return self.number > other_number
         # Return result of case-insensitive string comparison
         return self.as_string().upper() > other.as_string().upper()
 
     def __lt__(self, other):
         # Do both sides evaluate to numbers?
-        try:
-            return float(self.value) < float(other.value)
-        except:
-            pass
+        other_number = getattr(other, "number", None)
+        if self.number is not None and other_number is not None:
+            return self.number < other_number
         # Return result of case-insensitive string comparison
         return self.as_string().upper() < other.as_string().upper()
 
@@ -141,17 +152,15 @@ class Literal(object):
 
     # expose as different types
     def as_number(self):
-        try:
-            return float(self.value)
-        except:
-            return 0
+        if self.number is not None:
+            return self.number
+        return 0
 
     def as_number_if_number(self):
         """Returns a number if a number; None otherwise"""
-        try:
-            return float(self.value)
-        except:
-            return 0
+        if self.number is not None:
+            return self.number
+        return 0
 
     def as_string(self):
         if self.value is None:
@@ -347,6 +356,8 @@ class Variable(object):
     """Represents a value that changes over time.
     Contains something like a Literal, Bool, or List"""
 
+    __slots__ = ("name", "contents")
+
     def __init__(self, name="No name", contents=None):
         self.contents = contents
         self.name = name
@@ -383,6 +394,10 @@ class Variable(object):
         """Sets a variable.  Pass in a Literal or other object as a value"""
         self.contents = value
 
+    def change_by(self, increment):
+        """Adds a number to the variable (as 'change by' does)"""
+        self.contents = Literal(self.value().as_number() + increment)
+
     # to do -- record if there has been a change
 
     def value(self):
@@ -408,8 +423,13 @@ class Variables(object):
         else:
             self.variables = input
 
+        # Goes up whenever a variable is added or replaced, so that code
+        # that remembers where it found a variable knows to look again
+        self.version = 0
+
     def add(self, v):
         self.variables[v.name] = v
+        self.version += 1
 
     def deserialize(self, elem):
         """Loads this class from an element tree representation"""
@@ -420,6 +440,7 @@ class Variables(object):
         for var_name in self.variables.keys():
             if not var_name.startswith("@"):
                 del self.variables[var_name]
+        self.version += 1
 
         # Read in all the variables
         for child_node in elem:
@@ -0,0 +1,442 @@
+"""delta.py applies small edits ("deltas") to a running project.
+
+Rather than sending the whole project back and forth whenever a user
+changes something, a client sends a delta describing just the change:
+
+    project_delta <delta> ...one or more edits... </delta>
+
+Blocks are identified by the uuid each of them carries.  The edits are:
+
+    <insert-block after="uuid">BLOCK</insert-block>
+    <insert-block before="uuid">BLOCK</insert-block>
+    <insert-block parent="uuid" slot="1">BLOCK</insert-block>
+        Adds a block after or before a known block in the same script,
+        or to the top of the script in a C-slot (like the body of
+        a 'repeat' block).  New blocks must carry their own uuids.
+
+    <insert-script sprite="name" x="10" y="20">SCRIPT</insert-script>
+        Adds a new script to a sprite (or the stage, if no sprite is given)
+
+    <delete-block block="uuid"/>
+        Removes a block.  A reporter is replaced by an empty slot.
+
+    <move-block block="uuid" after="uuid"/>
+        Moves a block; it takes the same positions as insert-block,
+        or sprite, x, and y, to make it a script of its own.
+
+    <set-argument block="uuid" index="0">VALUE</set-argument>
+        Replaces one of a block's arguments with a literal, block, etc.
+
+    <set-property sprite="name" name="@x">VALUE</set-property>
+        Changes a sprite property (@x, @y, @heading, @scale, costume, name)
+
+    <set-variable sprite="name" name="score">VALUE</set-variable>
+        Changes (or creates) a sprite variable, or a global variable
+        if no sprite is given.
+
+    <set-definition sprite="name">BLOCK-DEFINITION</set-definition>
+        Adds a custom block definition to a sprite (or to the project,
+        if no sprite is given), replacing any with the same name.
+
+    <delete-definition sprite="name" s="sum of %'a' and %'b'"/>
+        Removes the custom block definition with that specification.
+
+Edits are applied in place, so running scripts keep running.
+"""
+
+import xml.etree.cElementTree as ElementTree
+
+import data
+import factory
+import script
+
+
+class DeltaError(Exception):
+
+    """The delta could not be applied to the project"""
+    pass
+
+
+# What applying a delta that doesn't fit the project can raise
+errors = (DeltaError, AssertionError, SyntaxError, KeyError, IndexError,
+          ValueError, TypeError, AttributeError)
+
+
+class BlockLocation(object):
+
+    """Where a block is in the project"""
+
+    def __init__(self, block, container, top_script, actor):
+        self.block = block
+        self.container = container  # Script or Block that holds the block
+        self.top_script = top_script  # used to recompile the code
+        self.actor = actor  # None if the block is in a block definition
+
+    def in_script(self):
+        """Is the block a command in a script (not an argument)?"""
+        return isinstance(self.container, script.Script)
+
+
+class BlockIndex(object):
+
+    """Finds blocks in a project by their uuid"""
+
+    def __init__(self, project):
+        self.locations = {}  # str(uuid) -> BlockLocation
+        for actor in project.all_actors():
+            for top_script in actor.scripts:
+                self.add_script(top_script, top_script, actor)
+            self.add_definitions(actor.blocks)
+        self.add_definitions(project.blocks)
+
+    def add_definitions(self, blocks):
+        if blocks is not None:
+            for definition in blocks.definitions:
+                self.add_script(definition.script, definition.script, None)
+
+    def add_script(self, code, top_script, actor):
+        for block in code.blocks:
+            self.add_block(block, code, top_script, actor)
+
+    def add_block(self, block, container, top_script, actor):
+        """Indexes a block, and any blocks or scripts inside it"""
+        self.locations[str(block.uuid)] = BlockLocation(
+            block, container, top_script, actor)
+        for arg in block.arguments:
+            if isinstance(arg, script.Block):
+                self.add_block(arg, block, top_script, actor)
+            elif isinstance(arg, script.Script):
+                self.add_script(arg, top_script, actor)
+
+    def forget_block(self, block):
+        """Removes a block, and anything inside it, from the index"""
+        for uuid_string in uuids_in(block):
+            self.locations.pop(uuid_string, None)
+
+    def find(self, uuid_string):
+        location = self.locations.get(uuid_string)
+        if location is None:
+            raise DeltaError("No block has uuid %s" % uuid_string)
+        return location
+
+
+class Changes(object):
+
+    """What a delta did, so the event loop can catch up"""
+
+    def __init__(self):
+        self.edited_scripts = set()  # (script, actor) -- may need re-queuing
+        self.added_scripts = []  # (script, actor)
+        self.removed_scripts = []  # (script, actor)
+        self.recompile = set()  # top-level scripts to recompile
+
+    def edited(self, location):
+        self.recompile.add(location.top_script)
+        if location.actor is not None:
+            self.edited_scripts.add((location.top_script, location.actor))
+
+
+class DeltaApplier(object):
+
+    """Applies the edits in a delta to a project"""
+
+    def __init__(self, project):
+        self.project = project
+        self.index = BlockIndex(project) if project is not None else None
+        self.changes = Changes()
+        self.applied = 0  # how many edits have been made
+
+    def apply(self, delta_node):
+        assert (delta_node.tag == "delta")
+        if self.project is None:
+            raise DeltaError("No project is loaded")
+        try:
+            for edit in delta_node:
+                handler = self.handlers.get(edit.tag)
+                if handler is None:
+                    raise DeltaError("Unknown edit: %s" % edit.tag)
+                handler(self, edit)
+                self.applied += 1
+        finally:
+            # Even if an edit failed, the ones before it have been made
+            for top_script in self.changes.recompile:
+                recompile(top_script)
+        return self.changes
+
+    # Finding things
+
+    def actor_named(self, name):
+        """Returns the named sprite, or the stage if name is None"""
+        stage = self.project.stage
+        if name is None or name == stage.name:
+            return stage
+        for sprite in self.project.all_actors()[1:]:
+            if sprite.name == name:
+                return sprite
+        raise DeltaError("No sprite is named %s" % name)
+
+    def attribute(self, edit, name):
+        """Returns an attribute that the edit can't do without"""
+        value = edit.get(name)
+        if value is None:
+            raise DeltaError("%s needs a '%s' attribute" % (edit.tag, name))
+        return value
+
+    def whole_number(self, edit, name, default=None):
+        """Returns an attribute that is a whole number"""
+        if default is None:
+            text = self.attribute(edit, name)
+        else:
+            text = edit.get(name, default)
+        try:
+            return int(text)
+        except ValueError:
+            raise DeltaError("%s's '%s' should be a whole number, not %r"
+                             % (edit.tag, name, text))
+
+    def value_of(self, edit):
+        """Returns the value (literal, block, etc) held in the edit"""
+        if len(edit) != 1:
+            raise DeltaError("%s needs exactly one value" % edit.tag)
+        return factory.deserialize_value(edit[0])
+
+    # Moving blocks around
+
+    def destination(self, edit):
+        """Returns (code, position, neighbour) for where the edit's
+        attributes say a block goes, or None if it becomes a script of
+        its own.  Changes nothing, so it can check an edit beforehand."""
+        for attribute, offset in (("after", 1), ("before", 0)):
+            if edit.get(attribute) is not None:
+                location = self.index.find(edit.get(attribute))
+                if not location.in_script():
+                    raise DeltaError("Blocks only go before or after "
+                                     "commands in scripts")
+                blocks = location.container.blocks
+                position = blocks.index(location.block) + offset
+                return location.container, position, location
+
+        if edit.get("parent") is not None:
+            location = self.index.find(edit.get("parent"))
+            slot = self.whole_number(edit, "slot", "0")
+            if not 0 <= slot < len(location.block.arguments):
+                raise DeltaError("%s has no slot %d" % (
+                    location.block.function_name, slot))
+            target = location.block.arguments[slot]
+            if not isinstance(target, script.Script):
+                raise DeltaError("Slot %d does not hold a script" % slot)
+            return target, 0, location
+
+        if edit.get("sprite") is not None:
+            self.actor_named(edit.get("sprite"))  # it must exist
+        return None
+
+    def place_block(self, block, edit, actor=None):
+        """Puts a block where the edit's attributes say it goes.
+        A block that becomes a script of its own goes to the named sprite,
+        or else to the given actor (or else the stage)"""
+        destination = self.destination(edit)
+        if destination is not None:
+            self.put_block(block, *destination)
+            return
+
+        # It becomes a new script of its own
+        new_script = script.Script()
+        new_script.x, new_script.y = edit.get("x"), edit.get("y")
+        new_script.blocks = [block]
+        if edit.get("sprite") is not None or actor is None:
+            actor = self.actor_named(edit.get("sprite"))
+        self.add_script(new_script, actor)
+
+    def put_block(self, block, code, position, neighbour):
+        code.blocks.insert(position, block)
+        self.index.add_block(block, code, neighbour.top_script,
+                             neighbour.actor)
+        self.changes.edited(neighbour)
+
+    def take_block(self, location):
+        """Removes a block from where it is"""
+        self.changes.edited(location)
+        if location.in_script():
+            location.container.blocks.remove(location.block)
+            top_script = location.top_script
+            if location.actor and not top_script.blocks and \
+                    top_script in location.actor.scripts:
+                # the script is gone entirely
+                location.actor.scripts.remove(top_script)
+                self.changes.removed_scripts.append(
+                    (top_script, location.actor))
+        else:
+            # An argument leaves behind an empty slot
+            arguments = location.container.arguments
+            arguments[arguments.index(location.block)] = data.Literal()
+
+    def add_script(self, new_script, actor):
+        actor.scripts.append(new_script)
+        self.index.add_script(new_script, new_script, actor)
+        self.changes.recompile.add(new_script)
+        self.changes.added_scripts.append((new_script, actor))
+
+    # The edits themselves
+
+    def insert_block(self, edit):
+        block = self.value_of(edit)
+        if not isinstance(block, script.Block):
+            raise DeltaError("Only blocks can be inserted")
+        self.place_block(block, edit)
+
+    def insert_script(self, edit):
+        new_script = self.value_of(edit)
+        if edit.get("x") is not None:
+            new_script.x, new_script.y = edit.get("x"), edit.get("y")
+        self.add_script(new_script, self.actor_named(edit.get("sprite")))
+
+    def delete_block(self, edit):
+        location = self.index.find(self.attribute(edit, "block"))
+        self.take_block(location)
+        self.index.forget_block(location.block)
+
+    def move_block(self, edit):
+        location = self.index.find(self.attribute(edit, "block"))
+        # Check where it goes before taking it, so a bad move loses nothing
+        destination = self.destination(edit)
+        if destination is not None:
+            neighbour = destination[2]
+            beside = edit.get("after") or edit.get("before")
+            if neighbour is location and beside is not None:
+                return  # before or after itself, it stays where it is
+            if str(neighbour.block.uuid) in set(uuids_in(location.block)):
+                raise DeltaError("A block can't be moved into itself")
+        self.take_block(location)
+        self.index.forget_block(location.block)
+        self.place_block(location.block, edit, location.actor)
+
+    def set_argument(self, edit):
+        location = self.index.find(self.attribute(edit, "block"))
+        block = location.block
+        index = self.whole_number(edit, "index")
+        if not 0 <= index < len(block.arguments):
+            raise DeltaError("%s has no argument %d" % (
+                block.function_name, index))
+        new_value = self.value_of(edit)
+        old_value = block.arguments[index]
+        if isinstance(old_value, script.Block):
+            self.index.forget_block(old_value)
+        elif isinstance(old_value, script.Script):
+            for nested in old_value.blocks:
+                self.index.forget_block(nested)
+
+        block.arguments[index] = new_value
+        if isinstance(new_value, script.Block):
+            self.index.add_block(new_value, block, location.top_script,
+                                 location.actor)
+        elif isinstance(new_value, script.Script):
+            self.index.add_script(new_value, location.top_script,
+                                  location.actor)
+        self.changes.edited(location)
+
+    def set_property(self, edit):
+        actor = self.actor_named(edit.get("sprite"))
+        name = self.attribute(edit, "name")
+        value = self.value_of(edit)
+        if name.startswith("@"):
+            actor.set_property(name, value)
+        elif name == "costume":
+            actor.costume = int(value.as_number())
+        elif name == "name":
+            actor.name = value.as_string()
+        else:
+            raise DeltaError("Unknown property: %s" % name)
+
+    def set_variable(self, edit):
+        if edit.get("sprite") is None:
+            variables = self.project.variables
+        else:
+            variables = self.actor_named(edit.get("sprite")).variables
+        name = self.attribute(edit, "name")
+        value = self.value_of(edit)
+        variable = variables.get_variable(name)
+        if variable is None:
+            variables.add(data.Variable(name, value))
+        else:
+            variable.set(value)
+
+    def blocks_of(self, edit, create=False):
+        """Returns the block definitions of the named sprite,
+        or the project's, if no sprite is named"""
+        if edit.get("sprite") is None:
+            owner = self.project
+        else:
+            owner = self.actor_named(edit.get("sprite"))
+        if owner.blocks is None and create:
+            owner.blocks = script.Blocks()
+        return owner.blocks
+
+    def forget_definition(self, definition):
+        for block in definition.script.blocks:
+            self.index.forget_block(block)
+
+    def set_definition(self, edit):
+        definition = self.value_of(edit)
+        if not isinstance(definition, script.BlockDefinition):
+            raise DeltaError("Only block definitions can be set")
+        old = self.blocks_of(edit, create=True).add(definition)
+        if old is not None:
+            self.forget_definition(old)
+        self.index.add_script(definition.script, definition.script, None)
+
+    def delete_definition(self, edit):
+        blocks = self.blocks_of(edit)
+        specification = self.attribute(edit, "s")
+        for definition in (blocks.definitions if blocks else []):
+            if definition.specification == specification:
+                blocks.remove(definition)
+                self.forget_definition(definition)
+                return
+        raise DeltaError("No block definition is %s" % specification)
+
+    handlers = {
+        "insert-block": insert_block,
+        "insert-script": insert_script,
+        "delete-block": delete_block,
+        "move-block": move_block,
+        "set-argument": set_argument,
+        "set-property": set_property,
+        "set-variable": set_variable,
+        "set-definition": set_definition,
+        "delete-definition": delete_definition,
+    }
+
+
+def uuids_in(block):
+    """Yields the uuids of a block, and of all the blocks inside it"""
+    yield str(block.uuid)
+    for arg in block.arguments:
+        if isinstance(arg, script.Block):
+            for uuid_string in uuids_in(arg):
+                yield uuid_string
+        elif isinstance(arg, script.Script):
+            for nested in arg.blocks:
+                for uuid_string in uuids_in(nested):
+                    yield uuid_string
+
+
+def recompile(top_script):
+    """Recompiles a script and all of the scripts nested inside it"""
+    top_script.compile()
+    for block in top_script.blocks:
+        recompile_arguments(block)
+
+
+def recompile_arguments(block):
+    for arg in block.arguments:
+        if isinstance(arg, script.Script):
+            recompile(arg)
+        elif isinstance(arg, script.Block):
+            recompile_arguments(arg)
+
+
+def apply_delta(project, xml):
+    """Applies the delta in the xml to the project; returns the Changes.
+    Raises DeltaError if the delta doesn't fit the project."""
+    return DeltaApplier(project).apply(ElementTree.XML(xml))
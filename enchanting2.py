@@ -3,23 +3,114 @@
 This is the main entry point of the system"""
 
 import sys
+import argparse
 
-import gevent
-
+import concurrency
 import event_loop
 import media
 import server
+import script
+import tracing
+import profiling
+
+
+# How many trace records to keep in memory, if not told otherwise
+default_trace_buffer = 10000
+
+
+def positive_number(text):
+    """An argparse type for rates and intervals, which must be above 0"""
+    try:
+        number = float(text)
+    except ValueError:
+        number = None
+    if not number or not 0 < number < float("inf"):
+        raise argparse.ArgumentTypeError(
+            "%r is not a positive number" % text)
+    return number
+
+
+def parse_arguments(argv):
+    """Reads the command line options"""
+    parser = argparse.ArgumentParser(description="Runs Snap! projects")
+    parser.add_argument("project", nargs="?",
+                        help="a Snap! project file to load and run")
+    parser.add_argument("--pacing", choices=script.Pacing.name_list,
+                        default=script.Pacing.name_list[script.pacing],
+                        help="'fixed' sleeps after every block, as older "
+                             "versions did; 'budgeted' runs scripts as "
+                             "fast as it can while sharing time fairly")
+    parser.add_argument("--fps", type=positive_number,
+                        default=event_loop.frames_per_second,
+                        help="how many times a second to draw the stage "
+                             "(and check for key presses), at most")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="run the sprites' scripts on N processes, "
+                             "to make use of more than one core "
+                             "(this needs gevent)")
+    parser.add_argument("--concurrency", choices=sorted(concurrency.backends),
+                        default=concurrency.backend,
+                        help="run scripts as gevent greenlets, or as "
+                             "threads (which don't need gevent)")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a display (or without pygame)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record every block that runs to FILE; "
+                             "read it with trace_reader.py")
+    parser.add_argument("--trace-buffer", type=int, metavar="N",
+                        help="keep the last N blocks that ran in memory "
+                             "(the default is %d when tracing to a file)"
+                             % default_trace_buffer)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="find out which blocks and sprites take up "
+                             "the time, and write it to FILE as collapsed "
+                             "stacks (for flamegraph.pl) on the way out")
+    parser.add_argument("--profile-interval", type=positive_number,
+                        metavar="MS",
+                        default=profiling.default_interval * 1000,
+                        help="milliseconds of CPU time between samples")
+    return parser.parse_args(argv[1:])
 
 
 def main(argv):
     """Load the project and start it running"""
 
-    media_environment = media.PyGameMediaEnvironment()
+    options = parse_arguments(argv)
+    if options.workers > 0 and options.concurrency != "gevent":
+        sys.exit("--workers needs gevent")
+    if options.profile and options.concurrency != "gevent":
+        sys.exit("--profile needs gevent")
+    concurrency.use(options.concurrency)
+    script.pacing = script.Pacing.pacing_from_name(options.pacing)
+    event_loop.frames_per_second = options.fps
+
+    if options.headless:
+        media_environment = media.HeadlessMediaEnvironment()
+    else:
+        media_environment = media.PyGameMediaEnvironment()
+    if options.trace or options.trace_buffer:
+        tracing.start(options.trace_buffer or default_trace_buffer,
+                      options.trace)
+
     loop = event_loop.EventLoop(media_environment)
-    if len(argv) >= 2:
-        loop.load_project_from_disk(argv[1])
+    if options.workers > 0:
+        import workers  # (only now, as it needs gevent)
+        loop.workers = workers.WorkerPool(options.workers)
+    if options.profile:
+        loop.start_profiling(options.profile_interval)
+    if options.project:
+        loop.load_project_from_disk(options.project)
         loop.trigger_green_flag()
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        if loop.workers is not None:
+            loop.workers.stop()
+        tracing.stop()  # flush the trace log
+        profile = profiling.stop()
+        if profile and options.profile:
+            with open(options.profile, "w") as f:
+                f.write(profile.collapsed() + "\n")
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,78 +1,249 @@
 """The event loop triggers and runs all the scripts, as appropriate"""
 
-import gevent
-import gevent.pool
-
-try:
-    from gevent.lock import BoundedSemaphore
-except:
-    print "Enchanting2 requires gevent v1.0 or newer"
-    raise
-
+import xml.etree.cElementTree as ElementTree
+from collections import deque
+import json
+import math
+import time
+
+import concurrency
+import data
+import delta
 import factory
 import server
 import script
+import timers
+import tracing
+import profiling
 
 port = 8000
 
+# Should projects sent by clients be loaded on a worker thread?
+# (If not, nothing else happens until the project has loaded.)
+background_loading = True
+
+# How often the screen is drawn (and events are checked for), at most
+frames_per_second = 30
+
+
+def build_project(parse, source):
+    """Builds a project that isn't attached to an event loop yet, and
+    decodes the costumes it will show first.  This can run on a worker
+    thread, as nothing else can see the project until it is done."""
+    project = parse(source, None)
+    for actor in project.all_actors():
+        if actor.costumes:
+            actor.costumes.preload(actor.costume)
+    return project
+
+
+def hat_trigger(top_block):
+    """Returns the key or message a hat block is waiting for,
+    or None if it just waits to be activated (like the green flag)"""
+    if top_block.function_name in ("receiveKey", "receiveMessage"):
+        for arg in top_block.arguments:
+            if not isinstance(arg, data.Comment):
+                return arg.as_string()
+    return None
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value that 'fraction' of the values are at or below"""
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(fraction * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class FramePacer(object):
+
+    """Keeps frames coming at a steady rate.
+
+    Call wait() at the end of each frame.  It sleeps (which lets the
+    scripts run) until the next frame is due -- so a frame that took 10 ms
+    to draw is followed by a 23 ms sleep at 30 fps, not a 33 ms one.
+
+    A frame that runs past the start of the next one is 'late', and we
+    start the next frame right away.  If it ran past more than one, the
+    frames it ran over are dropped rather than drawn back to back to catch
+    up, and the frames after it are timed from now.
+
+    stats() describes the last 'window' frames."""
+
+    def __init__(self, fps=None, window=300,
+                 clock=time.time, sleep=None):
+        if fps is None:
+            fps = frames_per_second
+        if not fps > 0:
+            raise ValueError("fps must be above 0, not %r" % fps)
+        self.period = 1.0 / fps
+        self.clock = clock
+        self.sleep = sleep or concurrency.sleep
+        self.frame_times = deque(maxlen=window)  # start to start, in s
+        self.work_times = deque(maxlen=window)  # start to wait(), in s
+        self.frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.frame_start = None  # when this frame started
+        self.deadline = None  # when the next frame is due
+
+    def wait(self):
+        """Call once each frame is done; returns when the next is due"""
+        now = self.clock()
+        if self.frame_start is None:
+            self.frame_start = self.deadline = now  # the first frame
+        self.frames += 1
+        self.work_times.append(now - self.frame_start)
+        self.deadline += self.period
+        if now > self.deadline:
+            self.late_frames += 1
+            self.dropped_frames += int((now - self.deadline) / self.period)
+            self.deadline = now
+            self.sleep(0)  # the scripts still get a turn
+        else:
+            self.sleep(self.deadline - now)
+        start = self.clock()
+        self.frame_times.append(start - self.frame_start)
+        self.frame_start = start
+
+    def stats(self):
+        """Returns frame times (in ms) and counts, as a dict"""
+        times = sorted(self.frame_times)
+        mean = sum(times) / len(times) if times else 0.0
+        work = self.work_times
+        return {
+            "target_fps": 1.0 / self.period,
+            "fps": 1.0 / mean if mean else 0.0,
+            "mean_ms": mean * 1000,
+            "p95_ms": percentile(times, 0.95) * 1000,
+            "max_ms": times[-1] * 1000 if times else 0.0,
+            "work_ms": sum(work) / len(work) * 1000 if work else 0.0,
+            "frames": self.frames,
+            "late_frames": self.late_frames,
+            "dropped_frames": self.dropped_frames,
+        }
+
+    def summary(self):
+        return ("%(frames)d frames at %(fps).1f fps (target %(target_fps)g);"
+                " mean %(mean_ms).1f ms, p95 %(p95_ms).1f ms;"
+                " %(late_frames)d late, %(dropped_frames)d dropped"
+                % self.stats())
+
+
+class SleepingScripts(object):
+
+    """Scripts waiting for their hat block to be triggered.
+
+    They are indexed by the hat block's function name and then by the
+    key or message it is waiting for, so that when (say) a message is
+    broadcast, we only look at the scripts that are waiting for it."""
+
+    def __init__(self):
+        self.index = {}  # function name -> {trigger -> [(script, sprite)]}
+        self.keys = {}  # script -> (function name, trigger) it is under
+
+    def add(self, script, sprite):
+        top_block = script.top_block()
+        if top_block:
+            function_name = top_block.function_name
+            trigger = hat_trigger(top_block)
+        else:
+            function_name, trigger = None, None
+        triggers = self.index.setdefault(function_name, {})
+        triggers.setdefault(trigger, []).append((script, sprite))
+        self.keys[script] = (function_name, trigger)
+
+    def remove(self, script):
+        """Removes a script; returns True if it was sleeping"""
+        key = self.keys.pop(script, None)
+        if key is None:
+            return False
+        function_name, trigger = key
+        waiting = self.index[function_name][trigger]
+        waiting[:] = [item for item in waiting if item[0] is not script]
+        return True
 
-def is_trigger_key(top_block, media_and_event):
-    """True if user pressed key hat block is waiting for."""
-    key_name = top_block.arguments[0].as_string()
-    media_env, event = media_and_event
-    return media_env.does_key_event_match(key_name, event)
+    def take(self, function_name, trigger=None):
+        """Removes and returns the scripts waiting for this trigger"""
+        triggers = self.index.get(function_name)
+        if triggers is None:
+            return []
+        taken = triggers.pop(trigger, [])
+        for script, sprite in taken:
+            del self.keys[script]
+        return taken
 
+    def triggers(self, function_name):
+        """Returns the keys or messages scripts are waiting for"""
+        return self.index.get(function_name, {}).keys()
 
-def does_match_broadcast(top_block, message_string):
-    message_to_start_script = top_block.arguments[0].as_string()
-    if message_to_start_script == "any message":
-        return True
-    else:
-        return message_string == message_to_start_script
+    def clear(self):
+        self.index = {}
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
 
 
 class EventLoop(object):
 
     def __init__(self, media_environment):
-        self.active_scripts = gevent.pool.Group()
-        self.sleeping_scripts = []
+        self.active_scripts = concurrency.Group()
+        self.sleeping_scripts = SleepingScripts()
         self.project = None
+        self.load_generation = 0  # goes up each time a project is sent
+        # Goes up each time the scripts are purged, so that a script that
+        # was running then (threads can't be killed) isn't queued again
+        self.script_generation = 0
+        self.profile = None  # the last profiler that ran (see profiling.py)
         self.media_environment = media_environment
+        self.frame_pacer = FramePacer()
+        # A workers.WorkerPool, if scripts run on other processes
+        self.workers = None
         # Get the script_lock before adding or removing scripts
-        self.script_lock = BoundedSemaphore(1)
+        self.script_lock = concurrency.Lock()
         self.clients = []
 
-    def queue(self, script, sprite):
-        """Queues up a script"""
+    def queue(self, script, sprite, generation=None):
+        """Queues up a script (unless the scripts have been purged since
+        the given generation)"""
         # Scripts usually start with a hat block and do nothing until it is
         # activated
         with self.script_lock:
-            self.sleeping_scripts.append((script, sprite))
+            if generation is None or generation == self.script_generation:
+                self.sleeping_scripts.add(script, sprite)
 
     def run_forever(self):
         """Runs all the scripts in the project"""
 
         # First, fire up the webserver
         server.ClientConnection.event_loop = self
-        gevent.spawn(server.run_web_servers, port)
+        concurrency.serve_web(port)
 
         # This is the main loop
         # It checks for events (from pygame)
         # and it updates the screen every so often
+        # (the scripts run while the frame pacer waits)
 
         while True:
             self.media_environment.check_for_events(self)
-            gevent.sleep(1.0 / 30)  # max 30 fps
             self.media_environment.draw(self.project)
+            tracing.flush()
+            self.frame_pacer.wait()
 
     def trigger_quit_event(self):
         """Anything we need to do before quitting? Do it now!"""
         print "Quitting"
-        pass
+        print self.frame_pacer.summary()
+        if self.workers is not None:
+            self.workers.stop()
 
     def trigger_key_press(self, media_and_event):
         """A key was pressed"""
-        self.trigger_scripts("receiveKey", is_trigger_key, media_and_event)
+        media_env, event = media_and_event
+        for key_name in self.sleeping_scripts.triggers("receiveKey"):
+            if media_env.does_key_event_match(key_name, event):
+                self.trigger_scripts("receiveKey", key_name)
 
     def trigger_green_flag(self):
         """The green flag was pressed / the project is starting"""
@@ -83,68 +254,96 @@ class EventLoop(object):
         """The stop button was pressed -- halt execution of all scripts"""
         if self.project:
             self.project.stop_all_scripts()
+        if self.workers is not None:
+            self.workers.stop_all_scripts()
 
     def broadcast_message(self, message_string):
         """A message was broadcast"""
-        self.trigger_scripts(
-            "receiveMessage", does_match_broadcast, message_string)
+        self.trigger_scripts("receiveMessage", message_string)
+        if message_string != "any message":
+            self.trigger_scripts("receiveMessage", "any message")
 
-    def trigger_scripts(self, function_name_match, callback=None, data=None):
-        """Trigger all sleeping scripts that match specified conditions"""
+    def trigger_scripts(self, function_name, trigger=None):
+        """Trigger the sleeping scripts waiting on this hat block
+        (and this key or message, if there is one)"""
+
+        if self.workers is not None:
+            # The workers run the scripts; ours just say what to wait for
+            self.workers.trigger_scripts(function_name, trigger)
+            return
 
         with self.script_lock:
-            # We can't remove items from the list in-place,
-            # so we create a new list of sleeping scripts
-            new_sleeping_scripts = []
             # print "sleeping scripts: %s, active scripts: %s" % \
             #    (len(self.sleeping_scripts), len(self.active_scripts))
-            for script, sprite in self.sleeping_scripts:
-                top_block = script.top_block()
-                if top_block and top_block.function_name == function_name_match \
-                        and (callback is None or callback(top_block, data)):
-                    # activate this script
-                    greenlet = gevent.spawn(self.run_script, script, sprite)
-                    self.active_scripts.add(greenlet)
-                else:
-                    # return script to sleeping list
-                    new_sleeping_scripts.append((script, sprite))
-            self.sleeping_scripts = new_sleeping_scripts
-
-    def run_script(self, script, sprite):
+            for script, sprite in self.sleeping_scripts.take(
+                    function_name, trigger):
+                # activate this script
+                task = concurrency.spawn(self.run_script, script, sprite,
+                                         self.script_generation)
+                self.active_scripts.add(task)
+
+    def run_script(self, script, sprite, generation=None):
         """Runs a script, and queues it up to run again if needs be"""
         script.run(sprite)
         if script.starts_on_trigger():
-            self.queue(script.from_start(), sprite)
+            self.queue(script.from_start(), sprite, generation)
 
     def purge_all_scripts(self):
         """Reset everything -- purge all running and queued scripts"""
         self.stop_all_scripts()
         with self.script_lock:
+            self.script_generation += 1
             self.active_scripts.kill()
-            self.sleeping_scripts = []
+            self.sleeping_scripts.clear()
 
     def load_project_from_disk(self, filename):
         """Loads a project from a file, and starts executing it"""
-        self.purge_all_scripts()
-        self.project = factory.deserialize_file(filename, self)
-        self.media_environment.setup_for_project(self.project)
-        # gevent.spawn(self.trigger_green_flag)
+        self.start_project(build_project(factory.deserialize_file, filename))
+        # concurrency.spawn(self.trigger_green_flag)
 
     def load_project_from_xml(self, xml):
-        """Loads a file from xml"""
+        """Loads a file from xml.
+
+        The project is parsed on a worker thread, so the stage keeps being
+        drawn (and other clients keep being served) while it loads.
+        Returns False if another project was sent while this one was
+        loading, in which case this one is dropped."""
+        self.load_generation += 1
+        generation = self.load_generation
+        if background_loading:
+            project = concurrency.run_in_thread(
+                build_project, factory.deserialize_xml, xml)
+        else:
+            project = build_project(factory.deserialize_xml, xml)
+        if generation != self.load_generation:
+            return False
+        self.start_project(project)
+        # concurrency.spawn(self.trigger_green_flag)
+        return True
+
+    def start_project(self, project):
+        """Swaps in a newly loaded project, and queues up its scripts"""
         self.purge_all_scripts()
-        self.project = factory.deserialize_xml(xml, self)
-        self.media_environment.setup_for_project(self.project)
-        # gevent.spawn(self.trigger_green_flag)
+        project.event_loop = self
+        self.project = project
+        for actor in project.all_actors():
+            for new_script in actor.scripts:
+                self.queue(new_script, actor)
+        self.media_environment.setup_for_project(project)
+        if self.workers is not None:
+            self.workers.start(project)
 
     def client_connected(self, client):
         self.clients.append(client)
         print "Now serving %s clients; %s just connected" \
               % (len(self.clients), client)
-        # Send the client a copy of the current world (if there is one)
+        self.send_project_to_client(client)
+
+    def send_project_to_client(self, client):
+        """Send the client a copy of the current world (if there is one)"""
         if self.project:
             message = "load_project %s" % factory.xml_for_object(self.project)
-            client.ws.send(message)
+            self.send_to_client(client, message)
 
     def client_disconnected(self, client):
         self.clients.remove(client)
@@ -156,28 +355,114 @@ class EventLoop(object):
         print message
         split = message.find(" ")
         if split == -1:
-            print "Unrecognized message: %s" % message
+            split = len(message)  # a command with no payload
         command = message[:split]
 
         if command == "load_project":
             xml = message[split + 1:]
-            self.load_project_from_xml(xml)
-            self.send_message_to_other_clients(message, client)
+            if self.load_project_from_xml(xml):
+                self.send_message_to_other_clients(message, client)
         elif command == "green_flag_press":
             self.trigger_green_flag()
         elif command == "stop_sign_press":
             self.stop_all_scripts()
         elif command == "execute_block":
             self.execute_block(message, split, client)
+        elif command == "project_delta":
+            self.apply_project_delta(message, split, client)
+        elif command == "profile_start":
+            try:
+                self.start_profiling(message[split + 1:].strip())
+            except RuntimeError as e:
+                print "Could not start profiling: %s" % e
+                self.send_to_client(client, "profile_error %s" % e)
+        elif command == "profile_stop":
+            self.stop_profiling()
+            self.send_profile_to_client(client)
+        elif command == "profile_report":
+            self.send_profile_to_client(client)
+        elif command == "frame_stats":
+            stats = self.frame_pacer.stats()
+            stats["timers"] = timers.get_wheel().stats()
+            self.send_to_client(client, "frame_stats %s" % json.dumps(
+                stats, sort_keys=True))
 
         else:
             print "Unrecognized command: %s" % command
 
+    def apply_project_delta(self, message, split, client):
+        """Applies a client's edit to the running project (see delta.py),
+        and passes it on to the other clients"""
+        applier = delta.DeltaApplier(self.project)
+        xml = message[split + 1:]
+        try:
+            applier.apply(ElementTree.XML(xml))
+        except delta.errors as e:
+            # The client is out of step with us; send it the real thing.
+            # If some of the edits were made before one failed, everyone
+            # else is out of step now, too.
+            print "Could not apply delta: %s" % e
+            out_of_step = list(self.clients) if applier.applied else []
+            if client not in out_of_step:
+                out_of_step.append(client)
+            for other in out_of_step:
+                self.send_project_to_client(other)
+            if self.workers is not None and applier.applied:
+                # the workers' copies don't have the edits that were made
+                self.workers.start(self.project)
+        else:
+            self.send_message_to_other_clients(message, client)
+            if self.workers is not None:
+                self.workers.apply_delta(xml)
+        finally:
+            # whatever changed, the sleeping scripts must catch up
+            self.scripts_changed(applier.changes)
+
+    def scripts_changed(self, changes):
+        """Catches up with scripts that were added, removed or edited"""
+        with self.script_lock:
+            for script, sprite in changes.removed_scripts:
+                self.sleeping_scripts.remove(script)
+                script.stop()
+            for script, sprite in changes.edited_scripts:
+                # its hat block may have changed
+                if self.sleeping_scripts.remove(script):
+                    self.sleeping_scripts.add(script, sprite)
+        for script, sprite in changes.added_scripts:
+            self.queue(script, sprite)
+
+    def start_profiling(self, interval_ms=""):
+        """Starts finding out which blocks take up the time"""
+        interval = profiling.default_interval
+        if interval_ms:
+            try:
+                interval = float(interval_ms) / 1000
+            except ValueError:
+                interval = None
+            if not interval or not 0 < interval < float("inf"):
+                print "Bad profiling interval %r; using %g ms" % (
+                    interval_ms, profiling.default_interval * 1000)
+                interval = profiling.default_interval
+        self.profile = profiling.start(interval)
+
+    def stop_profiling(self):
+        profiling.stop()
+
+    def send_profile_to_client(self, client):
+        """Sends the client what the profiler has found (so far)"""
+        if self.profile:
+            self.send_to_client(client, "profile_report %s"
+                                % self.profile.report_json())
+
+    def send_to_client(self, client, message):
+        """Sends a message to a web client (from whichever thread)"""
+        server.outbox.send(client.ws, message)
+
     def send_message_to_other_clients(self, message, source_client=None):
         """Send a message to all web clients, except the source"""
         for client in self.clients:
             if client != source_client:
-                client.ws.send(message)
+                self.send_to_client(client, message)
 
     def execute_block(self, message, split, client):
         """Executed block requested by user and return result"""
@@ -189,9 +474,9 @@ class EventLoop(object):
         xml = message[split2 + 1:]
 
         # run the block and return the result
-        greenlet = gevent.spawn(self.execute_block_and_return_result,
-                                sprite, xml, client)
-        self.active_scripts.add(greenlet)
+        task = concurrency.spawn(self.execute_block_and_return_result,
+                                 sprite, xml, client)
+        self.active_scripts.add(task)
 
     def execute_block_and_return_result(self, sprite, xml_for_block, client):
         """Runs a block and tells client the result"""
@@ -209,4 +494,5 @@ class EventLoop(object):
             result = obj.evaluate(sprite, empty_script)
         if result is not None:
             result_xml = factory.xml_for_object(result)
-            client.ws.send("execute_block_result %s" % result_xml)
+            self.send_to_client(client,
+                                "execute_block_result %s" % result_xml)
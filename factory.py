@@ -42,8 +42,59 @@ def deserialize_xml(xml, *args):
 
 
 def deserialize_file(filename, *args):
-    """Return the object represented by the data in the file"""
-    return deserialize_value(ElementTree.parse(filename).getroot(), *args)
+    """Return the object represented by the data in the file.
+
+    Projects are read as a stream (see deserialize_project_events), so
+    the whole document is never held in memory at once."""
+    events = ElementTree.iterparse(filename, events=("start", "end"))
+    event, root = next(events)
+    if root.tag == "project":
+        return deserialize_project_events(events, root, *args)
+    for event, elem in events:
+        pass  # read the rest of the document
+    return deserialize_value(root, *args)
+
+
+def deserialize_project_events(events, root, *args):
+    """Builds a project from iterparse events, starting just after the
+    project element itself has started.
+
+    Each sprite is built as soon as its element has been read, and that
+    element is then dropped, so the blocks (and other XML) of sprites
+    that have been loaded need not stay in memory while we read the rest.
+    Only the nodes that serialization needs are kept."""
+    project = actor.Project(*args)
+
+    # Queue the scripts once everything has loaded, in the usual order
+    event_loop = project.event_loop
+    project.event_loop = None
+
+    sprites = []  # sprites and watcher nodes, in order
+    path = [root]
+    for event, elem in events:
+        if event == "start":
+            path.append(elem)
+            continue
+        path.pop()
+        if len(path) == 3 and path[1].tag == "stage" and \
+                path[2].tag == "sprites":
+            if elem.tag == "sprite":
+                sprite = actor.Sprite(project)
+                sprite.deserialize(elem)
+                sprites.append(sprite)
+                elem.clear()
+            else:
+                sprites.append(elem)  # a 'watcher' node
+            path[2].remove(elem)
+
+    project.deserialize(root, sprites)
+
+    project.event_loop = event_loop
+    if event_loop:
+        for item in project.all_actors():
+            for new_script in item.scripts:
+                event_loop.queue(new_script, item)
+    return project
 
 
 def xml_for_object(object, **kwargs):
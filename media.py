@@ -4,23 +4,81 @@ Here we deal with all media-relate stuff (ie. sounds and images).
 
 All audio and graphics are to be done here,
 so that a fork of Enchanting 2 could be done without
-requiring pygame."""
+requiring pygame.
+
+PyGameMediaEnvironment draws the stage in a window;
+HeadlessMediaEnvironment runs projects without a display
+(or without pygame at all)."""
 
 from xml.etree.cElementTree import Element
 import base64
 from cStringIO import StringIO
 import sys
-import math
+from collections import OrderedDict
 
-import pygame
+try:
+    import pygame
+except ImportError:
+    pygame = None  # we can still run headless
 
 import data
 import actor
 
 
+# With more dirty rects than this, we redraw the whole screen
+max_dirty_rects = 32
+
+
+class HeadlessMediaEnvironment(object):
+
+    """Runs projects without a display, such as on a robot or server.
+
+    Nothing is drawn (so costumes need never be decoded), but sprites
+    keep all of their state.  Key presses can be queued up by name,
+    as there is no keyboard to read them from."""
+
+    def __init__(self):
+        self.width = 480
+        self.height = 360
+        self.frames = 0  # number of frames we've been asked to draw
+        self.pending_keys = []
+
+    def setup_for_project(self, project):
+        """We have loaded a new project.  Adjust setup if necessary"""
+        self.width = project.stage.width
+        self.height = project.stage.height
+
+    def draw(self, project):
+        self.frames += 1
+
+    def queue_key_press(self, key_name):
+        """Acts as if the named key (ex. "space" or "a") was pressed"""
+        self.pending_keys.append(key_name)
+
+    def check_for_events(self, event_loop):
+        """Called between frames"""
+        keys, self.pending_keys = self.pending_keys, []
+        for key_name in keys:
+            event_loop.trigger_key_press((self, key_name))
+
+    def create_speech_message(self, message, is_thought_bubble):
+        """There is nothing to render, so the message is its own image"""
+        return message
+
+    def draw_speech_message(self, speech_message, position):
+        pass
+
+    def does_key_event_match(self, key_name, key_event):
+        """Does this key event match the item checking for a key?"""
+        return key_name.upper() == key_event.upper()
+
+
 class PyGameMediaEnvironment(object):
 
     def __init__(self):
+        if pygame is None:
+            raise RuntimeError("pygame is required to show the stage; "
+                               "try running headless instead")
         pygame.init()
         pygame.key.set_repeat(100, 100)  # keys repeat every 100 ms
         self.width = 0
@@ -30,11 +88,20 @@ class PyGameMediaEnvironment(object):
         # Fonts
         self.speech_font = None
 
+        # What we drew last frame, so we only redraw what has changed
+        self.drawn_project = None
+        self.drawn_states = None  # [(actor, actor.draw_state()), ...]
+        self.drawn_rects = {}  # sprite -> screen rects it covered
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+        self.updated_rects = None  # what we last updated (None for all)
+
         self.setup_display()
 
     def setup_for_project(self, project):
         """We have loaded a new project.  Adjust setup if necessary"""
         stage = project.stage
+        image_cache.clear()  # let go of the old project's images
         self.setup_display(stage.width, stage.height, project.name, stage)
 
     def setup_display(self, width=480, height=360,
@@ -48,6 +115,7 @@ class PyGameMediaEnvironment(object):
         self.screen = pygame.display.set_mode((self.width, self.height))
         pygame.display.set_caption(title)
         self.speech_font = pygame.font.Font(None, 36)
+        self.invalidate()
 
         # convert media
         if stage:
@@ -55,15 +123,85 @@ class PyGameMediaEnvironment(object):
             # converted and cached
             stage.convert_art(self)
 
-    def draw(self, project):
-        if project:
-            for actor in project.actors_in_drawing_order():
-                actor.draw(self)
-        self.finished_frame()
+    def invalidate(self):
+        """Forces the whole screen to be redrawn next frame"""
+        self.drawn_project = None
+        self.drawn_states = None
+        self.drawn_rects = {}
 
-    def finished_frame(self):
-        """Called after every sequence of drawing commands"""
-        pygame.display.update()
+    def draw(self, project):
+        """Draws the project, only repainting the parts that changed"""
+        if not project:
+            self.finished_frame()
+            return
+
+        actors = project.actors_in_drawing_order()
+        states = [(actor, actor.draw_state()) for actor in actors]
+        if project is self.drawn_project and states == self.drawn_states:
+            # nothing has moved; leave the screen alone
+            self.frames_skipped += 1
+            return
+
+        sprites = actors[1:]  # the stage comes first
+        rects = dict((sprite, sprite.screen_rects(self))
+                     for sprite in sprites)
+        dirty = self.dirty_rects(project, states, rects)
+
+        if dirty is None:
+            self.draw_actors(actors)
+        else:
+            for area in dirty:
+                self.screen.set_clip(area)
+                self.draw_actors(
+                    [actors[0]] + [sprite for sprite in sprites
+                                   if area.collidelist(rects[sprite]) != -1])
+            self.screen.set_clip(None)
+        self.finished_frame(dirty)
+
+        self.drawn_project = project
+        self.drawn_states = states
+        self.drawn_rects = rects
+
+    def dirty_rects(self, project, states, rects):
+        """Returns the areas of the screen that need to be redrawn,
+        or None if the whole screen does"""
+        if project is not self.drawn_project or \
+                len(states) != len(self.drawn_states) or \
+                states[0] != self.drawn_states[0]:
+            # a new project, new sprites or a new stage costume
+            return None
+
+        screen_rect = self.screen.get_rect()
+        dirty = []
+        for (sprite, state), (drawn, drawn_state) in zip(
+                states[1:], self.drawn_states[1:]):
+            if sprite is not drawn:
+                return None
+            if state != drawn_state:
+                # clear where it was, and draw where it is
+                for rect in self.drawn_rects.get(sprite, []) + rects[sprite]:
+                    rect = rect.clip(screen_rect)
+                    if rect.width and rect.height:
+                        dirty.append(rect)
+
+        if len(dirty) > max_dirty_rects:
+            return None  # there is so much to do we may as well do it all
+        return dirty
+
+    def draw_actors(self, actors):
+        self.screen.fill((255, 255, 255))  # in case the stage has no art
+        for actor in actors:
+            actor.draw(self)
+
+    def finished_frame(self, rects=None):
+        """Called after every sequence of drawing commands.
+        Updates the given parts of the display (or all of it)"""
+        self.frames_drawn += 1
+        self.updated_rects = rects
+        if rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(rects)
 
     def check_for_events(self, event_loop):
         """Called between frames"""
@@ -103,6 +241,11 @@ class PyGameMediaEnvironment(object):
         self.screen.blit(
             speech_message, self.stage_pos_to_nearest_screen_pos(position))
 
+    def speech_message_rect(self, speech_message, position):
+        """Returns the area 'draw_speech_message' draws in"""
+        return speech_message.get_rect(
+            topleft=self.stage_pos_to_nearest_screen_pos(position))
+
     def does_key_event_match(self, key_name, key_event):
         """Does this key event match the item checking for a key?"""
         print "Does %s match %s?" % (key_name, key_event)
@@ -117,7 +260,7 @@ def load_image_from_string(s):
     """Takes a string like data:image/png;base64,iVBORw0KGgoAAA...
     and returns an image object"""
 
-    if len(s) == 0:
+    if len(s) == 0 or pygame is None:
         return None
 
     assert (s[:10] == "data:image")
@@ -136,6 +279,111 @@ def load_image_from_string(s):
     return pygame.image.load(data, namehint)
 
 
+# Sprites without a costume are drawn as a circle this size
+turtle_radius = 15
+
+# Costume images are rotated and scaled in steps this big
+heading_quantum = 1.0  # degrees
+scale_quantum = 0.001
+
+
+def image_size(image):
+    """Roughly how many bytes of memory does this image use?"""
+    width, height = image.get_size()
+    return width * height * image.get_bytesize()
+
+
+class ImageCache(object):
+
+    """A least-recently-used cache of rotated and scaled costume images.
+
+    It is shared by all the sprites, and holds on to no more than
+    max_bytes worth of images.  Keep an eye on the hits and misses
+    to see how well it is doing."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.images = OrderedDict()  # key -> (image, size); oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached image, or None"""
+        entry = self.images.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.images[key] = entry  # it is now the most recently used
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, image, size):
+        """Caches an image, forgetting old images to make room for it"""
+        old_entry = self.images.pop(key, None)
+        if old_entry is not None:
+            self.bytes_used -= old_entry[1]
+        if size > self.max_bytes:
+            return  # it would push everything else out
+        self.images[key] = (image, size)
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes:
+            unused_key, (unused_image, old_size) = \
+                self.images.popitem(last=False)
+            self.bytes_used -= old_size
+            self.evictions += 1
+
+    def clear(self):
+        self.images.clear()
+        self.bytes_used = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def __str__(self):
+        return "%d images, %d bytes, %d hits, %d misses, %d evictions" % (
+            len(self), self.bytes_used,
+            self.hits, self.misses, self.evictions)
+
+
+image_cache = ImageCache(max_bytes=16 * 1024 * 1024)
+
+
+class LazyImage(object):
+
+    """Holds on to an encoded image, and only decodes it when it is needed.
+
+    The encoded string is kept as-is, so that saving the costume never
+    needs to re-encode it."""
+
+    def __init__(self, raw_image):
+        self.raw_image = raw_image  # ex. "data:image/png;base64,iVBOR..."
+        self.loaded = False
+        self.convert = False  # convert to the display's format on load?
+        self.decoded_image = None
+
+    @property
+    def image(self):
+        if not self.loaded:
+            self.load()
+        return self.decoded_image
+
+    def load(self):
+        self.decoded_image = load_image_from_string(self.raw_image or "")
+        self.loaded = True
+        if self.convert and self.decoded_image:
+            self.decoded_image = self.decoded_image.convert_alpha()
+
+    def convert_when_loaded(self):
+        """Converts the image to the display's format (which makes it
+        faster to draw) as soon as it is decoded"""
+        if not self.convert:
+            self.convert = True
+            if self.loaded and self.decoded_image:
+                self.decoded_image = self.decoded_image.convert_alpha()
+
+
 class Costume(object):
 
     """A costume is a graphical representation of a stage or sprite.
@@ -154,6 +402,12 @@ class Costume(object):
         self.center_y = 0
         self.raw_image = None
         self.id = 0
+        self.lazy_image = LazyImage(None)
+
+    @property
+    def image(self):
+        """The decoded image (decoded the first time it is asked for)"""
+        return self.lazy_image.image
 
     def deserialize(self, elem):
         """Loads this class from an element tree representation"""
@@ -165,7 +419,8 @@ class Costume(object):
         self.raw_image = elem.get("image")
         self.id = int(elem.get("id"))
 
-        self.image = load_image_from_string(self.raw_image)
+        # Most costumes are never shown, so don't decode them yet
+        self.lazy_image = LazyImage(self.raw_image)
 
         # if self.image == None:
         #   import xml.etree.cElementTree as ElementTree
@@ -220,8 +475,6 @@ class Costumes(object):
 
     def __init__(self):
         self.list_node = None
-        self.cached_image = None
-        self.cached_settings = (0, 0, 0)
 
     def deserialize(self, elem):
         """Loads this class from an element tree representation"""
@@ -242,7 +495,14 @@ class Costumes(object):
         # converted
         if self.list_node:
             for costume in self.list_node.list:
-                costume.image = costume.image.convert_alpha()
+                costume.lazy_image.convert_when_loaded()
+
+    def preload(self, index):
+        """Decodes a costume's image ahead of time.  This doesn't touch
+        the display, so a worker thread can do it while a project loads."""
+        index -= 1  # convert 1-based index to 0-based index
+        if self.list_node and self.list_node.index_in_range(index):
+            self.list_node.item_at_index(index).lazy_image.image
 
     def draw_stage(self, media_env, index):
         """Draws a background for the stage"""
@@ -291,28 +551,37 @@ class Costumes(object):
 
         index -= 1  # convert 1-based index to standard 0-based index
 
-        cached_index, cached_heading, cached_scale = self.cached_settings
-        invalidate = self.cached_image is None or \
-            index != cached_index or \
-            math.fabs(scale - cached_scale) > 0.001 or \
-            math.fabs(heading - cached_heading) > 1
-        if invalidate:
-            # time to redraw the image
-            self.cached_settings = (index, heading, scale)
-
-            image = None
-            if self.list_node and self.list_node.index_in_range(index):
-                image = self.list_node.item_at_index(index).image
-
-            if image:
-                angle = 90 - heading
-                self.cached_image = pygame.transform.rotozoom(
-                    image, angle, scale)
-                self.cached_image.convert_alpha()
-            else:
-                "To do instead -- draw and cache a turtle"
-                self.cached_image = None
-        return self.cached_image
+        costume = None
+        if self.list_node and self.list_node.index_in_range(index):
+            costume = self.list_node.item_at_index(index)
+        if not costume or not costume.image:
+            # To do instead -- draw and cache a turtle
+            return None
+
+        # Nearby headings and scales share an image
+        heading = round(heading / heading_quantum) * heading_quantum % 360
+        scale = round(scale / scale_quantum) * scale_quantum
+
+        key = (costume, heading, scale)
+        image = image_cache.get(key)
+        if image is None:
+            angle = 90 - heading
+            image = pygame.transform.rotozoom(costume.image, angle, scale)
+            image_cache.put(key, image, image_size(image))
+        return image
+
+    def rect(self, media_env, index, x_pos, y_pos, heading, scale):
+        """Returns the area of the screen 'draw' will draw in"""
+
+        image = self.image(index, heading, scale)
+        pos = media_env.stage_pos_to_nearest_screen_pos((x_pos, y_pos))
+
+        if not image:
+            # the turtle is a circle; leave a pixel extra for antialiasing
+            size = 2 * turtle_radius + 2
+            return pygame.Rect(0, 0, size, size).move(
+                pos[0] - size / 2, pos[1] - size / 2)
+        return image.get_rect(center=pos)
 
     def draw(self, media_env, index, x_pos, y_pos, heading, scale):
         "Draws the costume"
@@ -325,8 +594,7 @@ class Costumes(object):
             # For now, draw a circle
             # (to do -- cache a proper turtle image)
             color = (255, 120, 0)
-            radius = 15
-            pygame.draw.circle(media_env.screen, color, pos, radius)
+            pygame.draw.circle(media_env.screen, color, pos, turtle_radius)
         else:
             rect = image.get_rect()
             rect.center = pos
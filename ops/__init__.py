@@ -4,9 +4,18 @@ that you want using ops.bind_to_function("function_name").
 This setup (as opposed to being class methods) allows
 for easily adding to the block library, and lets you bind
 to a function when you don't know which sprite you are going
-to operate on."""
+to operate on.
+
+Other block libraries (for, say, EV3 or Raspberry Pi hardware)
+can add their blocks with ops.register_module(module), or
+ops.register_block("name", function).  If a library needs hardware
+or packages that might not be there, use
+ops.register_module_lazily("module.name") instead; it is only
+imported when a project uses a block it doesn't otherwise know."""
 
 
 # Make the most useful function readily available
 # (through it, a client gets at all the other functions)
 from .utilities import bind_to_function
+from .utilities import register_block, register_module, \
+    register_module_lazily
@@ -1,4 +1,4 @@
-import gevent
+import timers
 
 import data
 
@@ -24,7 +24,7 @@ def receiveClick(target_actor, parent_script, args):
 
 
 def doWait(target_actor, parent_script, args):
-    gevent.sleep(args[0].as_number())
+    timers.wait(args[0].as_number())
     return None
 
 
@@ -1,5 +1,5 @@
 """These are the purple 'looks' blocks"""
-import gevent
+import timers
 
 import data
 
@@ -17,7 +17,7 @@ def doSayFor(target_actor, parent_script, args):
     message = args[0].as_string()
     duration = args[1].as_number()
     target_actor.say_or_think(message, False)
-    gevent.sleep(duration)
+    timers.wait(duration)
     target_actor.say_or_think("", False)
 
 
@@ -31,7 +31,7 @@ def doSayFor(target_actor, parent_script, args):
     message = args[0].as_string()
     duration = args[1].as_number()
     target_actor.say_or_think(message, True)
-    gevent.sleep(duration)
+    timers.wait(duration)
     target_actor.say_or_think("", True)
 
 
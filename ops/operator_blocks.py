@@ -35,7 +35,7 @@ def reportModulus(target_actor, parent_script, args):
 
 
 def reportRound(target_actor, parent_script, args):
-    return data.Literal(math.round(args[0].as_number()))
+    return data.Literal(round(args[0].as_number()))
 
 
 # def reportMonadic(target_actor, parent_script, args):
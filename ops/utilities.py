@@ -1,3 +1,6 @@
+import importlib
+import inspect
+
 from . import operator_blocks
 from . import variable_blocks
 from . import control_blocks
@@ -8,14 +11,65 @@ search_list = (operator_blocks, variable_blocks,
                control_blocks, looks_blocks,
                motion_blocks)
 
+# Block name (like "reportSum") -> the function that runs the block
+registry = {}
+
+# Block libraries that are only imported when a block needs them,
+# so that (say) EV3 blocks cost nothing, and do no harm, on a Raspberry Pi.
+# Module name -> the block names it provides, or None if we don't know
+lazy_modules = {}
+
+
+def block_functions(module):
+    """Returns (name, function) for each block a module defines.
+    Blocks are the public functions defined in the module itself
+    (not helpers it imported, like concurrency.sleep)."""
+    for name, value in vars(module).items():
+        if inspect.isfunction(value) and not name.startswith("_") and \
+                value.__module__ == module.__name__:
+            yield name, value
+
+
+def register_block(function_name, function):
+    """Adds (or replaces) a block"""
+    registry[function_name] = function
+
+
+def register_module(module):
+    """Adds all the blocks a module defines"""
+    for name, function in block_functions(module):
+        register_block(name, function)
+
+
+def register_module_lazily(module_name, block_names=None):
+    """Arranges for a module's blocks to be added the first time one of
+    them is needed.  If block_names is None, the module is imported the
+    first time any block can't be found."""
+    lazy_modules[module_name] = block_names
+
+
+def load_lazy_modules(function_name):
+    """Imports the lazy modules that might define this block"""
+    for module_name, block_names in lazy_modules.items():
+        if block_names is None or function_name in block_names:
+            del lazy_modules[module_name]
+            try:
+                register_module(importlib.import_module(module_name))
+            except ImportError as e:
+                print "Could not load block library %s: %s" % (
+                    module_name, e)
+
 
 def bind_to_function(function_name):
     """Takes the name of a function (like "reportSum") and returns
     a reference to that function if it is a known operation."""
 
-    for module in search_list:
-        try:
-            return getattr(module, function_name)
-        except AttributeError:
-            pass
-    return None
+    function = registry.get(function_name)
+    if function is None and lazy_modules:
+        load_lazy_modules(function_name)
+        function = registry.get(function_name)
+    return function
+
+
+for module in search_list:
+    register_module(module)
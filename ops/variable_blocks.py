@@ -1,6 +1,7 @@
 """These are the orange 'variable' blocks"""
 
 import data
+import script
 
 
 def var(target_actor, parent_script, name):
@@ -35,6 +36,8 @@ def doHideVar(target_actor, parent_script, args):
 def doDeclareVariables(target_actor, parent_script, args):
     list_of_vars = args[0]
     for var_name in list_of_vars.list:
-        parent_script.variables.add(data.Variable(var_name.as_string()))
+        name = var_name.as_string()
+        script.declare_local_variable_name(name)
+        parent_script.variables.add(data.Variable(name))
 
 # many more to do here
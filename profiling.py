@@ -0,0 +1,271 @@
+"""profiling.py finds out which blocks, custom blocks, and sprites a
+project spends its time in.
+
+Python's profilers only see Script.step and the compiled blocks, which
+are the same code whatever a project does.  This profiler looks at the
+blocks themselves:
+
+    profiling.start()
+    ... let the project run ...
+    profile = profiling.stop()
+    print profile.collapsed()
+
+Every 'interval' seconds of CPU time (or of wall time, with clock="wall")
+a signal interrupts whatever is running, and we look down the stack for
+the blocks that are running: the one running right now, the block it is
+an argument of, the custom block whose definition that is in, and so on
+down to the script's sprite.  Each of those blocks gets credit for the
+sample.  Custom blocks run on Script.run's stack of generators, rather
+than the Python stack, so we look there, too.
+
+Profiling also counts how many times each block runs, through the same
+hook that tracing uses (it passes the calls on to a trace recorder, if
+there is one).  While profiling, 'report (custom block)' isn't a tail
+call, just as when tracing.
+
+Results come as a dict, ready to be sent as JSON (see Profiler.report),
+or as 'collapsed stacks', which flamegraph.pl and speedscope read:
+
+    Sprite;doForever;doIf;move %s;forward 12
+
+This needs setitimer, which Windows doesn't have.  It also only works
+with the gevent backend (see concurrency.py): the signal handler can only
+be set on the main thread, and the signal only interrupts the main
+thread, so with the threads backend it would never see a script running.
+"""
+
+import json
+import signal
+import types
+
+import block_compiler
+import concurrency
+import script
+import tracing
+
+
+# The profiler that is running; None when we are not profiling
+profiler = None
+
+# Seconds between samples, if not told otherwise
+default_interval = 0.005
+
+clocks = {
+    "cpu": (signal.SIGPROF, getattr(signal, "ITIMER_PROF", None)),
+    "wall": (signal.SIGALRM, getattr(signal, "ITIMER_REAL", None)),
+}
+
+
+def nested_code(code):
+    """Yields the code of the functions defined inside some code"""
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            yield constant
+            for inner in nested_code(constant):
+                yield inner
+
+
+def find_block_code():
+    """Returns the code that runs blocks: Block.evaluate, and each of the
+    compiler's closures that knows which block it is running"""
+    codes = set([script.Block.evaluate.im_func.func_code])
+    for value in vars(block_compiler).values():
+        if isinstance(value, types.FunctionType):
+            for code in nested_code(value.func_code):
+                if "block" in code.co_freevars:
+                    codes.add(code)
+    return codes
+
+block_code = find_block_code()
+run_code = script.Script.run.im_func.func_code
+
+
+def block_in_frame(frame):
+    """Returns (target, block) if the frame is running a block"""
+    local = frame.f_locals
+    block = local.get("block") or local.get("self")
+    return local.get("target"), block
+
+
+def running_blocks(frame):
+    """Returns [(target, block)] for the blocks running in a frame and
+    the frames that called it, outermost first"""
+    found = []
+    while frame is not None:
+        if frame.f_code in block_code:
+            found.append(block_in_frame(frame))
+        elif frame.f_code is run_code:
+            # The generators that are waiting, on this one's stack
+            waiting = frame.f_locals.get("stack") or ()
+            for generator in reversed(waiting):
+                waiting_frame = generator.gi_frame
+                if not generator.gi_running and waiting_frame is not None \
+                        and waiting_frame.f_code in block_code:
+                    found.append(block_in_frame(waiting_frame))
+        frame = frame.f_back
+    found.reverse()
+    return found
+
+
+def block_label(block):
+    """How a block appears in collapsed stacks"""
+    if block.var_name is not None:
+        return "var %s" % block.var_name
+    return block.function_name.replace(";", ",")
+
+
+def actor_name(actor):
+    return getattr(actor, "name", None) or "?"
+
+
+class Profiler(object):
+
+    """Samples the running blocks, and counts the blocks that run"""
+
+    def __init__(self, interval=default_interval, clock="cpu"):
+        self.interval = interval
+        self.clock = clock
+        self.stacks = {}  # tuple of (target, block), outermost first -> n
+        self.calls = {}  # (block, target) -> number of times it ran
+        self.samples = 0  # samples taken while blocks were running
+        self.other_samples = 0  # samples taken while they weren't
+        self.running = False
+        self.next_recorder = None  # the trace recorder we pass calls on to
+        self.previous_handler = None
+
+    def start(self):
+        signal_number, timer = clocks[self.clock]
+        if timer is None:
+            raise RuntimeError("profiling needs signal.setitimer")
+        if concurrency.backend != "gevent":
+            raise RuntimeError("profiling only works with the gevent "
+                               "backend, not %s" % concurrency.backend)
+        self.next_recorder = tracing.recorder
+        tracing.recorder = self
+        self.previous_handler = signal.signal(signal_number, self.sample)
+        signal.setitimer(timer, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal_number, timer = clocks[self.clock]
+        signal.setitimer(timer, 0, 0)
+        signal.signal(signal_number, self.previous_handler or signal.SIG_DFL)
+        if tracing.recorder is self:
+            tracing.recorder = self.next_recorder
+        self.running = False
+
+    def sample(self, signal_number, frame):
+        """The signal handler; notes which blocks are running"""
+        stack = tuple(running_blocks(frame))
+        if stack:
+            self.samples += 1
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        else:
+            self.other_samples += 1
+
+    def record(self, block, target, args, result):
+        """Called by blocks after they have run (see tracing.py)"""
+        key = (block, target)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if self.next_recorder is not None:
+            self.next_recorder.record(block, target, args, result)
+
+    def flush(self):
+        if self.next_recorder is not None:
+            self.next_recorder.flush()
+
+    def close(self):
+        """tracing.stop() is closing us; stop passing calls on"""
+        if self.next_recorder is not None:
+            self.next_recorder.close()
+            self.next_recorder = None
+
+    def collapsed(self):
+        """Returns the samples as collapsed stacks, one per line"""
+        lines = []
+        for stack, count in dict(self.stacks).items():
+            labels = [actor_name(stack[0][0])]
+            labels.extend(block_label(block) for target, block in stack)
+            lines.append("%s %d" % (";".join(labels), count))
+        lines.sort()
+        return "\n".join(lines)
+
+    def report(self):
+        """Returns the time spent in, and the number of calls to, each
+        block (by uuid), block function, custom block definition, and
+        sprite.  'self_ms' is time spent in the block itself; 'total_ms'
+        includes the blocks it ran (its arguments, and for custom blocks,
+        their definitions)."""
+        ms = self.interval * 1000
+        tables = {"blocks": {}, "functions": {}, "definitions": {},
+                  "sprites": {}}
+
+        def keys(block, target):
+            """Where a block's calls and time are added up"""
+            yield "blocks", str(block.uuid)
+            yield "functions", block.function_name
+            if block.type is script.BlockType.custom and \
+                    block.definition is not None:
+                yield "definitions", block.definition.specification
+            yield "sprites", actor_name(target)
+
+        def add(table, key, field, amount):
+            entries = tables[table]
+            if key not in entries:
+                entries[key] = dict(calls=0, self_ms=0.0, total_ms=0.0)
+            entries[key][field] += amount
+
+        for (block, target), count in dict(self.calls).items():
+            for table, key in keys(block, target):
+                add(table, key, "calls", count)
+            tables["blocks"][str(block.uuid)]["function"] = \
+                block.function_name
+
+        for stack, count in dict(self.stacks).items():
+            time = count * ms
+            # A block can be in a stack more than once (when a custom
+            # block calls itself), but its time only counts once
+            seen = set()
+            for target, block in stack:
+                for table, key in keys(block, target):
+                    if (table, key) not in seen:
+                        seen.add((table, key))
+                        add(table, key, "total_ms", time)
+            target, block = stack[-1]
+            for table, key in keys(block, target):
+                add(table, key, "self_ms", time)
+            tables["blocks"][str(block.uuid)]["function"] = \
+                block.function_name
+
+        tables.update({
+            "interval_ms": ms,
+            "clock": self.clock,
+            "blocks_ms": self.samples * ms,
+            "other_ms": self.other_samples * ms,
+        })
+        return tables
+
+    def report_json(self):
+        return json.dumps(self.report(), sort_keys=True)
+
+
+def start(interval=default_interval, clock="cpu"):
+    """Starts profiling; returns the profiler"""
+    global profiler
+    stop()
+    started = Profiler(interval, clock)
+    started.start()
+    profiler = started
+    return profiler
+
+
+def stop():
+    """Stops profiling; returns the profiler (to read its results), or
+    None if we weren't profiling"""
+    global profiler
+    stopped, profiler = profiler, None
+    if stopped is not None:
+        stopped.stop()
+    return stopped
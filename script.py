@@ -7,13 +7,64 @@
 """
 
 from xml.etree.cElementTree import Element
+from types import GeneratorType
 import uuid
+import time
+import threading
 
-import gevent
-
+import concurrency
 import data
 import factory
 import ops
+import block_compiler
+import tracing
+import timers
+
+
+# Names that scripts have given variables of their own, with 'script
+# variables' blocks or as custom block inputs.  Compiled blocks assume that
+# any other name belongs to a sprite or the project, and needn't be looked
+# for in each script.  The generation goes up when a name is added.
+local_variable_names = set()
+local_names_generation = 0
+
+
+# Goes up whenever block definitions are added, replaced, or removed,
+# so that custom blocks know to look for their definitions again
+definitions_generation = 0
+
+# Projects can be loaded on a worker thread (see event_loop.py), so the
+# generations go up under a (real) lock, lest an increment be lost
+generation_lock = threading.Lock()
+
+
+def definitions_changed():
+    global definitions_generation
+    with generation_lock:
+        definitions_generation += 1
+
+
+def declare_local_variable_name(name):
+    """Call this before a script adds a variable of its own"""
+    global local_names_generation
+    with generation_lock:
+        if name not in local_variable_names:
+            local_variable_names.add(name)
+            local_names_generation += 1
+
+
+def variable_value(variable):
+    """Returns the value of a variable (which may be None)"""
+    if variable:
+        result = variable.value()
+        if result:
+            return result
+    return data.Literal(None)
+
+
+def increment_variable_value(variable, increment):
+    if variable:
+        variable.change_by(increment)
 
 
 def terse_debug_id(obj):
@@ -43,10 +94,36 @@ class BlockType(object):
         return BlockType.name_list[value]
 
 
+class Pacing(object):
+
+    """A simple enum for how running scripts share time with each other.
+
+    fixed - sleep after every block (so at most 100 blocks per second)
+    budgeted - run until the time budget is used up or a loop goes around,
+               and only then yield to the other scripts"""
+    fixed, budgeted = range(0, 2)
+    name_list = ["fixed", "budgeted"]
+
+    @staticmethod
+    def pacing_from_name(name):
+        return Pacing.name_list.index(name)
+
+
+# How scripts are paced as they run (see Script.run)
+pacing = Pacing.budgeted
+fixed_pacing_delay = 0.01  # seconds to sleep after each block, when fixed
+time_budget = 1.0 / 60  # seconds to run for before yielding, when budgeted
+
+
 class Block(object):
 
     """This is a code block, representing an instruction to execute"""
 
+    # Projects can have thousands of blocks; keep them small
+    __slots__ = ("function", "function_name", "arguments", "var_name",
+                 "type", "uuid", "deserialized_uuid",
+                 "binding")
+
     def __init__(self):
         self.function = None  # used to actually call the function
         self.function_name = ""  # the original, textual name of the function
@@ -59,6 +136,11 @@ class Block(object):
         self.uuid = None  # uuid.uuid1()
         self.deserialized_uuid = False
 
+        # Custom blocks: (who we last found the definition for, when,
+        # the definition, its function); replaced whole, as scripts on
+        # other threads may be reading it
+        self.binding = (None, None, None, None)
+
     def deserialize(self, elem):
         """Load from an xml element tree"""
 
@@ -132,26 +214,60 @@ class Block(object):
         else:
             args = self.var_name
 
-        if self.function is None and self.type is BlockType.custom:
-            # The definitions have been loaded -- what is this function?
-            bd = target.find_block_definition(self.function_name)
-            if bd is not None:
-                self.function = bd.run
+        if self.type is BlockType.custom:
+            function = self.bind_custom_function(target)
+        else:
+            function = self.function
 
         # now, run this function
-        if self.function is not None:
-            result = self.function(target, script, args)
+        if function is not None:
+            result = function(target, script, args)
         else:
             print "Unknown function: %s" % self.function_name
             result = data.Literal(None)
 
-        # to do -- save args and result with timestamp
+        if tracing.recorder is not None:
+            tracing.recorder.record(self, target, args, result)
 
         return result
 
+    def bind_custom_definition(self, target):
+        """Returns this custom block's definition,
+        or None if there is (as yet) no definition for it.
+
+        The answer depends on who runs the block (a sprite's definitions
+        hide the project's), and can change when definitions are sent
+        over the wire, so we look again if either of those changes."""
+        return self.bind(target)[2]
+
+    def bind_custom_function(self, target):
+        """Returns the function that runs this custom block, or None"""
+        return self.bind(target)[3]
+
+    def bind(self, target):
+        """Returns this custom block's binding for the target"""
+        binding = self.binding
+        generation = definitions_generation
+        if binding[0] is not target or binding[1] != generation:
+            bd = target.find_block_definition(self.function_name)
+            binding = (target, generation, bd,
+                       bd.run if bd is not None else None)
+            self.binding = binding
+        return binding
+
+    @property
+    def definition(self):
+        """The definition this custom block last ran"""
+        return self.binding[2]
+
+    def compile(self):
+        """Returns a function that evaluates this block, quickly"""
+        return block_compiler.compile_block(self)
+
     def __repr__(self):
         # Shows state; can't reconstruct from this info
-        return "%s(%r)" % (self.__class__, self.__dict__)
+        return "%s(%r)" % (self.__class__, dict(
+            (name, getattr(self, name)) for name in self.__slots__))
 
     def __str__(self):
         return "%s(%s)" % (
@@ -162,12 +278,19 @@ class Script(object):
 
     "Represents a sequence of instructions"
 
+    # A copy is made each time a loop goes around or a custom block runs
+    __slots__ = ("x", "y", "blocks", "compiled", "parent_script",
+                 "code_pos", "subscript", "repeat", "stopped", "_variables",
+                 "frames")
+
     def __init__(self):
         # Only top-level scripts contain x and y values
         self.x = None
         self.y = None
         self.blocks = []
+        self.compiled = None  # compiled blocks, if compiler is enabled
         self.parent_script = None
+        self.frames = None  # nested scripts we have run; see activate_subscript
         self.from_start()
 
     def from_start(self):
@@ -176,9 +299,16 @@ class Script(object):
         self.subscript = None  # set by flow control blocks
         self.repeat = 0  # adjusted by flow control blocks
         self.stopped = False
-        self.variables = data.Variables()
+        self._variables = None  # most scripts never have variables
         return self
 
+    @property
+    def variables(self):
+        """The script's own variables, created when first needed"""
+        if self._variables is None:
+            self._variables = data.Variables()
+        return self._variables
+
     def parallel_copy(self):
         """Clone script -- keep code, but create new flow control information
 
@@ -189,6 +319,7 @@ class Script(object):
         but we create a new copy of the code position, etc."""
         clone = Script()
         clone.blocks = self.blocks
+        clone.compiled = self.compiled
         clone.x, clone.y = self.x, self.y
         clone.parent_script = self.parent_script
         clone.from_start()
@@ -210,6 +341,20 @@ class Script(object):
             b = Block()
             b.deserialize(block)
             self.blocks.append(b)
+        self.compile()
+
+    def compile(self):
+        """Compiles the blocks, so they needn't be interpreted as they run.
+
+        Call this again if the list of blocks changes.  Copies of this
+        script that are running share the compiled code, and see the
+        change too."""
+        if not block_compiler.enabled:
+            self.compiled = None
+        elif self.compiled is None:
+            self.compiled = block_compiler.compile_script(self)
+        else:
+            self.compiled[:] = block_compiler.compile_script(self)
 
     def serialize(self, **kwargs):
         """Return an elementtree representing this object"""
@@ -234,20 +379,25 @@ class Script(object):
 
     def step(self, target):
         """Execute a line of code; raises StopIteration
-        when there is no more code"""
+        when there is no more code.
+
+        Returns True if a loop just went around, which is a good
+        time to let other scripts run."""
 
         # Are we inside a nested script?
         if self.subscript:
             # step the script until it is done
             try:
                 # print "(sub) ",
-                self.subscript.step(target)
+                return self.subscript.step(target)
             except StopIteration as e:
                 # print "(exit)"
                 self.subscript = None
                 result = e.args[0]
                 if result is not None:
                     raise e
+                # If we are repeating, we just finished a pass of the loop
+                return bool(self.repeat)
         else:
             if self.code_pos < len(self.blocks):
                 current_block = self.blocks[self.code_pos]
@@ -255,10 +405,22 @@ class Script(object):
                 raise StopIteration(None)
 
             # print "%s: %s" % (debug_name_for_object(self), current_block)
-            current_block.evaluate(target, self)
-            # print "(repeat %s)" % self.repeat
-            if not self.repeat:
-                self.code_pos += 1
+            if self.compiled is not None:
+                result = self.compiled[self.code_pos](target, self)
+                if type(result) is GeneratorType:
+                    # The block calls a custom block, and has to wait for
+                    # it; run_steps hands it to run, which runs it for us
+                    return result
+            else:
+                current_block.evaluate(target, self)
+            self.next_block()
+            return False
+
+    def next_block(self):
+        """Moves on, once a block has run (unless a loop is going around)"""
+        # print "(repeat %s)" % self.repeat
+        if not self.repeat:
+            self.code_pos += 1
 
     def evaluate(self, target, script):
         """Scripts (in arguments) evaluate to themselves.
@@ -266,27 +428,87 @@ class Script(object):
         return self
 
     def run(self, target):
-        """Runs the code until it is done (if it ever finishes)"""
+        """Runs the code until it is done (if it ever finishes)
+
+        Custom blocks do not call each other on the Python stack, which
+        a recursive block would soon overflow.  Instead, each running
+        script, block, and custom block is a generator (see run_steps and
+        block_compiler.compile_steps), and we keep a stack of them here.
+        A generator yields the generator it is waiting on, which we push;
+        when that one finishes, we pop it and send its result back.
+
+        'report (some custom block)' is a tail call: the custom block
+        replaces the one that is reporting, rather than going on top of
+        it, so the stack doesn't grow at all."""
         self.stopped = False
-        try:
-            while not self.stopped:
-                self.step(target)
-                gevent.sleep(0.01)
-        except StopIteration as e:
-            # The StopIteration's parameter is the return value
-            # It is typically None, but if a 'report' block
-            # was used, we'll have a value
-            result = e.args[0]
-            return result
+        stack = [self.run_steps(target)]
+        result = None
+        while stack:
+            if self.stopped:
+                return None
+            try:
+                waiting_on = stack[-1].send(result)
+            except StopIteration as e:
+                # The StopIteration's parameter is the return value
+                # It is typically None, but if a 'report' block
+                # was used, we'll have a value
+                stack.pop()
+                result = e.args[0] if e.args else None
+                if type(result) is GeneratorType:
+                    # a tail call; it finishes the job for the one we popped
+                    stack.append(result)
+                    result = None
+            else:
+                stack.append(waiting_on)
+                result = None
+        return result
+
+    def run_steps(self, target):
+        """Runs until the time budget is spent or a loop goes around,
+        then lets the other scripts have a turn (or, with fixed pacing,
+        sleeps after every block).
+
+        This is a generator, for run to run: it yields the blocks that
+        call custom blocks, and its result is what the script reported."""
+        deadline = time.time() + time_budget
+        while not self.stopped:
+            stepped = self.step(target)
+            if type(stepped) is GeneratorType:
+                reported = yield stepped
+                if reported is not None:
+                    if type(reported) is TailCall:
+                        reported = reported.start(target)
+                    raise StopIteration(reported)
+            if pacing == Pacing.fixed:
+                timers.wait(fixed_pacing_delay)
+            elif stepped is True or time.time() >= deadline:
+                concurrency.sleep(0)
+                deadline = time.time() + time_budget
 
     def stop(self):
         "Call this to stop a script (such as when the stop sign is pressed)"
         self.stopped = True
 
     def activate_subscript(self, subscript):
-        """Lets you run a nested script (like a 'repeat' or 'if' block)"""
-        self.subscript = subscript.parallel_copy()
-        self.subscript.parent_script = self
+        """Lets you run a nested script (like a 'repeat' or 'if' block).
+
+        A loop runs the same nested script over and over, so rather than
+        copying it each time around, we keep the copy (the 'frame') and
+        start it over.  Only one nested script runs at a time, and it has
+        finished before the next one starts, so this is safe."""
+        if self.frames is None:
+            self.frames = {}
+        frame = self.frames.get(subscript)
+        if frame is None:
+            frame = subscript.parallel_copy()
+            frame.parent_script = self
+            self.frames[subscript] = frame
+        else:
+            frame.from_start()
+            # in case the code has been edited or recompiled since
+            frame.blocks = subscript.blocks
+            frame.compiled = subscript.compiled
+        self.subscript = frame
 
     def starts_on_trigger(self):
         """After the script runs, should it be queued up
@@ -321,9 +543,10 @@ class Script(object):
 
         script = self
         while script:
-            ret = script.variables.get_variable(name)
-            if ret:
-                return ret
+            if script._variables is not None:
+                ret = script._variables.get_variable(name)
+                if ret:
+                    return ret
             script = script.parent_script
 
         ret = actor.variables.get_variable(name)
@@ -341,8 +564,8 @@ class Script(object):
 
         script = self
         while script:
-            ret = script.variables.get_variable(name)
-            if ret:
+            if script._variables is not None and \
+                    script._variables.get_variable(name):
                 return script
             script = script.parent_script
 
@@ -361,12 +584,7 @@ class Script(object):
         return "%s.%s" % (debug_name_for_object(owner), var_name)
 
     def value_of_variable(self, actor, name):
-        v = self.get_variable(actor, name)
-        if v:
-            result = v.value()
-            if result:
-                return result
-        return data.Literal(None)
+        return variable_value(self.get_variable(actor, name))
 
     def set_variable(self, actor, name, value):
         v = self.get_variable(actor, name)
@@ -377,9 +595,7 @@ class Script(object):
         return None
 
     def increment_variable(self, actor, name, increment):
-        v = self.get_variable(actor, name)
-        if v:
-            v.set(data.Literal(v.value().as_number() + increment))
+        increment_variable_value(self.get_variable(actor, name), increment)
         return None
 
     def show_variable(self, actor, name, visible):
@@ -504,6 +720,8 @@ class BlockDefinition(object):
                 function_name_list.append(specifier[1:])
 
         self.function_name = "".join(function_name_list)
+        for name in self.parameter_names:
+            declare_local_variable_name(name)
 
     def deserialize(self, elem):
         """Load from an xml element tree"""
@@ -538,15 +756,19 @@ class BlockDefinition(object):
 
         return definition
 
-    def run(self, target, parent_script, params):
-        """Runs the defined block, and returns a value afterwards"""
-
+    def frame(self, parent_script, params):
+        """Returns a copy of the script to run, with its inputs set"""
         script = self.script.parallel_copy()
         script.parent_script = parent_script
         # set input parameters
         for index, parameter in enumerate(params):
             name = self.parameter_names[index]
             script.variables.add(data.Variable(name, parameter))
+        return script
+
+    def run(self, target, parent_script, params):
+        """Runs the defined block, and returns a value afterwards"""
+        script = self.frame(parent_script, params)
         # initial_vars = str(script.variables)
         result = script.run(target)
         # print "Done %s: %s (%s) -> %s (%s)" % (debug_name_for_object(script),
@@ -554,6 +776,30 @@ class BlockDefinition(object):
         #                                  result, script.variables)
         return result
 
+    def start(self, target, parent_script, params):
+        """Returns a generator that runs the defined block,
+        for a running script to wait on (see Script.run)"""
+        return self.frame(parent_script, params).run_steps(target)
+
+
+class TailCall(object):
+
+    """What 'report (some custom block)' reports, so that the custom
+    block runs in place of the one reporting (see Script.run).
+
+    Its parent script is the one that reported, as for any other call,
+    so it sees the same variables however it was called."""
+
+    __slots__ = ("definition", "params", "parent_script")
+
+    def __init__(self, definition, params, parent_script):
+        self.definition = definition
+        self.params = params
+        self.parent_script = parent_script
+
+    def start(self, target):
+        return self.definition.start(target, self.parent_script, self.params)
+
 
 class Blocks(object):
 
@@ -561,12 +807,38 @@ class Blocks(object):
 
     def __init__(self):
         self.definitions = []
+        self.index = {}  # function name -> definition
 
     def deserialize(self, elem):
         """Load from an xml element tree"""
         assert (elem.tag == "blocks")
         for child in elem:
             self.definitions.append(factory.deserialize_value(child))
+        self.reindex()
+
+    def reindex(self):
+        """Call this after changing the list of definitions"""
+        self.index = {}
+        for definition in self.definitions:
+            # if a name is defined twice, the first definition wins
+            self.index.setdefault(definition.function_name, definition)
+        definitions_changed()
+
+    def add(self, definition):
+        """Adds a definition, replacing any with the same function name.
+        Returns the definition it replaced, or None."""
+        old = self.index.get(definition.function_name)
+        if old is None:
+            self.definitions.append(definition)
+        else:
+            self.definitions[self.definitions.index(old)] = definition
+        self.index[definition.function_name] = definition
+        definitions_changed()
+        return old
+
+    def remove(self, definition):
+        self.definitions.remove(definition)
+        self.reindex()
 
     def serialize(self, **kwargs):
         """Save out as an element tree"""
@@ -576,10 +848,7 @@ class Blocks(object):
         return blocks_node
 
     def find_block_definition(self, function_name):
-        for definition in self.definitions:
-            if definition.function_name == function_name:
-                return definition
-        return None
+        return self.index.get(function_name)
 
 #
 #    def get_custom_block(self, function_name):
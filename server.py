@@ -2,10 +2,23 @@
 
 import os.path
 import mimetypes
+import threading
+import Queue
+import gzip
+import hashlib
+import email.utils
+from cStringIO import StringIO
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 from collections import OrderedDict
 
-from geventwebsocket import WebSocketServer, WebSocketApplication, Resource
+try:
+    from geventwebsocket import WebSocketServer, WebSocketApplication, \
+        Resource
+except ImportError:
+    # We can still serve the web page (see run_web_servers_on_thread)
+    WebSocketServer = None
+    WebSocketApplication = object
 
 
 class ClientConnection(WebSocketApplication):
@@ -21,8 +34,155 @@ class ClientConnection(WebSocketApplication):
         ClientConnection.event_loop.client_disconnected(self)
 
 
+# Where the static files (the Snap! web page and its scripts) live
+web_root = "web"
+
+# Static files are kept in memory, and gzipped once, while they fit
+max_cached_bytes = 32 * 1024 * 1024
+
+# Only files of these types (and this large) are worth compressing
+compressed_types = ("text/", "application/javascript", "application/json",
+                    "application/xml", "image/svg+xml")
+min_compressed_size = 512
+
+
+def guess_mime_type(filename):
+    if filename.endswith(".js"):
+        return "application/javascript"
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def gzip_string(content):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def accepts_gzip(accept_encoding):
+    """Does an Accept-Encoding header allow gzip?  ("gzip;q=0" doesn't)"""
+    quality = {}
+    for token in accept_encoding.split(","):
+        parts = [part.strip() for part in token.split(";")]
+        coding = parts[0].lower()
+        q = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            quality[coding] = q
+    return quality.get("gzip", quality.get("*", 0.0)) > 0
+
+
+class StaticFile(object):
+
+    """The contents of a file, and the headers that go with it"""
+
+    def __init__(self, filename, stat):
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        with open(filename, "rb") as f:
+            self.content = f.read()
+        self.mime = guess_mime_type(filename)
+        self.etag = '"%s"' % hashlib.md5(self.content).hexdigest()
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+
+        self.gzipped = None
+        if len(self.content) >= min_compressed_size and \
+                self.mime.startswith(compressed_types):
+            gzipped = gzip_string(self.content)
+            if len(gzipped) < len(self.content):
+                self.gzipped = gzipped
+
+    def nbytes(self):
+        return len(self.content) + len(self.gzipped or "")
+
+    def is_current(self, stat):
+        return self.mtime == stat.st_mtime and self.size == stat.st_size
+
+    def not_modified(self, environ):
+        """Does the browser already have this version of the file?"""
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags or \
+                "W/" + self.etag in tags
+        if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(self.mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def response(self, environ):
+        """Returns the status, headers, and body to send"""
+        headers = [("ETag", self.etag),
+                   ("Last-Modified", self.last_modified),
+                   ("Cache-Control", "no-cache")]
+        if self.gzipped is not None:
+            headers.append(("Vary", "Accept-Encoding"))
+        if self.not_modified(environ):
+            return "304 Not Modified", headers, ""
+
+        content = self.content
+        if self.gzipped is not None and \
+                accepts_gzip(environ.get("HTTP_ACCEPT_ENCODING", "")):
+            content = self.gzipped
+            headers.append(("Content-Encoding", "gzip"))
+        headers += [("Content-Type", self.mime),
+                    ("Content-Length", str(len(content)))]
+        return "200 OK", headers, content
+
+
+class StaticFileCache(object):
+
+    """Keeps recently served files in memory, until they change on disk"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.files = OrderedDict()  # filename -> StaticFile, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        stat = os.stat(filename)
+        static_file = self.files.pop(filename, None)
+        if static_file is not None:
+            self.nbytes -= static_file.nbytes()
+            if static_file.is_current(stat):
+                self.hits += 1
+            else:
+                static_file = None
+        if static_file is None:
+            self.misses += 1
+            static_file = StaticFile(filename, stat)
+
+        if static_file.nbytes() <= self.max_bytes:
+            self.files[filename] = static_file
+            self.nbytes += static_file.nbytes()
+            while self.nbytes > self.max_bytes:
+                filename, evicted = self.files.popitem(last=False)
+                self.nbytes -= evicted.nbytes()
+        return static_file
+
+    def clear(self):
+        self.files.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.files)
+
+
+static_file_cache = StaticFileCache(max_cached_bytes)
+
+
 def static_file_server(environ, start_response):
-    filename = "web" + environ["PATH_INFO"]
+    filename = web_root + environ["PATH_INFO"]
     mime = "text/html"
     status = "200 OK"
     content = None
@@ -37,7 +197,7 @@ def static_file_server(environ, start_response):
         # special case -- if we are looking at the root directory,
         # return the snap web page
         if http_dir == "":
-            filename = "web/snap.html"
+            filename = os.path.join(web_root, "snap.html")
         else:
             # If the directory doesn't end in a "/", we have to issue a
             # redirect
@@ -53,17 +213,20 @@ def static_file_server(environ, start_response):
             content += "</pre></body></html>"
 
     if os.path.isfile(filename):
-        mime = mimetypes.guess_type(filename)
-        if filename.endswith(".js"):
-            mime = "application/javascript"
-        content = open(filename).readlines()
-
-    if content is None:
-        status = "404 Not Found"
-        content = "<h1>404 Not found</h1><p>%s does not exist" % (filename)
+        status, headers, content = \
+            static_file_cache.get(filename).response(environ)
+    else:
+        if content is None:
+            status = "404 Not Found"
+            content = "<h1>404 Not found</h1><p>%s does not exist" % (
+                filename)
+        headers = [("Content-Type", mime),
+                   ("Content-Length", str(len(content)))]
 
-    start_response(status, [("Content-Type", mime)])
-    return content
+    start_response(status, headers)
+    if environ.get("REQUEST_METHOD") == "HEAD":
+        return [""]
+    return [content]
 
 
 def run_web_servers(port):
@@ -77,3 +240,65 @@ def run_web_servers(port):
     server = WebSocketServer(("", port), resource, debug=False)
     print "Now listening on port %d" % port
     server.serve_forever()
+
+
+class Outbox(object):
+
+    """Sends messages to web clients on the web server's thread.
+
+    With the "threads" backend, the websockets belong to the gevent hub
+    of the web server's thread, and mustn't be used from other threads
+    (such as the scripts').  Messages sent from those are queued, and
+    the server's hub is woken up to send them."""
+
+    def __init__(self):
+        self.thread = None  # the web server's, once we have started
+        self.messages = Queue.Queue()
+        self.wakeup = None
+
+    def start(self):
+        """Call this on the web server's thread, before it serves"""
+        import gevent
+        self.thread = threading.current_thread()
+        self.wakeup = gevent.get_hub().loop.async_()
+        # (the hub itself mustn't block, so the sending is done elsewhere)
+        self.wakeup.start(lambda: gevent.spawn(self.flush))
+
+    def send(self, ws, message):
+        if self.thread is None or self.thread is threading.current_thread():
+            ws.send(message)
+        else:
+            self.messages.put((ws, message))
+            self.wakeup.send()
+
+    def flush(self):
+        while True:
+            try:
+                ws, message = self.messages.get_nowait()
+            except Queue.Empty:
+                return
+            ws.send(message)
+
+outbox = Outbox()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_web_servers_on_thread(port):
+    """Serves the web page, and (with gevent-websocket) the websocket,
+    on a thread of its own, for the "threads" backend (see
+    concurrency.py).  gevent gives each thread a hub of its own, so the
+    servers run there as they would anywhere else."""
+    if WebSocketServer is not None:
+        outbox.start()
+        run_web_servers(port)
+        return
+    httpd = make_server("", port, static_file_server,
+                        handler_class=QuietRequestHandler)
+    print "Now listening on port %d (web page only: the websocket " \
+          "needs gevent-websocket)" % port
+    httpd.serve_forever()
@@ -1,6 +1,11 @@
 import sys
 import os
 import glob
+import tempfile
+import json
+import time
+
+import gevent
 from xml.etree import cElementTree as ElementTree
 from xml.dom import minidom
 
@@ -24,8 +29,19 @@ from script import Block, Script
 from actor import Stage, Sprite, Project
 import factory
 import event_loop
+import block_compiler
+import script as script_module
 
 import ops
+import media
+import delta
+import tracing
+import trace_reader
+import concurrency
+import profiling
+import timers
+import workers
+import server
 
 sample_document = "sample_project_no_media.xml"
 all_xml_files = glob.glob('*.xml')
@@ -358,6 +374,38 @@ class PyInterpreterTestCase(unittest.TestCase):
         fn = ops.bind_to_function("nonexistentFunction")
         self.assertEquals(None, None, fn)
 
+    def test_block_registry(self):
+        """Blocks are found in a table, which other libraries can add to"""
+        from ops import utilities
+
+        self.assertTrue(ops.bind_to_function("doRepeat") is
+                        ops.control_blocks.doRepeat)
+        # modules the blocks import are not blocks
+        self.assertTrue(ops.bind_to_function("gevent") is None)
+        self.assertTrue(ops.bind_to_function("data") is None)
+
+        saved_registry = dict(utilities.registry)
+        saved_lazy_modules = dict(utilities.lazy_modules)
+        try:
+            ops.register_block("reportAnswer", lambda *args: Literal(42))
+            self.assertEqual(ops.bind_to_function("reportAnswer")(),
+                             Literal(42))
+
+            # A library that can't be imported is skipped, quietly
+            ops.register_module_lazily("no_such_hardware_library")
+            ops.register_module_lazily("colorsys", ["rgb_to_hsv"])
+            self.assertTrue(ops.bind_to_function("nonexistent") is None)
+            self.assertEqual(utilities.lazy_modules.keys(), ["colorsys"])
+            import colorsys
+            self.assertTrue(ops.bind_to_function("rgb_to_hsv") is
+                            colorsys.rgb_to_hsv)
+            self.assertEqual(utilities.lazy_modules, {})
+        finally:
+            utilities.registry.clear()
+            utilities.registry.update(saved_registry)
+            utilities.lazy_modules.clear()
+            utilities.lazy_modules.update(saved_lazy_modules)
+
     def test_script(self):
         """Runs a small script to see if it works.
 
@@ -430,6 +478,25 @@ class PyInterpreterTestCase(unittest.TestCase):
 
         self.do_test_using_factory(xml, "costumes.xml")
 
+    def test_lazy_costume_images(self):
+        """Costume images aren't decoded until they are used"""
+
+        xml = '<costume name="dot" center-x="0" center-y="0" ' \
+              'image="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAA' \
+              'AABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5E' \
+              'rkJggg==" id="3"/>'
+        costume = factory.deserialize_xml(xml)
+        self.assertFalse(costume.lazy_image.loaded)
+
+        # Saving it doesn't need it decoded, either
+        self.compare_xml(xml, factory.xml_for_object(costume),
+                         True, "lazy_costume.xml")
+        self.assertFalse(costume.lazy_image.loaded)
+
+        if media.pygame:
+            self.assertEqual(costume.image.get_size(), (1, 1))
+            self.assertTrue(costume.lazy_image.loaded)
+
     def test_empty_costumes(self):
 
         xml = """
@@ -730,6 +797,1063 @@ class PyInterpreterTestCase(unittest.TestCase):
             injection = {"start" : Literal(77), "depth": Literal(5)},
             post_check = {"result" : Literal(82)})
 
+    def test_deep_recursion(self):
+        """Custom blocks can recurse far deeper than Python can,
+        and tail calls see the same scripts as other calls do"""
+
+        # long_adder ends with 'report long_adder ...', a tail call
+        self.do_test_script(
+            "custom_recursive_block__long_adder.xml",
+            injection={"start": Literal(77), "depth": Literal(5000)},
+            post_check={"result": Literal(5077)})
+
+        def reportScriptDepth(target_actor, parent_script, args):
+            depth = 0
+            while parent_script:
+                depth += 1
+                parent_script = parent_script.parent_script
+            return Literal(depth)
+
+        ops.register_block("reportScriptDepth", reportScriptDepth)
+        try:
+            definitions = factory.deserialize_xml("""
+                <blocks>%s%s</blocks>""" % tuple(
+                """<block-definition s="%s %%'n'" type="reporter"
+                                     category="other">
+                    <inputs><input type="%%s"/></inputs>
+                    <script>
+                        <block s="doIf">
+                            <block s="reportEquals">
+                                <block var="n"/><l>0</l>
+                            </block>
+                            <script><block s="doReport">
+                                <block s="reportScriptDepth"/>
+                            </block></script>
+                        </block>
+                        <block s="doReport">%s</block>
+                    </script>
+                </block-definition>""" % (name, call) for name, call in (
+                    ("tail", """<custom-block s="tail %s">
+                        <block s="reportDifference">
+                            <block var="n"/><l>1</l>
+                        </block></custom-block>"""),
+                    ("nested", """<block s="reportSum"><l>0</l>
+                        <custom-block s="nested %s">
+                            <block s="reportDifference">
+                                <block var="n"/><l>1</l>
+                            </block></custom-block></block>"""))))
+        finally:
+            del ops.utilities.registry["reportScriptDepth"]
+
+        sprite = Sprite(None)
+        sprite.blocks = definitions
+        sprite.variables.add(Variable("depth", Literal(0)))
+        for name, expected_depth in (("tail", 3003), ("nested", 3003)):
+            test_script = factory.deserialize_xml("""
+                <script><block s="doSetVar"><l>depth</l>
+                    <custom-block s="%s %%s"><l>3000</l></custom-block>
+                </block></script>""" % name)
+            test_script.run(sprite)
+            # the script, the 3001 blocks that were called, and the 'if'
+            self.assertEqual(sprite.value_of_property("depth"),
+                             Literal(expected_depth))
+
+    def test_tail_call_scope(self):
+        """A custom block sees its caller's script variables whether it
+        was called by 'report' (a tail call) or otherwise"""
+
+        definitions = factory.deserialize_xml("""<blocks>
+            <block-definition s="peek" type="reporter" category="other">
+                <inputs/>
+                <script><block s="doReport"><block var="a"/></block></script>
+            </block-definition>%s%s</blocks>""" % tuple(
+            """<block-definition s="%s" type="reporter" category="other">
+                <inputs/>
+                <script>
+                    <block s="doDeclareVariables"><list><l>a</l></list></block>
+                    <block s="doSetVar"><l>a</l><l>5</l></block>
+                    <block s="doReport">%s</block>
+                </script>
+            </block-definition>""" % (name, call) for name, call in (
+                ("by tail call", '<custom-block s="peek"/>'),
+                ("by nested call", '<block s="reportSum"><l>0</l>'
+                 '<custom-block s="peek"/></block>'))))
+
+        sprite = Sprite(None)
+        sprite.blocks = definitions
+        sprite.variables.add(Variable("seen", Literal(0)))
+        for name in ("by tail call", "by nested call"):
+            test_script = factory.deserialize_xml("""
+                <script><block s="doSetVar"><l>seen</l>
+                    <custom-block s="%s"/>
+                </block></script>""" % name)
+            test_script.run(sprite)
+            self.assertEqual(
+                sprite.value_of_property("seen").as_number(), 5, name)
+
+    def test_compiled_script(self):
+        """Scripts are compiled when deserialized, comments and all"""
+
+        xml = """
+            <script>
+                <block s="doSetVar"><l>a</l>
+                    <block s="reportSum"><l>3</l><l>4</l></block>
+                    <comment w="90" collapsed="false">seven</comment>
+                </block>
+            </script>
+        """
+        script = factory.deserialize_xml(xml)
+        self.assertEqual(len(script.compiled), len(script.blocks))
+
+        sprite = Sprite(None)
+        sprite.variables.add(Variable("a", Literal(0)))
+        script.run(sprite)
+        self.assertEqual(sprite.value_of_property("a"), Literal(7))
+
+    def test_interpreted_scripts(self):
+        """The tree-walking interpreter is still available,
+        and gets the same results as the compiled code"""
+
+        block_compiler.enabled = False
+        try:
+            script = factory.deserialize_xml("<script/>")
+            self.assertEqual(script.compiled, None)
+
+            self.test_nested_repeat_block()
+            self.test_if_block()
+            self.test_calling_custom_reporter_block()
+        finally:
+            block_compiler.enabled = True
+
+    def test_fixed_pacing(self):
+        """Scripts can still be run one block at a time, as they used to"""
+
+        saved = script_module.pacing, script_module.fixed_pacing_delay
+        script_module.pacing = script_module.Pacing.fixed
+        script_module.fixed_pacing_delay = 0
+        try:
+            self.test_nested_repeat_block()
+            self.test_custom_recursive_block__long_adder()
+        finally:
+            script_module.pacing, script_module.fixed_pacing_delay = saved
+
+    def test_step_reports_loop_ends(self):
+        """Script.step tells the scheduler when a loop goes around"""
+
+        tree = ElementTree.parse("simple_repeat_loop.xml")
+        project = Project(None)
+        project.deserialize(tree.getroot())
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+
+        loop_ends = 0
+        try:
+            while True:
+                if test_script.step(sprite):
+                    loop_ends += 1
+        except StopIteration:
+            pass
+        self.assertEqual(loop_ends, 5)
+
+    def test_sleeping_script_index(self):
+        """Triggering a hat block only wakes the scripts waiting on it"""
+
+        loop = event_loop.EventLoop(None)
+        loop.project = factory.deserialize_file(sample_document, loop)
+        sleeping = loop.sleeping_scripts
+        total = len(sleeping)
+
+        self.assertEqual(sorted(sleeping.triggers("receiveMessage")),
+                         ["front left", "front right",
+                          "rear left", "rear right"])
+
+        loop.broadcast_message("front left")
+        self.assertEqual(len(sleeping), total - 1)
+        self.assertEqual(len(loop.active_scripts), 1)
+        self.assertEqual(sleeping.take("receiveMessage", "front left"), [])
+
+        # once it has run, the script goes back to sleep
+        loop.active_scripts.join()
+        self.assertEqual(len(sleeping), total)
+        self.assertEqual(len(sleeping.take("receiveMessage", "front left")),
+                         1)
+
+        loop.broadcast_message("nobody is listening")
+        self.assertEqual(len(sleeping), total - 1)
+
+    def test_threads_backend(self):
+        """Scripts, waits, and broadcasts work on threads, too"""
+
+        concurrency.use("threads")
+        try:
+            loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+            self.assertTrue(isinstance(loop.active_scripts,
+                                       concurrency.ThreadGroup))
+            loop.load_project_from_disk(sample_document)
+            sleeping = loop.sleeping_scripts
+            total = len(sleeping)
+
+            # (the script may be done before we can see it running)
+            loop.broadcast_message("front left")
+            self.assertTrue(loop.active_scripts.join(timeout=10))
+            self.assertEqual(len(sleeping), total)
+
+            waiter = factory.deserialize_xml("""<script>
+                <block s="doWait"><l>0.05</l></block></script>""")
+            task = concurrency.spawn(waiter.run, loop.project.stage)
+            loop.active_scripts.add(task)
+            self.assertEqual(len(loop.active_scripts), 1)
+            self.assertFalse(loop.active_scripts.join(timeout=0.01))
+            self.assertTrue(loop.active_scripts.join(timeout=10))
+            self.assertEqual(len(loop.active_scripts), 0)
+
+            # A script still running when the project is replaced (threads
+            # can't be killed) isn't queued up again in the new one
+            hat_script = factory.deserialize_xml("""<script>
+                <block s="receiveGo"/>
+                <block s="doWait"><l>0.05</l></block></script>""")
+            task = concurrency.spawn(loop.run_script, hat_script,
+                                     loop.project.stage,
+                                     loop.script_generation)
+            loop.load_project_from_disk(sample_document)
+            task.join(10)
+            self.assertEqual(len(loop.sleeping_scripts), total)
+        finally:
+            concurrency.use("gevent")
+
+    def test_outbox(self):
+        """Messages to web clients from other threads are sent on the
+        web server's thread"""
+
+        import threading
+        outbox = server.Outbox()
+        started = threading.Event()
+        done = threading.Event()
+
+        def serve():
+            outbox.start()
+            started.set()
+            while not done.is_set():
+                gevent.sleep(0.01)
+
+        sent = []
+
+        class FakeWebSocket(object):
+            def send(self, message):
+                sent.append((message, threading.current_thread()))
+
+        server_thread = threading.Thread(target=serve)
+        server_thread.start()
+        try:
+            self.assertTrue(started.wait(10))
+            outbox.send(FakeWebSocket(), "hello")
+            deadline = time.time() + 10
+            while not sent and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            done.set()
+            server_thread.join(10)
+        self.assertEqual(sent, [("hello", server_thread)])
+
+    def test_timer_wheel(self):
+        """Waits are filed in the wheel's levels, and come due on time"""
+
+        wheel = timers.TimerWheel()
+        dues = [1, 63, 64, 65, 100, 4095, 4096, 5000, 300000]
+        alarms = dict((due, wheel.schedule(due)) for due in dues)
+        self.assertTrue(wheel.schedule(100) is alarms[100])
+        for alarm in alarms.values():
+            alarm.waiters = 1
+            wheel.waiting += 1
+
+        for target in dues:
+            # pretend that 'target' ticks have passed
+            wheel.start = time.time() - (target + 0.5) * timers.tick
+            wheel.advance()
+            self.assertEqual(
+                sorted(due for due, alarm in alarms.items()
+                       if alarm.event.is_set()),
+                [due for due in dues if due <= target])
+        self.assertEqual(wheel.waiting, 0)
+        self.assertEqual(wheel.alarms, len(dues))
+
+    def test_waiting_scripts_share_alarms(self):
+        """Scripts that wait for the same time are woken together"""
+
+        timers.wheel = None
+        start = time.time()
+        gevent.joinall([gevent.spawn(timers.wait, 0.05)
+                        for i in range(200)])
+        self.assertTrue(0.05 <= time.time() - start < 1)
+        stats = timers.get_wheel().stats()
+        self.assertEqual((stats["waits"], stats["waiting"]), (200, 0))
+        self.assertTrue(stats["alarms"] <= 3)
+
+    def test_long_and_stopped_waits(self):
+        """The wheel sleeps until something is due, wakes sooner for a
+        shorter wait, and stops when the waiting scripts are killed"""
+
+        timers.wheel = None
+        wheel = timers.get_wheel()
+        long_waits = [gevent.spawn(timers.wait, 60) for i in range(50)]
+        gevent.sleep(0.01)
+        self.assertEqual(wheel.waiting, 50)
+
+        start = time.time()
+        timers.wait(0.05)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(wheel.wakeups <= 3)
+
+        gevent.killall(long_waits)
+        self.assertEqual(wheel.waiting, 0)
+        gevent.sleep(0.01)
+        self.assertTrue(wheel.ticker is None)
+
+    def test_frame_pacer(self):
+        """Frames sleep only for what is left of them, and drop frames
+        they overrun rather than catching up"""
+
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        self.assertRaises(ValueError, event_loop.FramePacer, 0)
+        self.assertRaises(ValueError, event_loop.FramePacer, -30)
+        pacer = event_loop.FramePacer(10, clock=lambda: now[0], sleep=sleep)
+        pacer.wait()  # the first frame
+        now[0] += 0.03  # a 30 ms frame
+        pacer.wait()
+        self.assertAlmostEqual(sleeps[-1], 0.07)
+        self.assertAlmostEqual(now[0], 0.2)
+
+        now[0] += 0.35  # 250 ms late: two frames are dropped
+        pacer.wait()
+        self.assertEqual(sleeps[-1], 0)
+        now[0] += 0.01  # the next frames are timed from then
+        pacer.wait()
+        self.assertAlmostEqual(sleeps[-1], 0.09)
+
+        stats = pacer.stats()
+        self.assertEqual((stats["frames"], stats["late_frames"],
+                          stats["dropped_frames"]), (4, 1, 2))
+        self.assertAlmostEqual(stats["p95_ms"], 350)
+        self.assertAlmostEqual(stats["mean_ms"], 162.5)
+        self.assertAlmostEqual(stats["work_ms"], 97.5)
+
+    def test_worker_processes(self):
+        """Sprites can run on worker processes, which share broadcasts,
+        global variables, and how the sprites look"""
+
+        sprite = """<sprite name="Sprite%(idx)d" idx="%(idx)d" x="0"
+            y="0" heading="90" scale="1" rotation="1" draggable="true"
+            costume="0" color="80,80,80" pen="tip" id="%(idx)d">
+            <variables></variables><blocks></blocks>
+            <scripts><script>%(script)s</script></scripts></sprite>"""
+        sender = """<block s="receiveGo"/>
+            <block s="doSetVar"><l>count</l><l>5</l></block>
+            <block s="doBroadcast"><l>ping</l></block>"""
+        receiver = """<block s="receiveMessage"><l>ping</l></block>
+            <block s="setXPosition"><block var="count"/></block>
+            <block s="doSetVar"><l>result</l><l>7</l></block>"""
+        project = factory.deserialize_xml(
+            """<project name="workers" app="Snap! 4.0" version="1">
+            <stage name="Stage" width="480" height="360" costume="0"
+            tempo="60" threadsafe="false" lines="round" codify="false"
+            scheduled="false" id="1"><variables></variables><blocks></blocks><scripts></scripts>
+            <sprites>%s%s</sprites></stage><blocks></blocks>
+            <variables><variable name="count"><l>0</l></variable>
+            <variable name="result"><l>0</l></variable></variables>
+            </project>""" % (sprite % {"idx": 1, "script": sender},
+                             sprite % {"idx": 2, "script": receiver}),
+            None)
+        self.assertEqual(workers.partition(project.all_actors(), 2),
+                         [[0, 1], [2]])
+
+        loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+        loop.workers = workers.WorkerPool(2)
+        try:
+            loop.start_project(project)
+            loop.trigger_green_flag()
+            result = project.variables.get_variable("result")
+            with gevent.Timeout(20):
+                while result.value().as_number() != 7:
+                    gevent.sleep(0.05)
+        finally:
+            loop.workers.stop()
+        self.assertEqual(project.stage.sprites[1].draw_state()[:2], (5, 0))
+        self.assertEqual(
+            project.variables.get_variable("count").value().as_number(), 5)
+        self.assertEqual(len(loop.active_scripts), 0)  # none ran here
+
+    def test_worker_increments_and_deltas(self):
+        """Changes to a global on several workers add up, and edits reach
+        the workers without restarting them"""
+
+        sprite = """<sprite name="Sprite%(idx)d" idx="%(idx)d" x="0"
+            y="0" heading="90" scale="1" rotation="1" draggable="true"
+            costume="0" color="80,80,80" pen="tip" id="%(idx)d">
+            <variables></variables><blocks></blocks>
+            <scripts>%(scripts)s</scripts></sprite>"""
+        counter = """<script><block s="receiveGo"/>
+            <block s="doRepeat"><l>500</l><script>
+                <block s="doChangeVar"><l>count</l><l>1</l></block>
+            </script></block></script>"""
+        receiver = """<script><block s="receiveMessage"><l>ping</l></block>
+            <block s="doSetVar"><l>result</l><l>7</l></block></script>"""
+        project = factory.deserialize_xml(
+            """<project name="workers" app="Snap! 4.0" version="1">
+            <stage name="Stage" width="480" height="360" costume="0"
+            tempo="60" threadsafe="false" lines="round" codify="false"
+            scheduled="false" id="1"><variables></variables><blocks></blocks><scripts></scripts>
+            <sprites>%s%s</sprites></stage><blocks></blocks>
+            <variables><variable name="count"><l>0</l></variable>
+            <variable name="result"><l>0</l></variable></variables>
+            </project>""" % (sprite % {"idx": 1, "scripts": counter},
+                             sprite % {"idx": 2,
+                                       "scripts": counter + receiver}),
+            None)
+        set_result = project.stage.sprites[1].scripts[1].blocks[1]
+
+        def wait_for(name, value):
+            variable = project.variables.get_variable(name)
+            with gevent.Timeout(20):
+                while variable.value().as_number() != value:
+                    gevent.sleep(0.05)
+
+        loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+        loop.workers = workers.WorkerPool(2)
+        try:
+            loop.start_project(project)
+            processes = [worker.process for worker in loop.workers.workers]
+            loop.trigger_green_flag()
+            wait_for("count", 1000)
+
+            loop.message_from_client(
+                'project_delta <delta><set-argument block="%s" index="1">'
+                '<l>9</l></set-argument></delta>' % set_result.uuid, None)
+            self.assertEqual(
+                [worker.process for worker in loop.workers.workers],
+                processes)
+            loop.broadcast_message("ping")
+            wait_for("result", 9)
+
+            # A worker that can't make an edit is restarted
+            loop.workers.apply_delta(
+                '<delta><delete-block block="no-such-block"/></delta>')
+            with gevent.Timeout(20):
+                while set(worker.process for worker
+                          in loop.workers.workers) & set(processes):
+                    gevent.sleep(0.05)
+            self.assertEqual(len(loop.workers.workers), 2)
+            loop.message_from_client(
+                'project_delta <delta><set-argument block="%s" index="1">'
+                '<l>11</l></set-argument></delta>' % set_result.uuid, None)
+            loop.broadcast_message("ping")
+            wait_for("result", 11)
+        finally:
+            loop.workers.stop()
+
+    def test_headless_media_environment(self):
+        """Projects run without a display, and still respond to keys"""
+
+        headless = media.HeadlessMediaEnvironment()
+        loop = event_loop.EventLoop(headless)
+        loop.load_project_from_disk(sample_document)
+        sprite = loop.project.stage.sprites[0]
+        sprite.costume = 1
+
+        headless.queue_key_press("space")
+        headless.check_for_events(loop)
+        loop.active_scripts.join()
+        headless.draw(loop.project)
+
+        self.assertEqual(sprite.costume, 2)
+        self.assertEqual(headless.frames, 1)
+
+    def test_dirty_rect_drawing(self):
+        """Only the parts of the screen that change are redrawn"""
+
+        if "SDL_VIDEODRIVER" not in os.environ:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            self.addCleanup(os.environ.pop, "SDL_VIDEODRIVER", None)
+        screen = media.PyGameMediaEnvironment()
+        project = factory.deserialize_file(sample_document, None)
+        screen.setup_for_project(project)
+
+        screen.draw(project)
+        self.assertEqual((screen.frames_drawn, screen.frames_skipped), (1, 0))
+
+        # Nothing changed, so nothing is drawn
+        screen.draw(project)
+        self.assertEqual((screen.frames_drawn, screen.frames_skipped), (1, 1))
+
+        # Moving a sprite redraws where it was and where it is now
+        sprite = project.stage.sprites[1]
+        old_rects = screen.drawn_rects[sprite]
+        sprite.move_forward(10)
+        screen.draw(project)
+        self.assertEqual((screen.frames_drawn, screen.frames_skipped), (2, 1))
+        self.assertEqual(screen.updated_rects,
+                         old_rects + screen.drawn_rects[sprite])
+
+    def test_image_cache(self):
+        """The image cache forgets the least recently used images first"""
+
+        cache = media.ImageCache(max_bytes=100)
+        cache.put("a", "image a", 40)
+        cache.put("b", "image b", 40)
+        self.assertEqual(cache.get("a"), "image a")  # 'b' is now oldest
+
+        cache.put("c", "image c", 40)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), "image c")
+        self.assertEqual(cache.get("a"), "image a")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (3, 1, 1))
+        self.assertEqual(cache.bytes_used, 80)
+
+        # Images that don't fit are not cached at all
+        cache.put("huge", "huge image", 1000)
+        self.assertEqual(len(cache), 2)
+
+    def test_project_deltas(self):
+        """Small edits can be made to a project without reloading it"""
+
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+        set_block, repeat_block = test_script.blocks[1:3]
+        change_block = repeat_block.arguments[1].blocks[0]
+
+        def apply(edits):
+            return delta.apply_delta(project, "<delta>%s</delta>" % edits)
+
+        def count_after_running():
+            test_script.from_start().run(sprite)
+            return test_script.value_of_variable(sprite, "count")
+
+        apply('<set-argument block="%s" index="0"><l>7</l></set-argument>'
+              % repeat_block.uuid)
+        self.assertEqual(count_after_running(), Literal(7))
+
+        new_uuid = "4ba7e4c6-5d35-11e4-8d4c-3c15c2d9c5a0"
+        changes = apply(
+            '<insert-block after="%s">'
+            '<block s="doChangeVar" uuid="%s"><l>count</l><l>2</l></block>'
+            '</insert-block>' % (change_block.uuid, new_uuid))
+        self.assertEqual(changes.edited_scripts, set([(test_script, sprite)]))
+        self.assertEqual(count_after_running(), Literal(21))
+
+        apply('<delete-block block="%s"/>' % new_uuid)
+        self.assertEqual(count_after_running(), Literal(7))
+
+        # Moving the 'set' block to its own script removes it from this one
+        changes = apply('<move-block block="%s" x="0" y="0"/>'
+                        % set_block.uuid)
+        self.assertEqual(len(changes.added_scripts), 1)
+        self.assertEqual(len(sprite.scripts), 3)
+        self.assertEqual(count_after_running(), Literal(14))
+
+        apply('<set-property sprite="%s" name="@x"><l>42</l></set-property>'
+              '<set-variable name="level"><l>3</l></set-variable>'
+              % sprite.name)
+        self.assertEqual(sprite.value_of_property("@x"), Literal(42))
+        self.assertEqual(project.get_variable("level").value(), Literal(3))
+
+        self.assertRaises(delta.DeltaError, apply,
+                          '<delete-block block="no-such-block"/>')
+
+    def test_bad_deltas_lose_nothing(self):
+        """A block can't be moved into itself (but can stay beside
+        itself), and a delta that fails part way sends every client the
+        whole project"""
+
+        class FakeWebSocket(object):
+            def __init__(self):
+                self.sent = []
+
+            def send(self, message):
+                self.sent.append(message)
+
+        class FakeClient(object):
+            def __init__(self):
+                self.ws = FakeWebSocket()
+
+        loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+        sender = FakeClient()
+        loop.message_from_client("project_delta <delta/>", sender)
+        self.assertRaises(delta.DeltaError, delta.apply_delta, None,
+                          "<delta/>")
+
+        loop.load_project_from_disk("simple_repeat_loop.xml")
+        test_script = loop.project.stage.sprites[0].scripts[0]
+        repeat_block = test_script.blocks[2]
+        change_block = repeat_block.arguments[1].blocks[0]
+        blocks = list(test_script.blocks)
+        for where in ('parent="%s" slot="1"' % repeat_block.uuid,
+                      'after="%s"' % change_block.uuid):
+            self.assertRaises(
+                delta.DeltaError, delta.apply_delta, loop.project,
+                '<delta><move-block block="%s" %s/></delta>'
+                % (repeat_block.uuid, where))
+            self.assertEqual(test_script.blocks, blocks)
+        for where in ("after", "before"):
+            delta.apply_delta(
+                loop.project, '<delta><move-block block="%s" %s="%s"/>'
+                '</delta>' % (repeat_block.uuid, where, repeat_block.uuid))
+            self.assertEqual(test_script.blocks, blocks)
+
+        other = FakeClient()
+        loop.clients = [sender, other]
+        loop.message_from_client(
+            'project_delta <delta><delete-block block="no-such-block"/>'
+            '</delta>', sender)
+        self.assertEqual(len(sender.ws.sent), 1)
+        self.assertEqual(other.ws.sent, [])
+
+        loop.message_from_client(
+            'project_delta <delta>'
+            '<set-argument block="%s" index="0"><l>7</l></set-argument>'
+            '<delete-block block="no-such-block"/></delta>'
+            % repeat_block.uuid, sender)
+        for client in (sender, other):
+            self.assertTrue(client.ws.sent[-1].startswith("load_project "))
+
+    def test_deltas_missing_attributes(self):
+        """An edit without an attribute it needs is a DeltaError"""
+
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        repeat_block = project.stage.sprites[0].scripts[0].blocks[2]
+        for edit, missing in (
+                ('<set-argument block="%s"><l>7</l></set-argument>'
+                 % repeat_block.uuid, "'index'"),
+                ('<set-argument block="%s" index="seven"><l>7</l>'
+                 '</set-argument>' % repeat_block.uuid, "'index'"),
+                ('<set-argument block="%s" index="9"><l>7</l></set-argument>'
+                 % repeat_block.uuid, "argument 9"),
+                ('<set-argument index="0"><l>7</l></set-argument>',
+                 "'block'"),
+                ('<set-property><l>7</l></set-property>', "'name'"),
+                ('<set-variable><l>7</l></set-variable>', "'name'"),
+                ('<move-block x="0" y="0"/>', "'block'"),
+                ('<delete-block/>', "'block'"),
+                ('<delete-definition/>', "'s'")):
+            try:
+                delta.apply_delta(project, "<delta>%s</delta>" % edit)
+            except delta.DeltaError as e:
+                self.assertIn(missing, str(e))
+            else:
+                self.fail("%s should have failed" % edit)
+        self.assertEqual(repeat_block.arguments[0], Literal(5))
+
+    def test_tracing(self):
+        """Blocks that run are recorded in memory and in a trace file"""
+
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+
+        handle, filename = tempfile.mkstemp(suffix=".trace")
+        os.close(handle)
+        os.unlink(filename)
+        try:
+            recorder = tracing.start(capacity=5, filename=filename)
+            test_script.from_start().run(sprite)
+            block_compiler.enabled = False
+            try:
+                test_script.compile()
+                test_script.from_start().run(sprite)
+            finally:
+                block_compiler.enabled = True
+                test_script.compile()
+            tracing.stop()
+            self.assertTrue(tracing.recorder is None)
+
+            # Only the most recent records are kept in memory
+            self.assertEqual(len(recorder.records), 5)
+            self.assertEqual(recorder.count % 2, 0)  # each run is the same
+
+            # ... but all of them go to the file
+            records = list(tracing.read_trace(filename))
+            self.assertEqual(len(records), recorder.count)
+            self.assertEqual(str(records[-1]), str(recorder.records[-1]))
+            changes = list(trace_reader.filter_records(
+                records, sprite=sprite.name, function_name="doChangeVar"))
+            self.assertEqual(len(changes), 10)  # 5 times, in each run
+            self.assertEqual(changes[0].args, ["count", "1"])
+            self.assertEqual(changes[0].uuid, changes[-1].uuid)
+
+            # The log is flushed as it goes, not just when tracing stops
+            os.unlink(filename)
+            records_per_flush = tracing.records_per_flush
+            tracing.records_per_flush = 3
+            try:
+                recorder = tracing.start(filename=filename)
+                test_script.from_start().run(sprite)
+                flushed = len(list(tracing.read_trace(filename)))
+                self.assertEqual(flushed, recorder.count - recorder.count % 3)
+                tracing.flush()
+                flushed = len(list(tracing.read_trace(filename)))
+                self.assertEqual(flushed, recorder.count)
+            finally:
+                tracing.records_per_flush = records_per_flush
+        finally:
+            tracing.stop()
+            os.unlink(filename)
+
+        # Names can be byte strings (UTF-8) or unicode
+        record = tracing.TraceRecord(
+            0, None, "Sp\xc3\xa9cial", "doSayFor", [u"h\xe9llo", "2"],
+            u"\u263a")
+        self.assertEqual(
+            str(record).decode("utf-8"),
+            u"0.000000 None Sp\xe9cial: doSayFor(h\xe9llo, 2) -> \u263a")
+
+    def test_profiler(self):
+        """The profiler counts the blocks that run, and samples the stack
+        of blocks (custom blocks included) that is running"""
+
+        project = factory.deserialize_file(
+            "custom_recursive_block__fib.xml", None)
+        sprite = project.stage.sprites[0]
+        project.variables.get_variable("input").set(Literal(15))
+
+        class FakeWebSocket(object):
+            def __init__(self):
+                self.sent = []
+
+            def send(self, message):
+                self.sent.append(message)
+
+        class FakeClient(object):
+            ws = FakeWebSocket()
+
+        loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+        client = FakeClient()
+        for bad_interval in ("soon", "-5", "nan"):
+            loop.message_from_client("profile_start %s" % bad_interval,
+                                     client)
+            self.assertEqual(loop.profile.interval,
+                             profiling.default_interval)
+            loop.message_from_client("profile_stop", client)
+
+        loop.message_from_client("profile_start 1", client)
+        try:
+            self.assertTrue(tracing.recorder is profiling.profiler)
+            sprite.scripts[0].run(sprite)
+        finally:
+            loop.message_from_client("profile_stop", client)
+        self.assertEqual(tracing.recorder, None)
+        self.assertEqual(profiling.profiler, None)
+        self.assertEqual(project.variables.get_variable("result").contents,
+                         Literal(610))
+
+        # fib(15) calls fib 1973 times, in all
+        command, payload = client.ws.sent[-1].split(" ", 1)
+        self.assertEqual(command, "profile_report")
+        report = json.loads(payload)
+        self.assertEqual(report["definitions"]["fib %'n'"]["calls"], 1973)
+        self.assertEqual(report["functions"]["fib %s"]["calls"], 1973)
+        self.assertTrue(report["blocks_ms"] > 0)
+        self.assertTrue(report["sprites"]["Sprite"]["total_ms"] > 0)
+
+        # The stacks go all the way down, through each recursive call
+        for line in loop.profile.collapsed().splitlines():
+            self.assertTrue(line.startswith("Sprite;doSetVar;fib %s"))
+        self.assertTrue("fib %s;doReport;reportSum;fib %s" in
+                        loop.profile.collapsed())
+
+        # With threads, the signal wouldn't see the scripts; we say so
+        concurrency.use("threads")
+        try:
+            loop.message_from_client("profile_start", client)
+        finally:
+            concurrency.use("gevent")
+        self.assertTrue(client.ws.sent[-1].startswith("profile_error "))
+        self.assertEqual(tracing.recorder, None)
+        self.assertEqual(profiling.profiler, None)
+
+    def test_static_file_cache(self):
+        """Static files are served from memory, gzipped, with ETags"""
+
+        self.addCleanup(setattr, server, "web_root", server.web_root)
+        server.web_root = os.path.join("..", "web")
+        server.static_file_cache.clear()
+        responses = []
+
+        def get(path, **headers):
+            environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET"}
+            environ.update(headers)
+            body = server.static_file_server(
+                environ, lambda status, headers: responses.append(
+                    (status, dict(headers))))
+            return "".join(body)
+
+        original = open(os.path.join("..", "web", "morphic.js"), "rb").read()
+        self.assertEqual(get("/morphic.js"), original)
+        status, headers = responses[-1]
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Type"], "application/javascript")
+        self.assertEqual(headers["Content-Length"], str(len(original)))
+
+        body = get("/morphic.js", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        status, headers = responses[-1]
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertTrue(len(body) < len(original))
+        self.assertEqual(server.static_file_cache.hits, 1)
+
+        self.assertEqual(get("/morphic.js",
+                             HTTP_ACCEPT_ENCODING="gzip;q=0, deflate"),
+                         original)
+        self.assertFalse("Content-Encoding" in responses[-1][1])
+        self.assertTrue(server.accepts_gzip("deflate, *;q=0.5"))
+        self.assertFalse(server.accepts_gzip("identity"))
+
+        self.assertEqual(get("/morphic.js",
+                             HTTP_IF_NONE_MATCH=headers["ETag"]), "")
+        self.assertEqual(responses[-1][0], "304 Not Modified")
+
+        get("/no-such-file.js")
+        self.assertEqual(responses[-1][0], "404 Not Found")
+
+    def test_local_names_from_threads(self):
+        """Names declared on several threads all count"""
+
+        import threading
+        before = script_module.local_names_generation
+
+        def declare(thread):
+            for i in range(500):
+                script_module.declare_local_variable_name(
+                    "thread %d name %d" % (thread, i))
+
+        threads = [threading.Thread(target=declare, args=(thread,))
+                   for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(script_module.local_names_generation - before, 4000)
+
+    def test_variable_slots(self):
+        """Compiled blocks remember where they found their variables"""
+
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+        slot = block_compiler.VariableSlot("slot test")
+
+        self.assertTrue(slot.find(sprite, test_script) is None)
+        project.variables.add(Variable("slot test", Literal(1)))
+        self.assertEqual(slot.find(sprite, test_script).value(), Literal(1))
+
+        # A sprite variable hides the global one...
+        sprite.variables.add(Variable("slot test", Literal(2)))
+        self.assertEqual(slot.find(sprite, test_script).value(), Literal(2))
+
+        # ...and a script variable hides both
+        names = List()
+        names.list = [Literal("slot test")]
+        ops.variable_blocks.doDeclareVariables(sprite, test_script, [names])
+        self.assertTrue(slot.find(sprite, test_script) is
+                        test_script.variables.get_variable("slot test"))
+
+    def test_compiled_arithmetic(self):
+        """Nested arithmetic blocks pass plain numbers to each other"""
+
+        self.assertEqual(Literal("12").number, 12.0)
+        self.assertEqual(Literal(True).number, 1.0)
+        self.assertTrue(Literal("twelve").number is None)
+        self.assertEqual(Literal("twelve").as_number(), 0)
+
+        # (a * 2) + (a - 0.5)
+        block = factory.deserialize_value(ElementTree.XML(
+            '<block s="reportSum">'
+            '<block s="reportProduct"><block var="a"/><l>2</l></block>'
+            '<block s="reportDifference"><block var="a"/><l>0.5</l></block>'
+            '</block>'))
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        sprite = project.stage.sprites[0]
+        sprite.variables.add(Variable("a", Literal("3")))
+        evaluate = block.compile()
+
+        self.assertEqual(evaluate(sprite, sprite.scripts[0]), Literal(8.5))
+        self.assertEqual(block.evaluate(sprite, sprite.scripts[0]),
+                         Literal(8.5))
+
+        # Every block is still traced
+        recorder = tracing.start()
+        try:
+            evaluate(sprite, sprite.scripts[0])
+        finally:
+            tracing.stop()
+        self.assertEqual([(r.function_name, r.result)
+                          for r in recorder.records],
+                         [("var", "3"), ("reportProduct", "6"),
+                          ("var", "3"), ("reportDifference", "2.5"),
+                          ("reportSum", "8.5")])
+
+    def test_compact_objects(self):
+        """Blocks, literals, and scripts have no per-object dictionaries,
+        and scripts only make variables when they need them"""
+
+        project = factory.deserialize_file("simple_repeat_loop.xml", None)
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+        for item in (test_script, test_script.blocks[0], Literal(1),
+                     Variable("a", Literal(1))):
+            self.assertFalse(hasattr(item, "__dict__"))
+
+        copy = test_script.parallel_copy()
+        self.assertTrue(copy._variables is None)
+        self.assertTrue(copy.get_variable(sprite, "count") is
+                        project.get_variable("count"))
+        self.assertTrue(copy._variables is None)
+        copy.variables.add(Variable("count", Literal(5)))
+        self.assertEqual(copy.value_of_variable(sprite, "count"), Literal(5))
+
+    def test_loop_frames_are_reused(self):
+        """Loops start their nested script over, rather than copying it,
+        but script variables declared in a loop are still new each time"""
+
+        xml = """
+            <sprite name="Sprite" idx="1" x="0" y="0" heading="90" scale="1"
+                    rotation="1" draggable="true" costume="0" id="8">
+                <variables>
+                    <variable name="total"><l>0</l></variable>
+                </variables>
+                <scripts>
+                    <script>
+                        <block s="doRepeat"><l>3</l><script>
+                            <block s="doDeclareVariables">
+                                <list><l>frame test</l></list>
+                            </block>
+                            <block s="doChangeVar"><l>frame test</l><l>1</l>
+                            </block>
+                            <block s="doChangeVar"><l>total</l>
+                                <block var="frame test"/>
+                            </block>
+                        </script></block>
+                    </script>
+                </scripts>
+            </sprite>"""
+        sprite = Sprite(None)
+        sprite.deserialize(ElementTree.XML(xml))
+        test_script = sprite.scripts[0]
+        loop_body = test_script.blocks[0].arguments[1]
+
+        test_script.run(sprite)
+        self.assertEqual(test_script.value_of_variable(sprite, "total"),
+                         Literal(3))
+        self.assertEqual(test_script.frames.keys(), [loop_body])
+        frame = test_script.frames[loop_body]
+
+        test_script.from_start().run(sprite)
+        self.assertEqual(test_script.value_of_variable(sprite, "total"),
+                         Literal(6))
+        self.assertTrue(test_script.frames[loop_body] is frame)
+
+    def test_streaming_project_load(self):
+        """Projects read as a stream match those read all at once"""
+
+        class QueueRecorder(object):
+            def __init__(self):
+                self.queued = []
+
+            def queue(self, script, actor):
+                self.queued.append((actor, script))
+
+            def names(self):
+                return [(actor.name, script.x, script.y)
+                        for actor, script in self.queued]
+
+        for filename in ("sample_project.xml", "simple_repeat_loop.xml"):
+            streamed_loop, tree_loop = QueueRecorder(), QueueRecorder()
+            streamed = factory.deserialize_file(filename, streamed_loop)
+            whole = factory.deserialize_value(
+                ElementTree.parse(filename).getroot(), tree_loop)
+            self.assertEqual(
+                factory.xml_for_object(streamed, only_source_uuids=True),
+                factory.xml_for_object(whole, only_source_uuids=True))
+            self.assertEqual(streamed_loop.names(), tree_loop.names())
+            self.assertTrue(streamed.event_loop is streamed_loop)
+            for sprite in streamed.all_actors()[1:]:
+                self.assertTrue(sprite.project is streamed)
+
+    def test_background_project_loading(self):
+        """Projects sent by clients load on a worker thread, and only the
+        most recently sent one is kept"""
+
+        loop = event_loop.EventLoop(media.HeadlessMediaEnvironment())
+        with open("simple_repeat_loop.xml") as f:
+            first_xml = f.read()
+        with open(sample_document) as f:
+            second_xml = f.read()
+
+        ticks = []
+
+        def ticker():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0)
+        ticking = gevent.spawn(ticker)
+
+        first = gevent.spawn(loop.load_project_from_xml, first_xml)
+        second = gevent.spawn(loop.load_project_from_xml, second_xml)
+        gevent.joinall([first, second])
+        ticking.kill()
+
+        self.assertFalse(first.value)  # overtaken by the second project
+        self.assertTrue(second.value)
+        self.assertTrue(ticks)  # other greenlets ran during the load
+        self.assertEqual(loop.project.name, "copter")
+        self.assertTrue(loop.project.event_loop is loop)
+        self.assertEqual(
+            len(loop.sleeping_scripts),
+            sum(len(actor.scripts) for actor in loop.project.all_actors()))
+
+    def test_block_definition_deltas(self):
+        """Custom blocks find sprite definitions before project ones, and
+        notice when definitions are sent over the wire"""
+
+        project = factory.deserialize_file(
+            "simple_custom_reporter_block.xml", None)
+        sprite = project.stage.sprites[0]
+        test_script = sprite.scripts[0]
+        custom_block = test_script.blocks[0].arguments[1]
+
+        def result():
+            test_script.from_start().run(sprite)
+            return test_script.value_of_variable(sprite, "result")
+
+        def apply(edits):
+            return delta.apply_delta(project, "<delta>%s</delta>" % edits)
+
+        self.assertEqual(result(), Literal(12))
+        definition = project.blocks.find_block_definition("add %s to %s")
+        self.assertEqual(custom_block.binding[2:],
+                         (definition, definition.run))
+
+        # The sprite's own definition multiplies instead
+        specification = "add %'a' to %'b'"
+        apply("""<set-definition sprite="Sprite">
+                 <block-definition s="%s" type="reporter" category="other">
+                     <inputs><input type="%%s"/><input type="%%s"/></inputs>
+                     <script><block s="doReport"><block s="reportProduct">
+                         <block var="a"/><block var="b"/>
+                     </block></block></script>
+                 </block-definition></set-definition>""" % specification)
+        self.assertEqual(result(), Literal(35))
+
+        apply('<delete-definition sprite="Sprite" s="%s"/>' % specification)
+        self.assertEqual(result(), Literal(12))
+        self.assertRaises(delta.DeltaError, apply,
+                          '<delete-definition sprite="Sprite" s="%s"/>'
+                          % specification)
+
     def test_simple_custom_command__glide_in_square(self):
         """Makes a sprite glide around in a square"""
 
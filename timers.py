@@ -0,0 +1,228 @@
+"""timers.py wakes up the scripts that are waiting (in 'wait', 'say for',
+and so on), in batches.
+
+When every waiting script slept on a timer of its own, hundreds of
+sprites each waiting 0.1 seconds meant hundreds of timers, and hundreds
+of separate wake-ups.  Instead, time is cut into ticks, and the scripts
+due to wake on the same tick wait on the same Wakeup (see concurrency.py),
+which wakes them all at once:
+
+    timers.wait(0.1)
+
+The ticks are kept in a hierarchical timer wheel: 64 slots of one tick
+each, then 64 slots of 64 ticks, and so on, four levels deep.  A wait is
+filed in the level that its time falls in, so scheduling one costs the
+same however many are waiting.  Each time the lowest level goes around,
+the next level's current slot is moved down, nearer its time (and so on
+up the levels), and the events in the lowest level's slot for the tick
+are set.
+
+One task (a greenlet or a thread, see concurrency.py) turns the wheel,
+while anyone is waiting.  It sleeps until the earliest tick that
+something is due on (a wait for a minute costs one wake-up, not one a
+tick), and is woken sooner if a script files a wait due before then.
+It doesn't use the frame loop, as frames are too far apart for short
+waits, and not every event loop draws frames.
+A script wakes up to one tick late (plus however long the other scripts
+take to let it run); stats() says how late the ticks have been.
+"""
+
+import heapq
+import math
+import time
+from collections import deque
+
+import concurrency
+
+# Seconds per tick: waits are rounded up to a whole number of ticks
+tick = 0.005
+
+# Each level of the wheel has 2 ** slot_bits slots
+slot_bits = 6
+levels = 4
+
+
+class Alarm(object):
+
+    """The event that the scripts waiting for a tick are waiting on"""
+
+    __slots__ = ("event", "waiters")
+
+    def __init__(self):
+        self.event = concurrency.Wakeup()
+        self.waiters = 0
+
+
+class TimerWheel(object):
+
+    """Wakes up waiting scripts, a tick's worth at a time"""
+
+    def __init__(self, window=1000):
+        self.backend = concurrency.backend  # events only work with it
+        self.start = time.time()
+        self.current = 0  # the last tick we have dealt with
+        self.slots = [[{} for i in range(1 << slot_bits)]
+                      for level in range(levels)]  # due tick -> [Alarm]
+        self.lock = concurrency.Lock()
+        self.ticker = None  # the task turning the wheel
+        self.alarm_clock = concurrency.Event()  # wakes the ticker early
+        self.wake_at = None  # the tick the sleeping ticker wakes on
+        self.dues = []  # a heap of the ticks that alarms are filed for
+        self.last_due = self.last_alarm = None  # the last alarm filed
+        self.waiting = 0
+        self.waits = 0
+        self.alarms = 0  # how many times we have woken scripts up
+        self.wakeups = 0  # how many times the ticker has woken up
+        self.lateness = deque(maxlen=window)  # in seconds, per alarm
+
+    def wait(self, seconds):
+        """Returns once the seconds have passed (to within a tick)"""
+        now = time.time()
+        with self.lock:
+            if self.waiting == 0:
+                # Nobody is waiting on the alarms still filed (if any),
+                # so they can go, and the wheel can skip the ticks that
+                # passed while nobody was waiting
+                self.clear()
+                self.current = max(self.current,
+                                   int((now - self.start) / tick))
+            due = max(int(math.ceil((now + seconds - self.start) / tick)),
+                      self.current + 1)
+            if due == self.last_due:
+                alarm = self.last_alarm  # most waits are due together
+            else:
+                alarm = self.schedule(due)
+                self.last_due, self.last_alarm = due, alarm
+            alarm.waiters += 1
+            self.waiting += 1
+            self.waits += 1
+            if self.ticker is None:
+                self.ticker = concurrency.spawn(self.run)
+            elif self.wake_at is not None and due < self.wake_at:
+                self.wake_at = None
+                self.alarm_clock.set()
+        try:
+            alarm.event.wait()
+        finally:
+            with self.lock:
+                if not alarm.event.is_set():
+                    # The script was stopped (killed) while it waited
+                    alarm.waiters -= 1
+                    self.waiting -= 1
+                    if self.waiting == 0 and self.wake_at is not None:
+                        self.alarm_clock.set()  # so the ticker can stop
+
+    def schedule(self, due):
+        """Returns the alarm for a tick, filing a new one if needs be"""
+        alarms = self.slot_for(due).setdefault(due, [])
+        if not alarms:
+            alarms.append(Alarm())
+            heapq.heappush(self.dues, due)
+        return alarms[-1]
+
+    def clear(self):
+        """Forgets all the alarms"""
+        for level in self.slots:
+            for slot in level:
+                slot.clear()
+        self.dues = []
+        self.last_due = self.last_alarm = None
+
+    def next_due(self):
+        """Returns the earliest tick an alarm is filed for, or None"""
+        while self.dues and self.dues[0] <= self.current:
+            heapq.heappop(self.dues)
+        return self.dues[0] if self.dues else None
+
+    def slot_for(self, due):
+        ticks = due - self.current
+        level = 0
+        while level < levels - 1 and \
+                ticks >= 1 << (slot_bits * (level + 1)):
+            level += 1
+        index = (due >> (slot_bits * level)) & ((1 << slot_bits) - 1)
+        return self.slots[level][index]
+
+    def advance(self):
+        """Deals with the ticks that have passed"""
+        now = time.time()
+        with self.lock:
+            target = int((now - self.start) / tick)
+            while self.current < target:
+                self.current += 1
+                self.cascade()
+                alarms = self.slot_for(self.current).pop(self.current, ())
+                for alarm in alarms:
+                    self.waiting -= alarm.waiters
+                    self.alarms += 1
+                    self.lateness.append(
+                        now - (self.start + self.current * tick))
+                    alarm.event.set()
+
+    def cascade(self):
+        """Moves alarms down the levels, as their time gets near"""
+        mask = (1 << slot_bits) - 1
+        if self.current & mask:
+            return  # (the lowest level hasn't gone around)
+        for level in range(levels - 1, 0, -1):
+            shift = slot_bits * level
+            if (self.current & ((1 << shift) - 1)) == 0:
+                slot = self.slots[level][(self.current >> shift) & mask]
+                moving = slot.items()
+                slot.clear()
+                for due, alarms in moving:
+                    self.slot_for(due).setdefault(due, []).extend(alarms)
+
+    def run(self):
+        """Turns the wheel until nobody is waiting, sleeping until the
+        next tick something is due on"""
+        while True:
+            with self.lock:
+                due = self.next_due()
+                if self.waiting == 0 or due is None:
+                    self.ticker = None
+                    self.wake_at = None
+                    return
+                self.wake_at = due
+                self.alarm_clock.clear()
+            delay = self.start + due * tick - time.time()
+            if delay > 0:
+                self.alarm_clock.wait(delay)
+            with self.lock:
+                self.wake_at = None
+                self.wakeups += 1
+            self.advance()
+
+    def stats(self):
+        """Returns how many scripts are waiting and have waited, and how
+        late (in ms) they have been woken up"""
+        late = sorted(self.lateness) or [0.0]
+        return {
+            "tick_ms": tick * 1000,
+            "waiting": self.waiting,
+            "waits": self.waits,
+            "alarms": self.alarms,
+            "wakeups": self.wakeups,
+            "late_ms": sum(late) / len(late) * 1000,
+            "late_p95_ms": late[int(math.ceil(0.95 * len(late))) - 1] * 1000,
+            "late_max_ms": late[-1] * 1000,
+        }
+
+
+# The wheel in use; one is made when it is first needed
+wheel = None
+
+
+def get_wheel():
+    global wheel
+    if wheel is None or wheel.backend != concurrency.backend:
+        wheel = TimerWheel()
+    return wheel
+
+
+def wait(seconds):
+    """Lets the other scripts run for a while"""
+    if seconds > 0:
+        get_wheel().wait(seconds)
+    else:
+        concurrency.sleep(0)
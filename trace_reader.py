@@ -0,0 +1,81 @@
+"""trace_reader.py
+
+Prints, or replays, a trace recorded with 'enchanting2.py --trace FILE'"""
+
+import sys
+import time
+import argparse
+
+import tracing
+
+
+def parse_arguments(argv):
+    """Reads the command line options"""
+    parser = argparse.ArgumentParser(
+        description="Reads a trace of the blocks a project ran")
+    parser.add_argument("trace", help="the trace file to read")
+    parser.add_argument("--sprite", help="only blocks run by this sprite")
+    parser.add_argument("--function",
+                        help="only blocks that call this function")
+    parser.add_argument("--block", help="only the block with this uuid")
+    parser.add_argument("--since", type=float, metavar="SECONDS",
+                        help="skip blocks run in the first SECONDS")
+    parser.add_argument("--until", type=float, metavar="SECONDS",
+                        help="stop after the first SECONDS")
+    parser.add_argument("--tail", type=int, metavar="N",
+                        help="only show the last N blocks")
+    parser.add_argument("--replay", action="store_true",
+                        help="print blocks as far apart as they ran")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster to replay")
+    return parser.parse_args(argv[1:])
+
+
+def filter_records(records, sprite=None, function_name=None, block=None,
+                   since=None, until=None):
+    """Yields the records that match.  Times are in seconds,
+    from when the first record was made"""
+    start = None
+    for record in records:
+        if start is None:
+            start = record.timestamp
+        elapsed = record.timestamp - start
+        if until is not None and elapsed > until:
+            return
+        if since is not None and elapsed < since:
+            continue
+        if sprite is not None and record.sprite != sprite:
+            continue
+        if function_name is not None and \
+                record.function_name != function_name:
+            continue
+        if block is not None and str(record.uuid) != block:
+            continue
+        yield record
+
+
+def replay(records, speed=1.0, out=sys.stdout):
+    """Prints the records, pausing between them as the project did"""
+    previous = None
+    for record in records:
+        if previous is not None:
+            time.sleep(max(0, record.timestamp - previous) / speed)
+        previous = record.timestamp
+        print >> out, record
+
+
+def main(argv):
+    options = parse_arguments(argv)
+    records = filter_records(tracing.read_trace(options.trace),
+                             options.sprite, options.function,
+                             options.block, options.since, options.until)
+    if options.tail:
+        records = list(records)[-options.tail:]
+    if options.replay:
+        replay(records, options.speed)
+    else:
+        for record in records:
+            print record
+
+if __name__ == "__main__":
+    main(sys.argv)
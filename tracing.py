@@ -0,0 +1,207 @@
+"""tracing.py records which blocks ran, with what, and what they returned.
+
+Tracing is off (and costs next to nothing) unless a recorder is installed:
+
+    tracing.recorder = tracing.TraceRecorder(capacity=10000,
+                                             filename="robot.trace")
+
+The most recent records are kept in memory, in a ring buffer of the given
+capacity.  If a filename is given, every record is also appended to that
+file in a compact binary format, which trace_reader.py can read back.
+The file is flushed every records_per_flush records, and the event loop
+calls flush() once a frame, so a crash loses at most the last moments.
+
+The file starts with the 8 byte signature below, and is followed by
+records.  Each record is:
+
+    length of the rest of the record    (unsigned 32 bit int)
+    timestamp                           (64 bit float, seconds)
+    block uuid                          (16 bytes; all zeros if none)
+    sprite name, function name, result  (strings)
+    number of arguments                 (unsigned 16 bit int)
+    arguments                           (strings)
+
+Strings are an unsigned 32 bit length followed by that many bytes of
+UTF-8.  Everything is little-endian.
+"""
+
+from collections import deque
+import struct
+import time
+import uuid
+
+
+# The recorder blocks report to; None when we are not tracing
+recorder = None
+
+# How many records are written to the file between flushes, at most
+records_per_flush = 1000
+
+signature = "E2TRACE\x01"
+no_uuid = "\x00" * 16
+
+header_format = struct.Struct("<d16s")
+length_format = struct.Struct("<I")
+count_format = struct.Struct("<H")
+
+
+def value_to_string(value):
+    """Returns a string describing a block's argument or result"""
+    if value is None:
+        return ""
+    if isinstance(value, basestring):
+        return value
+    if hasattr(value, "as_string"):
+        return value.as_string()
+    return value.__class__.__name__  # ex. a Script
+
+
+def as_unicode(text):
+    """Byte strings are taken to be UTF-8"""
+    if isinstance(text, str):
+        return text.decode("utf-8", "replace")
+    return text
+
+
+class TraceRecord(object):
+
+    """One block that ran"""
+
+    def __init__(self, timestamp, block_uuid, sprite, function_name,
+                 args, result):
+        self.timestamp = timestamp
+        self.uuid = block_uuid  # a uuid.UUID, or None
+        self.sprite = sprite
+        self.function_name = function_name
+        self.args = args  # a list of strings
+        self.result = result  # a string
+
+    def __str__(self):
+        text = u"%.6f %s %s: %s(%s) -> %s" % (
+            self.timestamp, self.uuid, as_unicode(self.sprite),
+            as_unicode(self.function_name),
+            u", ".join(as_unicode(arg) for arg in self.args),
+            as_unicode(self.result))
+        return text.encode("utf-8")
+
+    def encode(self):
+        """Returns the record in its binary format"""
+        parts = [header_format.pack(
+            self.timestamp, self.uuid.bytes if self.uuid else no_uuid)]
+        for text in (self.sprite, self.function_name, self.result):
+            parts.append(encode_string(text))
+        parts.append(count_format.pack(len(self.args)))
+        parts.extend(encode_string(arg) for arg in self.args)
+        body = "".join(parts)
+        return length_format.pack(len(body)) + body
+
+    @staticmethod
+    def decode(body):
+        """Creates a record from its binary format (without the length)"""
+        timestamp, uuid_bytes = header_format.unpack_from(body, 0)
+        offset = header_format.size
+        sprite, offset = decode_string(body, offset)
+        function_name, offset = decode_string(body, offset)
+        result, offset = decode_string(body, offset)
+        count, = count_format.unpack_from(body, offset)
+        offset += count_format.size
+        args = []
+        for i in range(count):
+            arg, offset = decode_string(body, offset)
+            args.append(arg)
+        block_uuid = None
+        if uuid_bytes != no_uuid:
+            block_uuid = uuid.UUID(bytes=uuid_bytes)
+        return TraceRecord(timestamp, block_uuid, sprite, function_name,
+                           args, result)
+
+
+def encode_string(text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return length_format.pack(len(text)) + text
+
+
+def decode_string(body, offset):
+    length, = length_format.unpack_from(body, offset)
+    offset += length_format.size
+    text = body[offset:offset + length].decode("utf-8")
+    return text, offset + length
+
+
+class TraceRecorder(object):
+
+    """Keeps the most recent trace records, and optionally logs them all"""
+
+    def __init__(self, capacity=10000, filename=None):
+        self.records = deque(maxlen=capacity)
+        self.count = 0  # how many records there have been, in total
+        self.log = None
+        if filename:
+            self.log = open(filename, "ab", 64 * 1024)
+            if self.log.tell() == 0:
+                self.log.write(signature)
+
+    def record(self, block, target, args, result):
+        """Called by blocks after they have run"""
+        if isinstance(args, list):
+            args = [value_to_string(arg) for arg in args]
+        else:
+            args = [value_to_string(args)]  # a var block's variable name
+        entry = TraceRecord(time.time(), block.uuid,
+                            getattr(target, "name", ""),
+                            block.function_name, args,
+                            value_to_string(result))
+        self.records.append(entry)
+        self.count += 1
+        if self.log:
+            self.log.write(entry.encode())
+            if self.count % records_per_flush == 0:
+                self.log.flush()
+
+    def flush(self):
+        if self.log:
+            self.log.flush()
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+
+
+def start(capacity=10000, filename=None):
+    """Starts tracing; returns the recorder"""
+    global recorder
+    stop()
+    recorder = TraceRecorder(capacity, filename)
+    return recorder
+
+
+def flush():
+    """Writes out what the trace log has buffered, if we are tracing"""
+    if recorder is not None:
+        recorder.flush()
+
+
+def stop():
+    """Stops tracing, and finishes writing the log"""
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def read_trace(filename):
+    """Yields the records in a trace file, in the order they were made"""
+    with open(filename, "rb") as f:
+        if f.read(len(signature)) != signature:
+            raise ValueError("%s is not a trace file" % filename)
+        while True:
+            length_bytes = f.read(length_format.size)
+            if len(length_bytes) < length_format.size:
+                return  # a record may have been cut off by a crash
+            length, = length_format.unpack(length_bytes)
+            body = f.read(length)
+            if len(body) < length:
+                return
+            yield TraceRecord.decode(body)
@@ -419,6 +419,15 @@ IDE_Morph.prototype.openIn = function (world) {
             case "execute_block_result":
                 myself.onExecuteBlockResult(payload);
                 break;
+            case "profile_report":
+                myself.onProfileReport(payload);
+                break;
+            case "profile_error":
+                myself.onProfileError(payload);
+                break;
+            case "frame_stats":
+                myself.onFrameStats(payload);
+                break;
             default:
                 console.log("Unknown command: " + command);
         }
@@ -4218,6 +4227,53 @@ IDE_Morph.prototype.remotelyExecuteBlock = function (sprite, block) {
     }
 };
 
+// Starts the server's profiler (interval_ms may be left out)
+IDE_Morph.prototype.remotelyStartProfiling = function (interval_ms) {
+    if (this.websocket) {
+        this.websocket.send("profile_start " + (interval_ms || ""));
+    }
+};
+
+// Stops the server's profiler; it sends back what it found
+IDE_Morph.prototype.remotelyStopProfiling = function () {
+    if (this.websocket) {
+        this.websocket.send("profile_stop ");
+    }
+};
+
+// Asks the server what its profiler has found so far
+IDE_Morph.prototype.remotelyRequestProfile = function () {
+    if (this.websocket) {
+        this.websocket.send("profile_report ");
+    }
+};
+
+// Where the time goes, on the server: calls, self_ms, and total_ms for
+// each block (by uuid), block function, custom block, and sprite
+IDE_Morph.prototype.onProfileReport = function (payload) {
+    this.profile = JSON.parse(payload);
+    console.log("Profile: " + this.profile.blocks_ms + " ms in blocks");
+};
+
+// The server can't profile (it isn't running on gevent)
+IDE_Morph.prototype.onProfileError = function (payload) {
+    console.log("Profiling failed: " + payload);
+};
+
+// Asks the server how steadily it is drawing the stage
+IDE_Morph.prototype.remotelyRequestFrameStats = function () {
+    if (this.websocket) {
+        this.websocket.send("frame_stats ");
+    }
+};
+
+// fps, mean_ms, p95_ms, max_ms, late_frames, dropped_frames, and so on
+IDE_Morph.prototype.onFrameStats = function (payload) {
+    this.frameStats = JSON.parse(payload);
+    console.log("Frames: " + this.frameStats.fps.toFixed(1) + " fps, " +
+        this.frameStats.late_frames + " late");
+};
+
 // The remote block ran, and this is the result
 IDE_Morph.prototype.onExecuteBlockResult = function (payload) {
     // Hmm... don't seem to know how to deserialize the XML
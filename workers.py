@@ -0,0 +1,430 @@
+"""workers.py runs a project's sprites on several processes at once, so
+that a project with many busy sprites can use all of a Pi's cores.
+
+The main process keeps the whole project: it draws the stage, serves the
+web clients, and reads the keyboard, but it runs no scripts.  Instead,
+each worker process loads its own copy of the project and runs the
+scripts of the sprites it has been given (sprites are shared out so that
+each worker has about as many scripts as the others).  Once a frame:
+
+ - each worker tells the main process how the sprites it owns look now
+   (see Sprite.draw_state), and which global variables it has changed;
+ - the main process copies those into its project, to draw them, and
+   passes them on to the other workers, so that their sprites can see
+   where the others are and what the globals hold.
+
+Broadcasts, key presses, the green flag and the stop sign go to every
+worker.  Before a worker broadcasts, it sends what it has changed, so the
+scripts that receive the message see the variables that were set for it.
+
+Otherwise, workers see the others' sprites and globals as they were at
+the end of the last frame.  A global that is only changed ('change by')
+is sent as the amount it changed by, so changes made on several workers
+add up; but if two workers set a global in the same frame, the last one
+heard from wins.  That suits simulations with many independent sprites;
+projects whose sprites depend on each other's exact timing are better
+run on one process.  Edits to the project (deltas from a web client, see
+delta.py) are passed on to the workers, which make them to their copies,
+so the scripts that are running keep running.  A worker that can't make
+an edit says so, and is restarted on the main process's copy.
+
+Messages are lines of "command payload", as with web clients, where the
+payload is JSON and values are sent as XML.  Workers are started as
+"python workers.py <fd>", and send their messages on file descriptor fd,
+so that anything they print still goes to stdout.
+"""
+
+import json
+import os
+import signal
+import sys
+import xml.etree.cElementTree as ElementTree
+
+import gevent
+import gevent.subprocess
+from gevent.fileobject import FileObject
+
+import data
+import delta
+import event_loop
+import factory
+import media
+
+worker_script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+
+def partition(actors, count):
+    """Shares actors out among 'count' workers, so that each gets about
+    the same number of scripts.  Returns a list of actor indexes for each
+    worker."""
+    shares = [[] for i in range(count)]
+    loads = [0] * count
+    by_size = sorted(range(len(actors)),
+                     key=lambda index: -len(actors[index].scripts))
+    for index in by_size:
+        least = loads.index(min(loads))
+        shares[least].append(index)
+        loads[least] += max(len(actors[index].scripts), 1)
+    return [sorted(share) for share in shares]
+
+
+def encode(command, payload=None):
+    return "%s %s\n" % (command, json.dumps(payload))
+
+
+def decode(line):
+    command, payload = line.split(" ", 1)
+    return command, json.loads(payload)
+
+
+def error_text(error):
+    """Returns an exception's message as unicode, whatever it was made of"""
+    try:
+        return unicode(error)
+    except UnicodeDecodeError:
+        return str(error).decode("utf-8", "replace")
+
+
+def global_values(project):
+    """Returns {name: XML of its value} for the project's variables"""
+    return dict((variable.name,
+                 ElementTree.tostring(variable.value().serialize()))
+                for variable in project.variables.variables.values())
+
+
+def set_global_values(project, values):
+    """Sets the project's variables from {name: XML of its value}"""
+    for name, xml in values.items():
+        value = factory.deserialize_xml(xml)
+        variable = project.get_variable(name)
+        if variable is None:
+            project.variables.add(data.Variable(name, value))
+        else:
+            variable.set(value)
+
+
+def change_global_values(project, increments):
+    """Adds {name: increment} to the project's variables"""
+    for name, increment in increments.items():
+        variable = project.get_variable(name)
+        if variable is None:
+            project.variables.add(data.Variable(name, data.Literal(0)))
+            variable = project.get_variable(name)
+        # (not variable.change_by, which a SharedVariable counts as ours)
+        data.Variable.change_by(variable, increment)
+
+
+def set_draw_states(project, states):
+    """Sets how actors look from [[actor index, draw state]]"""
+    actors = project.all_actors()
+    for index, state in states:
+        actors[index].set_draw_state(state)
+
+
+class SharedVariable(data.Variable):
+
+    """A global variable in a worker, which remembers whether it has been
+    set since the last frame, or only changed, and by how much"""
+
+    __slots__ = ("was_set", "changed_by")
+
+    def __init__(self, name="No name", contents=None):
+        super(SharedVariable, self).__init__(name, contents)
+        self.forget_changes()
+
+    def set(self, value):
+        self.contents = value
+        self.was_set = True
+
+    def change_by(self, increment):
+        data.Variable.change_by(self, increment)
+        self.changed_by += increment
+
+    def forget_changes(self):
+        self.was_set = False
+        self.changed_by = 0
+
+
+class Worker(object):
+
+    """The main process's end of a worker process"""
+
+    def __init__(self, actor_indexes):
+        self.actor_indexes = actor_indexes
+        read_fd, write_fd = os.pipe()
+        self.process = gevent.subprocess.Popen(
+            [sys.executable, worker_script, str(write_fd)],
+            stdin=gevent.subprocess.PIPE, close_fds=True,
+            pass_fds=(write_fd,))
+        os.close(write_fd)
+        self.messages = FileObject(read_fd, "r")
+        self.reader = None  # the greenlet reading our messages
+
+    def send(self, line):
+        try:
+            self.process.stdin.write(line)
+            self.process.stdin.flush()
+        except IOError as e:
+            print "Could not send to worker %s: %s" % (self.process.pid, e)
+
+    def stop(self, timeout=1):
+        self.send(encode("quit"))
+        if self.reader is not None:
+            self.reader.kill()
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if self.process.wait(timeout) is None:
+            self.process.kill()
+            self.process.wait()
+        self.messages.close()
+
+
+class WorkerPool(object):
+
+    """Runs a project's scripts on worker processes; used by the event
+    loop in the main process (see EventLoop.workers)"""
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = []
+        self.project = None
+
+    def start(self, project):
+        """Starts (or restarts) the workers on a project"""
+        self.stop()
+        self.project = project
+        xml = factory.xml_for_object(project)
+        for share in partition(project.all_actors(), self.count):
+            self.workers.append(self.start_worker(share, xml))
+
+    def start_worker(self, actor_indexes, xml):
+        worker = Worker(actor_indexes)
+        worker.send(encode("load_project",
+                           {"xml": xml, "actors": actor_indexes}))
+        worker.reader = gevent.spawn(self.read_messages, worker)
+        return worker
+
+    def restart(self, worker):
+        """Replaces a worker whose copy of the project has gone astray
+        with one that loads the main process's copy"""
+        if worker not in self.workers:
+            return  # already stopped, or replaced
+        xml = factory.xml_for_object(self.project)
+        replacement = self.start_worker(worker.actor_indexes, xml)
+        self.workers[self.workers.index(worker)] = replacement
+        worker.stop()
+
+    def stop(self):
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+    def send(self, line, source=None):
+        """Sends a message to every worker except the source"""
+        for worker in self.workers:
+            if worker is not source:
+                worker.send(line)
+
+    def trigger_scripts(self, function_name, trigger=None):
+        self.send(encode("trigger", [function_name, trigger]))
+
+    def stop_all_scripts(self):
+        self.send(encode("stop"))
+
+    def apply_delta(self, xml):
+        """Passes on an edit that the main process has made"""
+        self.send(encode("project_delta", xml))
+
+    def read_messages(self, worker):
+        for line in worker.messages:
+            self.handle(worker, line)
+
+    def handle(self, worker, line):
+        """Catches up with what a worker has done, and passes it on"""
+        command, payload = decode(line)
+        if command == "sprites":
+            set_draw_states(self.project, payload)
+        elif command == "variables":
+            set_global_values(self.project, payload)
+        elif command == "increments":
+            change_global_values(self.project, payload)
+        elif command == "delta_failed":
+            print "Worker %s could not apply delta (%s); restarting it" % (
+                worker.process.pid, payload.encode("utf-8"))
+            # (not from here: stopping the worker kills its reader, us)
+            gevent.spawn(self.restart, worker)
+            return
+        elif command != "trigger":
+            print "Unrecognized command from worker: %s" % command
+            return
+        self.send(line, worker)
+
+
+class WorkerEventLoop(event_loop.EventLoop):
+
+    """Runs the scripts of some of a project's sprites, in a worker
+    process, and keeps in step with the main process"""
+
+    def __init__(self, incoming, outgoing):
+        super(WorkerEventLoop, self).__init__(
+            media.HeadlessMediaEnvironment())
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.actor_indexes = []
+        self.owned = set()  # the actors whose scripts we run
+        self.sent_states = {}  # actor index -> draw state last sent
+        self.sent_values = {}  # global name -> XML of value last seen
+        self.running = True
+
+    def send(self, command, payload):
+        self.outgoing.write(encode(command, payload))
+        self.outgoing.flush()
+
+    def queue(self, script, sprite, generation=None):
+        if sprite in self.owned:
+            super(WorkerEventLoop, self).queue(script, sprite, generation)
+
+    def load(self, xml, actor_indexes):
+        project = factory.deserialize_xml(xml, None)
+        actors = project.all_actors()
+        self.actor_indexes = actor_indexes
+        self.owned = set(actors[index] for index in actor_indexes)
+        self.sent_states = dict((index, actors[index].draw_state())
+                                for index in actor_indexes)
+        self.sent_values = global_values(project)
+        self.share_globals(project)
+        self.start_project(project)
+
+    def share_globals(self, project):
+        """Makes the project's global variables SharedVariables"""
+        for variable in project.variables.variables.values():
+            if not isinstance(variable, SharedVariable):
+                project.variables.add(
+                    SharedVariable(variable.name, variable.contents))
+
+    def trigger_scripts(self, function_name, trigger=None):
+        """One of our scripts broadcast a message; the other workers
+        need to know, too"""
+        self.send_changes()
+        super(WorkerEventLoop, self).trigger_scripts(function_name, trigger)
+        self.send("trigger", [function_name, trigger])
+
+    def send_changes(self):
+        """Sends how our sprites look, and the globals we have changed,
+        if they have changed since we last sent them"""
+        if self.project is None:
+            return
+        actors = self.project.all_actors()
+        states = []
+        for index in self.actor_indexes:
+            state = actors[index].draw_state()
+            if state != self.sent_states[index]:
+                self.sent_states[index] = state
+                states.append([index, state])
+        if states:
+            self.send("sprites", states)
+
+        values = global_values(self.project)
+        changed = {}
+        increments = {}
+        for name, xml in values.items():
+            variable = self.project.get_variable(name)
+            if isinstance(variable, SharedVariable):
+                if variable.changed_by and not variable.was_set:
+                    increments[name] = variable.changed_by
+                variable.forget_changes()
+            if name not in increments and self.sent_values.get(name) != xml:
+                changed[name] = xml
+        self.sent_values = values
+        if changed:
+            self.send("variables", changed)
+        if increments:
+            self.send("increments", increments)
+
+    def receive_values(self, values):
+        """Another worker set some globals.  What ours have been changed
+        by since the last frame still counts, on top of the new values."""
+        for name, xml in values.items():
+            variable = self.project.get_variable(name)
+            changed_by = 0
+            if isinstance(variable, SharedVariable) and not variable.was_set:
+                changed_by = variable.changed_by
+            set_global_values(self.project, {name: xml})
+            variable = self.project.get_variable(name)
+            if isinstance(variable, SharedVariable):
+                variable.forget_changes()
+                if changed_by:
+                    variable.change_by(changed_by)
+        self.sent_values.update(values)
+        self.share_globals(self.project)
+
+    def receive_increments(self, increments):
+        """Other workers changed some globals"""
+        change_global_values(self.project, increments)
+        self.share_globals(self.project)
+        self.sent_values.update(
+            (name, ElementTree.tostring(
+                self.project.get_variable(name).value().serialize()))
+            for name in increments)
+
+    def apply_delta(self, xml):
+        """Makes an edit that the main process has made, to our copy"""
+        applier = delta.DeltaApplier(self.project)
+        try:
+            applier.apply(ElementTree.XML(xml))
+        except delta.errors as e:
+            # our copy may be half edited; the main process will restart us
+            self.send("delta_failed", error_text(e))
+        finally:
+            self.scripts_changed(applier.changes)
+            if self.project is not None:
+                self.share_globals(self.project)
+
+    def read_messages(self):
+        for line in self.incoming:
+            self.handle(*decode(line))
+            if not self.running:
+                break
+        self.running = False  # the main process has gone
+
+    def handle(self, command, payload):
+        if command == "load_project":
+            self.load(payload["xml"], payload["actors"])
+        elif command == "trigger":
+            # (not our own trigger_scripts, which would send it back)
+            event_loop.EventLoop.trigger_scripts(self, *payload)
+        elif command == "stop":
+            self.stop_all_scripts()
+        elif command == "sprites":
+            set_draw_states(self.project, payload)
+        elif command == "variables":
+            self.receive_values(payload)
+        elif command == "increments":
+            self.receive_increments(payload)
+        elif command == "project_delta":
+            self.apply_delta(payload)
+        elif command == "quit":
+            self.running = False
+        else:
+            print "Unrecognized command from main process: %s" % command
+
+    def run_forever(self):
+        reader = gevent.spawn(self.read_messages)
+        while self.running:
+            self.send_changes()
+            self.frame_pacer.wait()
+        reader.kill()
+        self.purge_all_scripts()
+
+
+def main(argv):
+    # ^C is for the main process, which stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = WorkerEventLoop(FileObject(sys.stdin, "r"),
+                           FileObject(int(argv[1]), "w"))
+    loop.run_forever()
+
+if __name__ == "__main__":
+    main(sys.argv)